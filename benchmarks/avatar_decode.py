@@ -0,0 +1,113 @@
+"""Compares processing avatar uploads with the jpeg decoded at full size
+(`full`) against decoding it at a reduced scale with draft mode (`draft`).
+
+Without draft mode, photos with an EXIF orientation are decoded at full
+size when they're rotated, before they're shrunk to the largest avatar
+size.
+
+Each mode runs in its own process, reading the images one at a time, and
+peak RSS is reported as the increase over the RSS before the first image
+is read. Generated images are written in a separate process so that
+doesn't add to it.
+
+Pass a directory of phone photos with `--corpus`, otherwise 12 megapixel
+images are generated, three in four of them with an EXIF rotation.
+
+usage: python -m benchmarks.avatar_decode [--corpus DIR] [--count 20] [--repeat 3]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import struct
+import tempfile
+import time
+
+from PIL import Image
+
+from toshiid.handlers_v1 import process_image
+
+GENERATED_SIZE = (4032, 3024)
+# exif orientations a phone writes for each way it can be held
+ORIENTATIONS = (1, 3, 6, 8)
+
+def exif_orientation(orientation):
+    """A minimal EXIF block with only the orientation tag"""
+
+    ifd = struct.pack(">HHHIHHI", 1, 0x0112, 3, 1, orientation, 0, 0)
+    return b'Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08' + ifd
+
+def generate_corpus(path, count, seed):
+    rng = random.Random(seed)
+    for i in range(count):
+        # smooth colours with noise on top, so the jpeg has something to encode
+        colours = Image.frombytes('RGB', (64, 48), bytes(rng.getrandbits(8) for _ in range(64 * 48 * 3)))
+        noise = Image.effect_noise(GENERATED_SIZE, rng.randint(20, 60)).convert('RGB')
+        img = Image.blend(colours.resize(GENERATED_SIZE, Image.BICUBIC), noise, 0.2)
+        filename = os.path.join(path, "{}.jpg".format(i))
+        img.save(filename, format='JPEG', quality=90,
+                 exif=exif_orientation(ORIENTATIONS[i % len(ORIENTATIONS)]))
+
+def find_corpus(path):
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if name.lower().endswith(('.jpg', '.jpeg'))]
+
+def max_rss():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run(name, draft, corpus, repeat, results):
+    start_rss = max_rss()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for filename in corpus:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            process_image(data, 'image/jpeg', draft=draft)
+    duration = time.perf_counter() - start
+    results.put({
+        'name': name,
+        'ms_per_image': duration * 1000 / (len(corpus) * repeat),
+        'peak_rss_mb': (max_rss() - start_rss) / (1024 * 1024)
+    })
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', help="directory of jpegs to process")
+    parser.add_argument('--count', type=int, default=20,
+                        help="number of images to generate without a corpus")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="times each image is processed")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        if not args.corpus:
+            process = multiprocessing.Process(target=generate_corpus, args=(path, args.count, args.seed))
+            process.start()
+            process.join()
+        compare(find_corpus(args.corpus or path), args.repeat)
+
+def compare(corpus, repeat):
+    sizes = []
+    for filename in corpus:
+        with Image.open(filename) as img:
+            sizes.append(img.size)
+    megapixels = sum(width * height for width, height in sizes) / len(sizes) / 1000000
+
+    print("{} jpegs, {:.1f} megapixels on average".format(len(corpus), megapixels))
+    print("{:<8} {:>10} {:>14}".format("decode", "ms/image", "peak RSS (MB)"))
+    results = []
+    queue = multiprocessing.Queue()
+    for name, draft in [('full', False), ('draft', True)]:
+        process = multiprocessing.Process(target=run, args=(name, draft, corpus, repeat, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+    for result in results:
+        print("{name:<8} {ms_per_image:>10.1f} {peak_rss_mb:>14.1f}".format(**result))
+    print("speedup: {:.1f}x".format(results[0]['ms_per_image'] / results[1]['ms_per_image']))
+
+if __name__ == '__main__':
+    main()
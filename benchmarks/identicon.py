@@ -0,0 +1,73 @@
+"""Compares rendering identicons with `blockies` against the palette PNG
+renderer in `toshiid.identicon`.
+
+Reports renders per second on a single core and the average size of the
+resulting PNGs. The same addresses are rendered by both, and a sample of
+them is checked to make sure the images are the same.
+
+usage: python -m benchmarks.identicon [--count 5000] [--size 8] [--scale 12] [--seed 1]
+"""
+import argparse
+import random
+import time
+
+from io import BytesIO
+
+import blockies
+from PIL import Image
+
+from toshiid.identicon import render_png
+
+PARITY_SAMPLE = 100
+
+def render_blockies(address, size, scale):
+    return blockies.create(address, size=size, scale=scale, format='PNG')
+
+def render_palette(address, size, scale):
+    return render_png(address, size=size, scale=scale)
+
+def run(name, render, addresses, size, scale):
+    start = time.perf_counter()
+    total_bytes = 0
+    for address in addresses:
+        total_bytes += len(render(address, size, scale))
+    duration = time.perf_counter() - start
+    return {
+        'name': name,
+        'renders_per_second': len(addresses) / duration,
+        'average_bytes': total_bytes / len(addresses)
+    }
+
+def check_parity(addresses, size, scale):
+    for address in addresses[:PARITY_SAMPLE]:
+        expected = Image.open(BytesIO(render_blockies(address, size, scale))).convert('RGB').tobytes()
+        actual = Image.open(BytesIO(render_palette(address, size, scale))).convert('RGB').tobytes()
+        if expected != actual:
+            raise Exception("Renders differ for {}".format(address))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=5000,
+                        help="number of identicons to render with each renderer")
+    parser.add_argument('--size', type=int, default=8)
+    parser.add_argument('--scale', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=1,
+                        help="seed for generating the addresses")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    addresses = ["0x{:040x}".format(rng.getrandbits(160)) for _ in range(args.count)]
+    check_parity(addresses, args.size, args.scale)
+
+    print("{} identicons, {}x{} cells at scale {}".format(args.count, args.size, args.size, args.scale))
+    print("{:<10} {:>12} {:>12}".format("renderer", "renders/s", "avg bytes"))
+    results = [run('blockies', render_blockies, addresses, args.size, args.scale),
+               run('palette', render_palette, addresses, args.size, args.scale)]
+    for result in results:
+        print("{name:<10} {renders_per_second:>12.1f} {average_bytes:>12.1f}".format(**result))
+    print("speedup: {:.1f}x, size: {:.0%}".format(
+        results[1]['renders_per_second'] / results[0]['renders_per_second'],
+        results[1]['average_bytes'] / results[0]['average_bytes']))
+
+if __name__ == '__main__':
+    main()
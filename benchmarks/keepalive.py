@@ -0,0 +1,135 @@
+"""Compares keep alive scheduling strategies for a large number of
+simulated websocket connections.
+
+`timers` is the old behaviour of each connection scheduling its own
+`call_later` for the next ping and re-arming it when the pong arrives.
+`wheel` uses the shared `KeepaliveScheduler`.
+
+All connections are opened at the same time (e.g. clients reconnecting
+after a deploy), which is the worst case for ping bursts.
+
+usage: python -m benchmarks.keepalive [--connections 100000] [--interval 10] [--duration 25]
+"""
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+
+import tornado.ioloop
+
+from toshiid.keepalive import KeepaliveScheduler
+
+LAG_PROBE_INTERVAL = 0.01
+
+class FakeConnection:
+
+    def __init__(self, io_loop, interval, scheduler=None):
+        self.io_loop = io_loop
+        self.interval = interval
+        self.scheduler = scheduler
+        self.pings = 0
+        # real handlers already have plenty of attributes, so pre-populate
+        # the ones the schedulers set to avoid measuring dict resizes
+        self._pingcb = None
+        self._keepalive_slot = None
+
+    def open(self):
+        if self.scheduler is None:
+            self.schedule_ping()
+        else:
+            self.scheduler.add(self)
+
+    def schedule_ping(self):
+        self._pingcb = self.io_loop.call_later(self.interval, self.send_ping)
+
+    def send_ping(self):
+        self.pings += 1
+        # the pong arrives on a later iteration of the event loop
+        self.io_loop.add_callback(self.on_pong)
+
+    def on_pong(self):
+        if self.scheduler is None:
+            self.schedule_ping()
+
+    def close(self):
+        if self.scheduler is None:
+            self.io_loop.remove_timeout(self._pingcb)
+        else:
+            self.scheduler.remove(self)
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+async def measure_lag(duration):
+    lags = []
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        start = time.monotonic()
+        await asyncio.sleep(LAG_PROBE_INTERVAL)
+        lags.append(time.monotonic() - start - LAG_PROBE_INTERVAL)
+    return lags
+
+async def run(mode, count, interval, duration):
+    io_loop = tornado.ioloop.IOLoop.current()
+    scheduler = KeepaliveScheduler(interval, io_loop=io_loop) if mode == 'wheel' else None
+
+    gc.collect()
+    tracemalloc.start()
+    # measure the connection objects on their own so we only
+    # report the overhead of the scheduling
+    base = tracemalloc.take_snapshot()
+    connections = [FakeConnection(io_loop, interval, scheduler) for _ in range(count)]
+    objects = tracemalloc.take_snapshot()
+    for connection in connections:
+        connection.open()
+    opened = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    object_bytes = sum(stat.size_diff for stat in objects.compare_to(base, 'filename'))
+    schedule_bytes = sum(stat.size_diff for stat in opened.compare_to(objects, 'filename'))
+
+    lags = await measure_lag(duration)
+
+    pings = sum(connection.pings for connection in connections)
+    for connection in connections:
+        connection.close()
+    if scheduler is not None:
+        scheduler.stop()
+
+    return {
+        'mode': mode,
+        'object_bytes': object_bytes / count,
+        'schedule_bytes': schedule_bytes / count,
+        'pings': pings,
+        'lag_p50': percentile(lags, 50) * 1000,
+        'lag_p99': percentile(lags, 99) * 1000,
+        'lag_max': max(lags) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=100000)
+    parser.add_argument('--interval', type=int, default=10,
+                        help="keep alive interval in seconds")
+    parser.add_argument('--duration', type=float, default=25,
+                        help="how long to measure event loop lag for in seconds")
+    parser.add_argument('--mode', choices=['timers', 'wheel', 'both'], default='both')
+    args = parser.parse_args()
+
+    modes = ['timers', 'wheel'] if args.mode == 'both' else [args.mode]
+    print("{} connections, {}s interval, measuring for {}s".format(
+        args.connections, args.interval, args.duration))
+    print("{:<8} {:>14} {:>16} {:>10} {:>12} {:>12} {:>12}".format(
+        "mode", "conn B/conn", "schedule B/conn", "pings", "lag p50 ms", "lag p99 ms", "lag max ms"))
+    for mode in modes:
+        result = tornado.ioloop.IOLoop.current().run_sync(
+            lambda: run(mode, args.connections, args.interval, args.duration))
+        print("{mode:<8} {object_bytes:>14.1f} {schedule_bytes:>16.1f} {pings:>10} "
+              "{lag_p50:>12.2f} {lag_p99:>12.2f} {lag_max:>12.2f}".format(**result))
+
+if __name__ == '__main__':
+    main()
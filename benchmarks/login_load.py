@@ -0,0 +1,244 @@
+"""Load test for the remote login flow.
+
+Starts a local redis server (using testing.redis) and the login
+endpoints on a local port, opens many concurrent `GET /v1/login/{key}`
+long polls, then completes them with signed `POST`s at a fixed rate.
+
+Reports the completion latency (time from sending the POST to the long
+poll returning), the size of the `LoginManager` bookkeeping while the
+polls are pending and after they complete, and the redis command rate
+while completing the logins.
+
+Login keys, signing key and completion order are derived from `--seed`
+so runs with the same arguments can be compared between changes.
+
+usage: python -m benchmarks.login_load [--clients 10000] [--rate 500] [--seed 1]
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+import resource
+import socket
+import string
+import sys
+import time
+
+import aioredis
+import testing.redis
+import tornado.httpclient
+import tornado.ioloop
+import tornado.platform.asyncio
+
+from toshi.config import config
+from toshi.ethereum.utils import private_key_to_address
+from toshi.handlers import TOSHI_ID_ADDRESS_HEADER, TOSHI_SIGNATURE_HEADER, TOSHI_TIMESTAMP_HEADER
+from toshi.request import sign_request
+import toshi.web
+
+from toshiid import login
+
+LOGIN_URLS = [
+    (r"^/v1/login/([a-zA-Z0-9]+)/?$", login.LoginHandler),
+]
+
+SAMPLE_INTERVAL = 0.1
+LOGIN_KEY_LENGTH = 16
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def raise_file_limit(clients):
+    # every long poll needs a socket on both the client and server side
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = clients * 2 + 100
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+        soft = min(wanted, hard)
+    if soft < wanted:
+        print("WARNING: open file limit of {} is too low for {} clients".format(soft, clients), file=sys.stderr)
+
+async def command_stats(redis):
+    info = await redis.info('commandstats')
+    return {key.split('_', 1)[1]: int(value['calls'])
+            for key, value in info['commandstats'].items()}
+
+class ManagerSampler:
+    """Records the size of the login manager's bookkeeping over time"""
+
+    def __init__(self):
+        self.max_keys = 0
+        self.max_futures = 0
+        self.max_expiry = 0
+        self._running = True
+
+    def current(self):
+        manager = login.LoginManager._instance
+        if manager is None:
+            return 0, 0, 0
+        return len(manager._keys), len(manager._futures), len(manager._expiry)
+
+    async def run(self):
+        while self._running:
+            keys, futures, expiry = self.current()
+            self.max_keys = max(self.max_keys, keys)
+            self.max_futures = max(self.max_futures, futures)
+            self.max_expiry = max(self.max_expiry, expiry)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    def stop(self):
+        self._running = False
+
+async def run(args, redis_dsn):
+    rng = random.Random(args.seed)
+    alphabet = string.ascii_letters + string.digits
+    keys = [''.join(rng.choice(alphabet) for _ in range(LOGIN_KEY_LENGTH)) for _ in range(args.clients)]
+    completion_order = list(range(args.clients))
+    rng.shuffle(completion_order)
+    signing_key = hashlib.sha256("login_load:{}".format(args.seed).encode('utf-8')).digest()
+    address = private_key_to_address(signing_key)
+
+    port = free_port()
+    app = toshi.web.Application(LOGIN_URLS)
+    server = app.listen(port, address='127.0.0.1')
+    base_url = "http://127.0.0.1:{}".format(port)
+
+    redis = await aioredis.create_redis((redis_dsn['host'], redis_dsn['port']))
+
+    poll_client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=args.clients)
+    post_client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=args.post_concurrency)
+
+    sampler = ManagerSampler()
+    sampler_task = asyncio.ensure_future(sampler.run())
+
+    completed = {}
+    errors = []
+
+    async def poll(i):
+        try:
+            await poll_client.fetch("{}/v1/login/{}".format(base_url, keys[i]),
+                                    request_timeout=args.timeout, connect_timeout=args.timeout)
+            completed[i] = time.monotonic()
+        except Exception as e:
+            errors.append(e)
+
+    print("opening {} long polls".format(args.clients))
+    open_start = time.monotonic()
+    polls = [asyncio.ensure_future(poll(i)) for i in range(args.clients)]
+    while sampler.current()[0] < args.clients and time.monotonic() - open_start < args.timeout:
+        await asyncio.sleep(SAMPLE_INTERVAL)
+    pending_keys, pending_futures, _ = sampler.current()
+    print("{} long polls pending after {:.2f}s".format(pending_keys, time.monotonic() - open_start))
+
+    posted = {}
+
+    async def complete(i):
+        path = "/v1/login/{}".format(keys[i])
+        timestamp = int(time.time())
+        signature = sign_request(signing_key, "POST", path, timestamp, b"")
+        posted[i] = time.monotonic()
+        try:
+            await post_client.fetch(base_url + path, method="POST", body=b"", headers={
+                TOSHI_ID_ADDRESS_HEADER: address,
+                TOSHI_SIGNATURE_HEADER: signature,
+                TOSHI_TIMESTAMP_HEADER: str(timestamp)
+            })
+        except Exception as e:
+            errors.append(e)
+
+    before = await command_stats(redis)
+    complete_start = time.monotonic()
+    posts = []
+    for n, i in enumerate(completion_order):
+        # schedule off the start time so the rate doesn't drift
+        delay = complete_start + n / args.rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        posts.append(asyncio.ensure_future(complete(i)))
+    await asyncio.gather(*posts)
+    await asyncio.wait(polls, timeout=args.timeout)
+    complete_duration = time.monotonic() - complete_start
+    after = await command_stats(redis)
+
+    # give cancelled/expired checks a moment to clean up
+    await asyncio.sleep(SAMPLE_INTERVAL * 2)
+    sampler.stop()
+    await sampler_task
+    remaining_keys, remaining_futures, remaining_expiry = sampler.current()
+
+    for f in polls:
+        if not f.done():
+            f.cancel()
+    poll_client.close()
+    post_client.close()
+    server.stop()
+    redis.close()
+    await redis.wait_closed()
+
+    latencies = [completed[i] - posted[i] for i in completed if i in posted]
+    commands = {name: after.get(name, 0) - before.get(name, 0) for name in after}
+    commands = {name: calls for name, calls in commands.items() if calls > 0}
+
+    return {
+        'pending_keys': pending_keys,
+        'pending_futures': pending_futures,
+        'completed': len(latencies),
+        'errors': len(errors),
+        'duration': complete_duration,
+        'latencies': latencies,
+        'max_keys': sampler.max_keys,
+        'max_futures': sampler.max_futures,
+        'max_expiry': sampler.max_expiry,
+        'remaining_keys': remaining_keys,
+        'remaining_futures': remaining_futures,
+        'remaining_expiry': remaining_expiry,
+        'commands': commands
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=10000,
+                        help="number of concurrent long polls")
+    parser.add_argument('--rate', type=float, default=500,
+                        help="logins completed per second")
+    parser.add_argument('--post-concurrency', type=int, default=50,
+                        help="maximum number of POSTs in flight")
+    parser.add_argument('--timeout', type=float, default=55,
+                        help="client timeout, should be less than the login expiry")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    raise_file_limit(args.clients)
+    tornado.platform.asyncio.AsyncIOMainLoop().install()
+
+    with testing.redis.RedisServer() as redis_server:
+        redis_dsn = redis_server.dsn()
+        config['redis'] = {key: str(value) for key, value in redis_dsn.items()}
+        result = asyncio.get_event_loop().run_until_complete(run(args, redis_dsn))
+
+    latencies = result['latencies']
+    print("clients: {clients}, rate: {rate}/s, seed: {seed}".format(**vars(args)))
+    print("pending before completion: {pending_keys} keys, {pending_futures} futures".format(**result))
+    print("completed {} logins in {:.2f}s, {} errors".format(
+        result['completed'], result['duration'], result['errors']))
+    print("latency ms: p50 {:.2f} p90 {:.2f} p99 {:.2f} max {:.2f}".format(
+        percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+        percentile(latencies, 99) * 1000, max(latencies or [0]) * 1000))
+    print("login manager peak: {max_keys} keys, {max_futures} futures, {max_expiry} expiry entries".format(**result))
+    print("login manager after: {remaining_keys} keys, {remaining_futures} futures, "
+          "{remaining_expiry} expiry entries".format(**result))
+    total = sum(result['commands'].values())
+    print("redis commands: {} total, {:.1f}/s".format(total, total / result['duration']))
+    for name, calls in sorted(result['commands'].items(), key=lambda item: -item[1]):
+        print("  {:<12} {:>8} {:>10.1f}/s".format(name, calls, calls / result['duration']))
+
+if __name__ == '__main__':
+    main()
@@ -62,6 +62,14 @@ CREATE TABLE IF NOT EXISTS avatars (
     hash VARCHAR,
     format VARCHAR NOT NULL,
     last_modified TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'),
+    -- set once the image has been copied to the object store
+    object_key VARCHAR,
+    -- the largest dimension of the image, and the hash of the
+    -- full size avatar for smaller versions of the same upload
+    size INTEGER,
+    source_hash VARCHAR,
+    -- the sha256 of the image, for avatars stored in avatar_blobs
+    blob_hash VARCHAR,
 
     PRIMARY KEY (toshi_id, hash)
 );
@@ -70,6 +78,22 @@ CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_hash_substr ON avatars (toshi_id
 CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_format_hash_substr ON avatars (toshi_id, format, substring(hash for 5));
 CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_last_modified ON avatars (toshi_id, last_modified DESC NULLS LAST);
 CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_format_last_modified ON avatars (toshi_id, format, last_modified DESC NULLS LAST);
+CREATE INDEX IF NOT EXISTS idx_avatars_unmigrated ON avatars (toshi_id, hash) WHERE object_key IS NULL;
+CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_source_hash_size ON avatars (toshi_id, source_hash, size);
+CREATE INDEX IF NOT EXISTS idx_avatars_blob_hash ON avatars (blob_hash);
+
+-- uploaded images, stored once however many users use them
+CREATE TABLE IF NOT EXISTS avatar_blobs (
+    hash VARCHAR PRIMARY KEY,
+    format VARCHAR NOT NULL,
+    bytes INTEGER,
+    object_key VARCHAR NOT NULL,
+    created TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'),
+    -- the last time an upload used the blob
+    last_used TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc')
+);
+
+CREATE INDEX IF NOT EXISTS idx_avatar_blobs_last_used ON avatar_blobs (last_used);
 
 CREATE TABLE IF NOT EXISTS reports (
     report_id SERIAL PRIMARY KEY,
@@ -108,4 +132,4 @@ CREATE TABLE IF NOT EXISTS websocket_sessions (
 CREATE INDEX IF NOT EXISTS idx_websocket_sessions_toshi_id ON websocket_sessions (toshi_id);
 CREATE INDEX IF NOT EXISTS idx_websocket_sessions_last_seen ON websocket_sessions (last_seen DESC);
 
-UPDATE database_version SET version_number = 27;
+UPDATE database_version SET version_number = 32;
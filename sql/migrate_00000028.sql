@@ -0,0 +1,3 @@
+ALTER TABLE avatars ADD COLUMN object_key VARCHAR;
+
+CREATE INDEX IF NOT EXISTS idx_avatars_unmigrated ON avatars (toshi_id, hash) WHERE object_key IS NULL;
@@ -0,0 +1,2 @@
+-- identicons are no longer stored
+DELETE FROM avatars WHERE position('_identicon_' IN toshi_id) > 0;
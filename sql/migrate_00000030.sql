@@ -0,0 +1,6 @@
+-- uploaded avatars are stored at multiple sizes, source_hash is the
+-- hash of the full size avatar the row is a version of
+ALTER TABLE avatars ADD COLUMN size INTEGER;
+ALTER TABLE avatars ADD COLUMN source_hash VARCHAR;
+
+CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_source_hash_size ON avatars (toshi_id, source_hash, size);
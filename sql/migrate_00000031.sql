@@ -0,0 +1,11 @@
+-- uploaded avatars are stored once per distinct image, keyed by the
+-- sha256 of their content. avatars rows reference the blob they use
+CREATE TABLE IF NOT EXISTS avatar_blobs (
+    hash VARCHAR PRIMARY KEY,
+    format VARCHAR NOT NULL,
+    bytes INTEGER,
+    object_key VARCHAR NOT NULL,
+    created TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc')
+);
+
+ALTER TABLE avatars ADD COLUMN blob_hash VARCHAR;
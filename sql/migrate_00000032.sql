@@ -0,0 +1,6 @@
+-- blobs no avatar references are removed by housekeeping once they
+-- haven't been used by an upload for a while
+ALTER TABLE avatar_blobs ADD COLUMN last_used TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc');
+
+CREATE INDEX IF NOT EXISTS idx_avatars_blob_hash ON avatars (blob_hash);
+CREATE INDEX IF NOT EXISTS idx_avatar_blobs_last_used ON avatar_blobs (last_used);
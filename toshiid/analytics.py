@@ -0,0 +1,220 @@
+import asyncio
+import collections
+import json
+import random
+import time
+
+from tornado.httpclient import AsyncHTTPClient
+
+from toshi.analytics import AnalyticsMixin, encode_id
+from toshi.config import config
+from toshi.log import log
+
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+def parse_sample_rates(value):
+    """Parses `"Searched=0.1,Edited profile=1"` into a dict of
+    event name -> fraction of events to keep"""
+
+    rates = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        event, rate = item.rsplit('=', 1)
+        rates[event.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+class MixpanelBackend:
+
+    def __init__(self, token):
+        import mixpanel
+        self.consumer = mixpanel.BufferedConsumer(max_size=DEFAULT_BATCH_SIZE)
+        self.mixpanel = mixpanel.Mixpanel(token, consumer=self.consumer)
+
+    def _send(self, events):
+        for kind, distinct_id, name, data in events:
+            if kind == 'track':
+                self.mixpanel.track(distinct_id, name, data)
+            else:
+                self.mixpanel.people_set(distinct_id, data)
+        self.consumer.flush()
+
+    async def send(self, events):
+        # the mixpanel client uses blocking http requests
+        await asyncio.get_event_loop().run_in_executor(None, self._send, events)
+
+class FileBackend:
+    """Appends events to a file as json lines, for local development"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _send(self, events):
+        with open(self.path, 'a') as f:
+            for kind, distinct_id, name, data in events:
+                f.write(json.dumps({'type': kind, 'distinct_id': distinct_id, 'event': name, 'data': data}))
+                f.write('\n')
+
+    async def send(self, events):
+        await asyncio.get_event_loop().run_in_executor(None, self._send, events)
+
+class HTTPBackend:
+    """Posts each batch of events as a json list to the given url"""
+
+    def __init__(self, url):
+        self.url = url
+
+    async def send(self, events):
+        body = json.dumps([{'type': kind, 'distinct_id': distinct_id, 'event': name, 'data': data}
+                           for kind, distinct_id, name, data in events])
+        await AsyncHTTPClient().fetch(self.url, method="POST", body=body,
+                                      headers={'Content-Type': 'application/json'})
+
+class AnalyticsQueue:
+    """A bounded in memory queue of analytics events, which are sent to the
+    backend in batches by a background task. When the queue is full new
+    events are dropped rather than making the caller wait"""
+
+    _instance = None
+
+    def __init__(self, backend, *, maxsize=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, sample_rates=None):
+        self.backend = backend
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_rates = sample_rates or {}
+        self._config = None
+        self._events = collections.deque()
+        self._flusher = None
+        self._flusher_loop = None
+        self._wakeup = None
+
+        self.queued = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.sent = 0
+        self.failed = 0
+
+    @staticmethod
+    def get_instance():
+        """Returns the queue for the configured backend, or None if
+        events should be sent directly. Without a backend, events are
+        queued for mixpanel when a mixpanel token is configured. The
+        `direct` backend opts out of the queue"""
+
+        backend_name = config['general'].get('analytics_backend', '')
+        if not backend_name:
+            if 'mixpanel' in config and config['mixpanel'].get('token'):
+                backend_name = 'mixpanel'
+            else:
+                # nowhere to send events
+                return None
+        if backend_name == 'direct':
+            return None
+        target = config['general'].get('analytics_target', '')
+        instance = AnalyticsQueue._instance
+        if instance is None or instance._config != (backend_name, target):
+            if backend_name == 'mixpanel':
+                backend = MixpanelBackend(target or config['mixpanel']['token'])
+            elif backend_name == 'file':
+                backend = FileBackend(target)
+            elif backend_name == 'http':
+                backend = HTTPBackend(target)
+            else:
+                raise Exception("Unknown analytics backend: {}".format(backend_name))
+            instance = AnalyticsQueue._instance = AnalyticsQueue(
+                backend,
+                maxsize=int(config['general'].get('analytics_queue_size', DEFAULT_QUEUE_SIZE)),
+                batch_size=int(config['general'].get('analytics_batch_size', DEFAULT_BATCH_SIZE)),
+                flush_interval=float(config['general'].get('analytics_flush_interval', DEFAULT_FLUSH_INTERVAL)),
+                sample_rates=parse_sample_rates(config['general'].get('analytics_sample_rates', '')))
+            instance._config = (backend_name, target)
+        return instance
+
+    def __len__(self):
+        return len(self._events)
+
+    def put(self, kind, distinct_id, name, data):
+        rate = self.sample_rates.get(name, self.sample_rates.get('*', 1.0))
+        if rate < 1.0 and random.random() >= rate:
+            self.sampled_out += 1
+            return False
+        if len(self._events) >= self.maxsize:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                log.warning("analytics queue full, {} events dropped so far".format(self.dropped))
+            return False
+        self._events.append((kind, distinct_id, name, data))
+        self.queued += 1
+        self._start()
+        if len(self._events) >= self.batch_size and self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+        return True
+
+    def _start(self):
+        loop = asyncio.get_event_loop()
+        if self._flusher is not None and not self._flusher.done() and self._flusher_loop is loop:
+            return
+        self._flusher_loop = loop
+        self._flusher = loop.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while self._events:
+            if len(self._events) < self.batch_size:
+                # wait for a full batch, or the flush interval
+                self._wakeup = loop.create_future()
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._wakeup), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup = None
+            await self.flush()
+
+    async def flush(self):
+        """Sends everything currently in the queue"""
+
+        while self._events:
+            batch = [self._events.popleft() for _ in range(min(self.batch_size, len(self._events)))]
+            start = time.monotonic()
+            try:
+                await self.backend.send(batch)
+                self.sent += len(batch)
+            except:
+                # don't retry, the backend could be down for a while
+                # and we don't want to build up a backlog
+                self.failed += len(batch)
+                log.exception("error sending {} analytics events".format(len(batch)))
+            duration = time.monotonic() - start
+            if duration > self.flush_interval:
+                log.warning("sending {} analytics events took {:.3f}s".format(len(batch), duration))
+
+    def stats(self):
+        return {
+            'size': len(self._events),
+            'queued': self.queued,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+            'sent': self.sent,
+            'failed': self.failed
+        }
+
+class QueuedAnalyticsMixin(AnalyticsMixin):
+    """Sends analytics events through the `AnalyticsQueue`, so handlers
+    never wait on the analytics service, unless the `direct` backend
+    is configured"""
+
+    def track(self, toshi_id, event, data=None, *args, **kwargs):
+        queue = AnalyticsQueue.get_instance()
+        if queue is None:
+            return super().track(toshi_id, event, data, *args, **kwargs)
+        queue.put('track', encode_id(toshi_id) if toshi_id is not None else None, event, data or {})
+
+    def people_set(self, toshi_id, data, *args, **kwargs):
+        queue = AnalyticsQueue.get_instance()
+        if queue is None:
+            return super().people_set(toshi_id, data, *args, **kwargs)
+        queue.put('people_set', encode_id(toshi_id) if toshi_id is not None else None, None, data)
@@ -4,6 +4,7 @@ from toshiid import handlers_v1
 from toshiid import websocket
 from toshiid import login
 from toshiid import search_v2
+from toshiid import metrics
 from toshi.handlers import GenerateTimestamp
 import toshi.config
 
@@ -26,7 +27,61 @@ def update_config():
     elif 'apps_public_by_default' not in toshi.config.config['general']:
         toshi.config.config['general']['apps_public_by_default'] = 'false'
 
-urls = [
+    if 'PRESENCE_BACKEND' in os.environ:
+        toshi.config.config['general']['presence_backend'] = os.environ['PRESENCE_BACKEND']
+    elif 'presence_backend' not in toshi.config.config['general']:
+        toshi.config.config['general']['presence_backend'] = 'postgres'
+
+    if 'AVATAR_VERSIONS_TO_KEEP' in os.environ:
+        toshi.config.config['general']['avatar_versions_to_keep'] = os.environ['AVATAR_VERSIONS_TO_KEEP']
+    elif 'avatar_versions_to_keep' not in toshi.config.config['general']:
+        toshi.config.config['general']['avatar_versions_to_keep'] = '2'
+
+    if 'IMAGE_CACHE_SIZE' in os.environ:
+        toshi.config.config['general']['image_cache_size'] = os.environ['IMAGE_CACHE_SIZE']
+
+    if 'MAX_UPLOAD_SIZE' in os.environ:
+        toshi.config.config['general']['max_upload_size'] = os.environ['MAX_UPLOAD_SIZE']
+
+    if 'AVATAR_MAX_PIXELS' in os.environ:
+        toshi.config.config['general']['avatar_max_pixels'] = os.environ['AVATAR_MAX_PIXELS']
+
+    if 'IMAGE_WORKERS' in os.environ:
+        toshi.config.config['general']['image_workers'] = os.environ['IMAGE_WORKERS']
+
+    if 'IMAGE_QUEUE_SIZE' in os.environ:
+        toshi.config.config['general']['image_queue_size'] = os.environ['IMAGE_QUEUE_SIZE']
+
+    if 'REDIS_REQUEST_POOL_SIZE' in os.environ:
+        toshi.config.config['general']['redis_request_pool_size'] = os.environ['REDIS_REQUEST_POOL_SIZE']
+    if 'REDIS_BLOCKING_POOL_SIZE' in os.environ:
+        toshi.config.config['general']['redis_blocking_pool_size'] = os.environ['REDIS_BLOCKING_POOL_SIZE']
+
+    for key in ['ANALYTICS_BACKEND', 'ANALYTICS_TARGET', 'ANALYTICS_QUEUE_SIZE',
+                'ANALYTICS_BATCH_SIZE', 'ANALYTICS_FLUSH_INTERVAL', 'ANALYTICS_SAMPLE_RATES']:
+        if key in os.environ:
+            toshi.config.config['general'][key.lower()] = os.environ[key]
+
+    if 'SLOW_QUERY_THRESHOLD' in os.environ:
+        toshi.config.config['general']['slow_query_threshold'] = os.environ['SLOW_QUERY_THRESHOLD']
+    if 'SLOW_QUERY_EXPLAIN_RATE' in os.environ:
+        toshi.config.config['general']['slow_query_explain_rate'] = os.environ['SLOW_QUERY_EXPLAIN_RATE']
+
+    if 'METRICS_TOKEN' in os.environ:
+        toshi.config.config['general']['metrics_token'] = os.environ['METRICS_TOKEN']
+    elif 'DYNO' in os.environ and 'metrics_require_token' not in toshi.config.config['general']:
+        # the public app's metrics are only served with a token
+        toshi.config.config['general']['metrics_require_token'] = 'true'
+
+    if 'RATE_LIMITS' in os.environ:
+        toshi.config.config['general']['rate_limits'] = os.environ['RATE_LIMITS']
+    if 'TRUSTED_PROXIES' in os.environ:
+        toshi.config.config['general']['trusted_proxies'] = os.environ['TRUSTED_PROXIES']
+    elif 'DYNO' in os.environ and 'trusted_proxies' not in toshi.config.config['general']:
+        # running on heroku, behind its router
+        toshi.config.config['general']['trusted_proxies'] = '1'
+
+urls = metrics.instrument_urls([
 
     # #### VERSION 1 #### #
 
@@ -67,7 +122,10 @@ urls = [
     (r"^/v2/user/(?P<username>[^/]+)/?$", handlers_v1.UserHandler, {'api_version': 2}),
     (r"^/v2/search/?$", search_v2.SearchHandler),
 
-]
+    # prometheus metrics
+    (r"^/metrics/?$", metrics.MetricsHandler),
+
+])
 
 def main():
     update_config()
@@ -0,0 +1,27 @@
+"""Avatar storage constants and keys, shared by the handlers and the
+background processes without pulling in the rest of the handler stack"""
+
+AVATAR_URL_HASH_LENGTH = 6
+# avatars are stored at each of these sizes (when the upload is large
+# enough) so clients can pick the size they need
+AVATAR_SIZES = (64, 128, 256, 512)
+AVATAR_MAX_SIZE = AVATAR_SIZES[-1]
+AVATAR_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+def avatar_size_step(size):
+    """The smallest of `AVATAR_SIZES` that's at least `size`, or the
+    largest if `size` is bigger than all of them. Stored avatars are
+    only ever these sizes, or smaller when the upload was"""
+
+    for step in AVATAR_SIZES:
+        if step >= size:
+            return step
+    return AVATAR_MAX_SIZE
+
+def avatar_object_key(toshi_id, hash, format):
+    return "public/avatar/{}_{}.{}".format(toshi_id, hash[:AVATAR_URL_HASH_LENGTH], AVATAR_EXTENSIONS[format])
+
+def avatar_blob_key(digest, format):
+    """Uploaded avatars are stored by the sha256 of their content, so
+    identical images uploaded by different users are only stored once"""
+    return "public/avatar/blob/{}.{}".format(digest, AVATAR_EXTENSIONS[format])
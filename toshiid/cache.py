@@ -0,0 +1,200 @@
+import collections
+import time
+
+from toshi.config import config
+from toshiid.metrics import Counter, Gauge, register_collector
+
+DEFAULT_IMAGE_CACHE_SIZE = 64 * 1024 * 1024
+# entries are a few hashes per upload, so this holds thousands
+UPLOAD_CACHE_SIZE = 1024 * 1024
+# share of the cache kept for entries that have been hit more than once
+PROTECTED_RATIO = 0.8
+# rough per entry overhead (key, tuple, dict slots) on top of the data
+ENTRY_OVERHEAD = 256
+
+CACHE_REQUESTS = Counter('toshiid_cache_requests_total', "Cache lookups by cache and result", ['cache', 'result'])
+CACHE_BYTES = Gauge('toshiid_cache_bytes', "Bytes held in the cache", ['cache'])
+CACHE_ENTRIES = Gauge('toshiid_cache_entries', "Entries held in the cache", ['cache'])
+CACHE_EVICTIONS = Counter('toshiid_cache_evictions_total', "Entries evicted to make room in the cache", ['cache'])
+
+class SegmentedLRUCache:
+    """An in memory cache bounded by the total size of its values.
+
+    New entries go into a probationary segment and are moved to the
+    protected segment when they're hit again, so a burst of one off
+    lookups only pushes out other one off entries rather than the
+    popular ones. When the protected segment is full its least recently
+    used entries drop back to the probationary segment.
+
+    Entries can be given a group, so everything cached for a user can be
+    invalidated at once, and a ttl for values that can change"""
+
+    def __init__(self, name, maxbytes, *, protected_ratio=PROTECTED_RATIO):
+        self.name = name
+        self.maxbytes = maxbytes
+        self.max_protected_bytes = int(maxbytes * protected_ratio)
+        # key -> (value, size, group, expires)
+        self._probation = collections.OrderedDict()
+        self._protected = collections.OrderedDict()
+        self._groups = {}
+        self.probation_bytes = 0
+        self.protected_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._hit_metrics = CACHE_REQUESTS.labels(name, 'hit')
+        self._miss_metrics = CACHE_REQUESTS.labels(name, 'miss')
+        self._eviction_metrics = CACHE_EVICTIONS.labels(name)
+
+    def __len__(self):
+        return len(self._probation) + len(self._protected)
+
+    def __contains__(self, key):
+        return key in self._probation or key in self._protected
+
+    @property
+    def bytes(self):
+        return self.probation_bytes + self.protected_bytes
+
+    def get(self, key, default=None):
+        if key in self._protected:
+            entry = self._protected[key]
+            if entry[3] is not None and entry[3] < time.monotonic():
+                self.invalidate(key)
+            else:
+                self._protected.move_to_end(key)
+                self._hit()
+                return entry[0]
+        elif key in self._probation:
+            entry = self._probation[key]
+            if entry[3] is not None and entry[3] < time.monotonic():
+                self.invalidate(key)
+            else:
+                # promote to the protected segment
+                del self._probation[key]
+                self.probation_bytes -= entry[1]
+                self._protected[key] = entry
+                self.protected_bytes += entry[1]
+                self._demote()
+                self._hit()
+                return entry[0]
+        self.misses += 1
+        self._miss_metrics.inc()
+        return default
+
+    def _hit(self):
+        self.hits += 1
+        self._hit_metrics.inc()
+
+    def put(self, key, value, size, *, group=None, ttl=None):
+        """Adds `value`, which takes up `size` bytes, to the cache. Values
+        larger than the probationary segment are not cached"""
+
+        self.invalidate(key)
+        size += ENTRY_OVERHEAD
+        if size > self.maxbytes - self.max_protected_bytes:
+            return False
+        expires = time.monotonic() + ttl if ttl is not None else None
+        self._probation[key] = (value, size, group, expires)
+        self.probation_bytes += size
+        if group is not None:
+            self._groups.setdefault(group, set()).add(key)
+        self._evict()
+        return True
+
+    def _demote(self):
+        while self.protected_bytes > self.max_protected_bytes:
+            key, entry = self._protected.popitem(last=False)
+            self.protected_bytes -= entry[1]
+            self._probation[key] = entry
+            self.probation_bytes += entry[1]
+        self._evict()
+
+    def _evict(self):
+        while self.bytes > self.maxbytes and self._probation:
+            key, entry = self._probation.popitem(last=False)
+            self.probation_bytes -= entry[1]
+            self._remove_from_group(key, entry[2])
+            self.evictions += 1
+            self._eviction_metrics.inc()
+
+    def _remove_from_group(self, key, group):
+        if group is None:
+            return
+        keys = self._groups.get(group)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._groups[group]
+
+    def invalidate(self, key):
+        if key in self._probation:
+            entry = self._probation.pop(key)
+            self.probation_bytes -= entry[1]
+        elif key in self._protected:
+            entry = self._protected.pop(key)
+            self.protected_bytes -= entry[1]
+        else:
+            return False
+        self._remove_from_group(key, entry[2])
+        return True
+
+    def invalidate_group(self, group):
+        for key in list(self._groups.get(group, ())):
+            self.invalidate(key)
+
+    def clear(self):
+        self._probation.clear()
+        self._protected.clear()
+        self._groups.clear()
+        self.probation_bytes = 0
+        self.protected_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self),
+            'bytes': self.bytes,
+            'maxbytes': self.maxbytes,
+            'protected_bytes': self.protected_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions
+        }
+
+# an avatar or identicon response. `redirect_url` is set instead of
+# `data` for images served from the object store
+CachedImage = collections.namedtuple('CachedImage', ['data', 'content_type', 'hash', 'last_modified', 'redirect_url'])
+
+_image_cache = None
+
+def get_image_cache():
+    """Returns the cache used for avatar and identicon responses. The cache
+    is recreated (empty) if the configured size changes"""
+
+    global _image_cache
+    maxbytes = int(config['general'].get('image_cache_size', DEFAULT_IMAGE_CACHE_SIZE))
+    if _image_cache is None or _image_cache.maxbytes != maxbytes:
+        _image_cache = SegmentedLRUCache('image', maxbytes)
+    return _image_cache
+
+_upload_cache = None
+
+def get_upload_cache():
+    """Returns the cache of avatar uploads that have already been processed
+    and stored, keyed by the hash of the uploaded bytes"""
+
+    global _upload_cache
+    if _upload_cache is None:
+        _upload_cache = SegmentedLRUCache('avatar_upload', UPLOAD_CACHE_SIZE)
+    return _upload_cache
+
+def _collect_cache_metrics():
+    for cache in (_image_cache, _upload_cache):
+        if cache is not None:
+            CACHE_BYTES.labels(cache.name).set(cache.bytes)
+            CACHE_ENTRIES.labels(cache.name).set(len(cache))
+
+register_collector(_collect_cache_metrics)
@@ -0,0 +1,190 @@
+import asyncio
+import random
+import time
+
+import asyncpg
+import regex
+import toshi.database
+
+from toshi.config import config
+from toshi.database import get_database_pool
+from toshi.log import log
+from toshiid.metrics import Gauge, Histogram, register_collector
+
+# limit the number of distinct query shapes tracked, anything
+# past this is recorded under `other`
+MAX_QUERY_SHAPES = 200
+# raw queries that map to a shape, these can include inlined
+# values so keep a limit on them too
+MAX_CACHED_QUERIES = 5000
+MAX_SHAPE_LENGTH = 200
+
+DEFAULT_SLOW_QUERY_THRESHOLD = 1.0
+# the longest an explain is allowed to run for
+MAX_EXPLAIN_TIMEOUT = 30
+
+DB_POOL_SIZE = Gauge('toshiid_db_pool_size', "Open connections in the database pool").labels()
+DB_POOL_MAX_SIZE = Gauge('toshiid_db_pool_max_size', "Maximum connections in the database pool").labels()
+DB_POOL_IN_USE = Gauge('toshiid_db_pool_in_use', "Database pool connections in use").labels()
+DB_POOL_ACQUIRE = Histogram('toshiid_db_pool_acquire_seconds',
+                            "Time spent waiting for a database connection (including BEGIN)").labels()
+DB_QUERY = Histogram('toshiid_db_query_seconds', "Database query latency by query shape", ['query'])
+
+_STRING_RE = regex.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = regex.compile(r"(?<![\w$])\d+(?:\.\d+)?\b")
+_TUPLE_LIST_RE = regex.compile(r"\((?:\s*\?\s*,)*\s*\?\s*\)(?:\s*,\s*\((?:\s*\?\s*,)*\s*\?\s*\))+")
+_VALUE_LIST_RE = regex.compile(r"\?(?:\s*,\s*\?)+")
+_SPACE_RE = regex.compile(r"\s+")
+
+def query_shape(query):
+    """Normalizes a query so queries that only differ in inlined
+    values are grouped together"""
+
+    shape = _STRING_RE.sub("?", query)
+    shape = _NUMBER_RE.sub("?", shape)
+    shape = _TUPLE_LIST_RE.sub("(...)", shape)
+    shape = _VALUE_LIST_RE.sub("...", shape)
+    shape = _SPACE_RE.sub(" ", shape).strip()
+    if len(shape) > MAX_SHAPE_LENGTH:
+        shape = shape[:MAX_SHAPE_LENGTH - 3] + "..."
+    return shape
+
+_query_metrics = {}
+_shape_metrics = {}
+
+def query_metrics(query):
+    """Returns the histogram child for the query's shape"""
+
+    child = _query_metrics.get(query)
+    if child is not None:
+        return child
+    shape = query_shape(query)
+    child = _shape_metrics.get(shape)
+    if child is None:
+        if len(_shape_metrics) >= MAX_QUERY_SHAPES:
+            shape = 'other'
+        child = _shape_metrics[shape] = DB_QUERY.labels(shape)
+    if len(_query_metrics) < MAX_CACHED_QUERIES:
+        _query_metrics[query] = child
+    return child
+
+_explaining = False
+
+async def explain_query(query, args, timeout):
+    """Logs the plan of a slow query. The query is run again on its own
+    connection so it doesn't hold up the request, and rolled back"""
+
+    global _explaining
+    _explaining = True
+    try:
+        con = await asyncpg.connect(config['database']['dsn'])
+        try:
+            transaction = con.transaction()
+            await transaction.start()
+            try:
+                # a timeout of 0 would disable it, so never go below 1ms
+                await con.execute("SELECT set_config('statement_timeout', $1, true)",
+                                  str(max(1, int(timeout * 1000))))
+                rows = await con.fetch("EXPLAIN (ANALYZE, BUFFERS) {}".format(query), *args)
+            finally:
+                await transaction.rollback()
+        finally:
+            await con.close()
+        log.warning("plan for slow query: {}\n{}".format(
+            query_shape(query), "\n".join(row[0] for row in rows)))
+    except:
+        log.exception("error explaining slow query: {}".format(query_shape(query)))
+    finally:
+        _explaining = False
+
+def log_slow_query(query, args, duration, explain_rate):
+    log.warning("slow query ({:.3f}s): {} params: ({})".format(
+        duration, query_shape(query), ", ".join(type(arg).__name__ for arg in args)))
+    # only explain one query at a time, and only queries that
+    # are safe to run again
+    if (explain_rate > 0 and not _explaining and random.random() < explain_rate and
+            query.lstrip()[:6].upper() == 'SELECT'):
+        asyncio.get_event_loop().create_task(
+            explain_query(query, args, min(MAX_EXPLAIN_TIMEOUT, duration * 10)))
+
+class InstrumentedDatabase:
+    """Wraps the handler's database context, recording how long it takes
+    to get a connection and how long each query takes. If `slow_query_log`
+    is set, queries slower than the configured threshold are logged along
+    with (for a sample of them) their query plan"""
+
+    def __init__(self, context, slow_query_log=False):
+        self._context = context
+        if slow_query_log:
+            self._slow_query_threshold = float(config['general'].get(
+                'slow_query_threshold', DEFAULT_SLOW_QUERY_THRESHOLD))
+            self._explain_rate = float(config['general'].get('slow_query_explain_rate', 0))
+        else:
+            self._slow_query_threshold = None
+
+    async def __aenter__(self):
+        start = time.monotonic()
+        rval = await self._context.__aenter__()
+        DB_POOL_ACQUIRE.observe(time.monotonic() - start)
+        return self if rval is self._context else rval
+
+    def __aexit__(self, exc_type, exc, tb):
+        return self._context.__aexit__(exc_type, exc, tb)
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    async def _run(self, method, query, args, kwargs):
+        start = time.monotonic()
+        try:
+            return await method(query, *args, **kwargs)
+        finally:
+            duration = time.monotonic() - start
+            query_metrics(query).observe(duration)
+            if self._slow_query_threshold is not None and duration >= self._slow_query_threshold:
+                log_slow_query(query, args, duration, self._explain_rate)
+
+    def fetch(self, query, *args, **kwargs):
+        return self._run(self._context.fetch, query, args, kwargs)
+
+    def fetchrow(self, query, *args, **kwargs):
+        return self._run(self._context.fetchrow, query, args, kwargs)
+
+    def fetchval(self, query, *args, **kwargs):
+        return self._run(self._context.fetchval, query, args, kwargs)
+
+    def execute(self, query, *args, **kwargs):
+        return self._run(self._context.execute, query, args, kwargs)
+
+    def executemany(self, query, *args, **kwargs):
+        return self._run(self._context.executemany, query, args, kwargs)
+
+class DatabaseMixin(toshi.database.DatabaseMixin):
+    """`toshi.database.DatabaseMixin` with metrics. Handlers can set
+    `slow_query_log` to log their slow queries"""
+
+    slow_query_log = False
+
+    @property
+    def db(self):
+        db = self.__dict__.get('_instrumented_db')
+        if db is None:
+            db = self._instrumented_db = InstrumentedDatabase(super().db, self.slow_query_log)
+        return db
+
+def _collect_pool_metrics():
+    try:
+        pool = get_database_pool()
+    except Exception:
+        return
+    if pool is None:
+        return
+    # asyncpg doesn't expose these, so be careful with its internals
+    holders = getattr(pool, '_holders', None) or []
+    queue = getattr(pool, '_queue', None)
+    DB_POOL_MAX_SIZE.set(getattr(pool, '_maxsize', len(holders)))
+    DB_POOL_SIZE.set(sum(1 for holder in holders if getattr(holder, '_con', None) is not None))
+    if queue is not None:
+        DB_POOL_IN_USE.set(len(holders) - queue.qsize())
+
+register_collector(_collect_pool_metrics)
@@ -10,7 +10,7 @@ import string
 import datetime
 import hashlib
 
-from toshi.database import DatabaseMixin
+from toshiid.database import DatabaseMixin
 from toshi.boto import BotoMixin
 from toshi.errors import JSONHTTPError
 from toshi.config import config
@@ -19,13 +19,24 @@ from decimal import Decimal
 from toshi.handlers import (BaseHandler,
                             RequestVerificationMixin,
                             SimpleFileHandler)
-from toshi.analytics import AnalyticsMixin, encode_id as analytics_encode_id
-from tornado.web import HTTPError
+from toshi.analytics import encode_id as analytics_encode_id
+from tornado.web import HTTPError, stream_request_body
 from toshi.utils import validate_address, validate_decimal_string, validate_int_string, parse_int
 from PIL import Image, ExifTags
 from PIL.JpegImagePlugin import get_sampling
 
 from toshiid.handlers_v2 import user_row_for_json as user_row_for_json_v2
+from toshiid.presence import get_presence_store
+from toshiid.subscriptions import notify_user_updated
+from toshiid.analytics import QueuedAnalyticsMixin
+from toshiid.ratelimit import RateLimitMixin
+from toshiid.cache import get_image_cache, get_upload_cache, CachedImage
+from toshiid.image_pool import ImagePool, ImagePoolBusy
+from toshiid.uploads import StreamingUploadMixin
+from toshiid.metrics import Counter
+from toshiid.avatars import (AVATAR_URL_HASH_LENGTH, AVATAR_SIZES, AVATAR_MAX_SIZE,
+                             avatar_size_step, avatar_blob_key)
+from toshiid import identicon
 
 assert ExifTags.TAGS[0x0112] == "Orientation"
 EXIF_ORIENTATION = 0x0112
@@ -35,7 +46,25 @@ PUNCTUATION = string.punctuation.replace('_', '')
 
 MIN_AUTOID_LENGTH = 5
 
-AVATAR_URL_HASH_LENGTH = 6
+AVATAR_WEBP_QUALITY = 85
+# uploads with more pixels than this are rejected before they're decoded
+AVATAR_MAX_PIXELS = 50 * 1000 * 1000
+# webp support depends on how pillow was built
+Image.init()
+WEBP_SUPPORTED = 'WEBP' in Image.SAVE
+# how long clients can cache redirects to avatars in the object store.
+# urls with a hash always point to the same image
+AVATAR_REDIRECT_MAX_AGE = 86400 * 365
+AVATAR_LATEST_REDIRECT_MAX_AGE = 300
+# how long the newest avatar for a user is cached in memory
+AVATAR_LATEST_CACHE_TTL = 60
+# identicons never change
+IDENTICON_MAX_AGE = 86400 * 365
+IDENTICON_LAST_MODIFIED = datetime.datetime(2017, 1, 1)
+# how many users can be listed for the same rate limit cost as a search
+LIST_USERS_PER_TOKEN = 100
+
+AVATAR_BLOBS = Counter('toshiid_avatar_blobs_total', "Avatar images uploaded, or already stored by another upload", ['result'])
 
 def generate_username(autoid_length):
     """Generate usernames postfixed with a random ID which is a concatenation
@@ -47,6 +76,9 @@ def generate_username(autoid_length):
 def validate_username(username):
     return regex.match('^[a-zA-Z][a-zA-Z0-9_]{2,59}$', username)
 
+def avatar_cache_group(toshi_id):
+    return ('avatar', toshi_id)
+
 def dapp_row_for_json(request, row):
     rval = {
         'name': row['name'],
@@ -115,16 +147,60 @@ def parse_boolean(b):
         return bool(b)
     return None
 
-def process_image(data, mime_type):
+def accepts_media_type(accept, media_type):
+    """Returns whether an Accept header explicitly lists the media type
+    with a q-value greater than 0. Wildcards don't count, clients send
+    `image/*` without supporting every image format"""
+
+    for entry in accept.split(','):
+        params = entry.split(';')
+        if params[0].strip().lower() != media_type:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0
+        if q > 0:
+            return True
+    return False
+
+class ImageProcessingError(Exception):
+    """Raised by `process_image` for uploads that can't be used. It is
+    raised in the image pool's worker processes so only carries a message"""
+    pass
+
+def encode_webp(img):
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if img.mode in ('LA', 'P') or 'transparency' in img.info else 'RGB')
+    stream = io.BytesIO()
+    img.save(stream, format='WEBP', quality=AVATAR_WEBP_QUALITY)
+    return stream.getbuffer().tobytes()
+
+def process_image(data, mime_type, max_pixels=AVATAR_MAX_PIXELS, draft=True):
+    """Returns the avatar variants for an upload. Opening the image only
+    reads its header, so the size is checked before any pixels are
+    decoded. With `draft` jpegs are decoded at the smallest scale (1/2,
+    1/4 or 1/8) that is still at least `AVATAR_MAX_SIZE`"""
+
     stream = io.BytesIO(data)
     try:
         img = Image.open(stream)
     except OSError:
-        raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid image data'}]})
+        raise ImageProcessingError('Invalid image data')
+
+    if img.size[0] * img.size[1] > max_pixels:
+        raise ImageProcessingError('Image too large')
 
     if mime_type == 'image/jpeg' and img.format == 'JPEG':
         format = "JPEG"
         subsampling = 'keep'
+        if draft:
+            # before the exif rotation, which decodes the image
+            img.draft(img.mode, (AVATAR_MAX_SIZE, AVATAR_MAX_SIZE))
         # check exif information for orientation
         if hasattr(img, '_getexif'):
             x = img._getexif()
@@ -157,27 +233,74 @@ def process_image(data, mime_type):
         format = "PNG"
         save_kwargs = {'icc_profile': img.info.get("icc_profile")}
     else:
-        raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Unsupported image format'}]})
-
-    if img.size[0] > 512 or img.size[1] > 512:
-        img.thumbnail((512, 512))
-
-    stream = io.BytesIO()
-    img.save(stream, format=format, optimize=True, **save_kwargs)
-
-    data = stream.getbuffer().tobytes()
-    hasher = hashlib.md5()
-    hasher.update(data)
-    cache_hash = hasher.hexdigest()
-
-    return data, cache_hash, format
+        raise ImageProcessingError('Unsupported image format')
+
+    if img.size[0] > AVATAR_MAX_SIZE or img.size[1] > AVATAR_MAX_SIZE:
+        img.thumbnail((AVATAR_MAX_SIZE, AVATAR_MAX_SIZE))
+
+    # the full size image followed by smaller versions from the
+    # size ladder, each resized from the one before. each size is
+    # also encoded as webp for clients that accept it
+    variants = []
+    size = max(img.size)
+    while True:
+        stream = io.BytesIO()
+        img.save(stream, format=format, optimize=True, **save_kwargs)
+
+        data = stream.getbuffer().tobytes()
+        variants.append((size, format, data, hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest()))
+        if WEBP_SUPPORTED:
+            data = encode_webp(img)
+            variants.append((size, 'WEBP', data, hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest()))
+
+        smaller = [s for s in AVATAR_SIZES if s < size]
+        if not smaller:
+            break
+        if save_kwargs.get('subsampling') == 'keep':
+            # resized copies are no longer jpegs, so pass the
+            # subsampling on explicitly
+            sampling = get_sampling(img)
+            if sampling == -1:
+                del save_kwargs['subsampling']
+            else:
+                save_kwargs['subsampling'] = sampling
+        size = smaller[-1]
+        img = img.copy()
+        img.thumbnail((size, size), Image.LANCZOS)
+
+    return variants, format
+
+def process_upload(path, offset, length, mime_type, max_pixels=AVATAR_MAX_PIXELS):
+    """As `process_image`, for an upload spooled to a file. Only the path
+    is passed to the image pool's workers, which read the image"""
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    return process_image(data, mime_type, max_pixels)
+
+def hash_upload(path, offset, length):
+    """Returns the sha256 of an upload spooled to a file"""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            chunk = f.read(min(length, 65536))
+            if not chunk:
+                break
+            digest.update(chunk)
+            length -= len(chunk)
+    return digest.hexdigest()
 
 def create_identitcon(address, format='PNG'):
     if format == 'JPG':
         format = 'JPEG'
+    if format.upper() == 'PNG':
+        return identicon.render_png(address, size=8, scale=12)
     return blockies.create(address, size=8, scale=12, format=format.upper())
 
-class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
+class UserMixin(BotoMixin, RequestVerificationMixin, QueuedAnalyticsMixin):
 
     def is_superuser(self, toshi_id):
         return 'superusers' in config and \
@@ -318,6 +441,7 @@ class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
                 await self.db.execute("UPDATE users SET active = true WHERE toshi_id = $1", toshi_id)
 
             user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
+            await notify_user_updated(self.db, toshi_id)
             await self.db.commit()
 
         self.write_user_data(user)
@@ -332,41 +456,120 @@ class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
         if user is None:
             raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
 
-        files = self.request.files.values()
-        if len(files) != 1:
+        if len(self.uploads) != 1:
             raise JSONHTTPError(404, body={'errors': [{'id': 'bad_arguments', 'message': 'Too many files'}]})
-
-        file = next(iter(files))
-        if len(file) != 1:
-            raise JSONHTTPError(404, body={'errors': [{'id': 'bad_arguments', 'message': 'Too many files'}]})
-        data = file[0]['body']
-        mime_type = file[0]['content_type']
-
-        data, cache_hash, format = await self.run_in_executor(process_image, data, mime_type)
-
-        boto_key = "public/avatar/{}_{}.{}".format(toshi_id, cache_hash[:AVATAR_URL_HASH_LENGTH], 'jpg' if format == 'JPEG' else 'png')
+        upload = self.uploads[0]
+
+        max_pixels = int(config['general'].get('avatar_max_pixels', AVATAR_MAX_PIXELS))
+        # clients on bad connections retry uploads, if these bytes have
+        # already been processed and stored skip straight to updating the user
+        raw_hash = await self.run_in_executor(hash_upload, upload.path, upload.offset, upload.length)
+        upload_key = (raw_hash, upload.content_type, max_pixels)
+        upload_cache = get_upload_cache()
+        stored = upload_cache.get(upload_key)
+        if stored is not None:
+            # housekeeping removes blobs that are no longer used, if
+            # any of these are gone the upload has to be stored again
+            digests = {digest for _, _, _, digest, _ in stored}
+            if await self.touch_avatar_blobs(digests) != digests:
+                stored = None
+        if stored is None:
+            try:
+                variants, format = await ImagePool.get_instance().run(
+                    process_upload, upload.path, upload.offset, upload.length, upload.content_type, max_pixels)
+            except ImageProcessingError as e:
+                raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': str(e)}]})
+            except ImagePoolBusy:
+                raise JSONHTTPError(503, body={'errors': [{'id': 'busy', 'message': 'Too many avatar uploads, try again later'}]})
+            stored = await self.store_avatar_variants(variants)
+
+        # the user's avatar url is the full size image
+        source_hash = stored[0][2]
+        keys = [avatar_blob_key(digest, variant_format) for _, variant_format, _, digest, _ in stored]
         async with self.boto:
-            await self.boto.put_object(key=boto_key, body=data)
-            avatar_url = self.boto.url_for_object(boto_key)
+            avatar_url = self.boto.url_for_object(keys[0])
 
         async with self.db:
             await self.db.execute("UPDATE users SET avatar = $1 WHERE toshi_id = $2", avatar_url, toshi_id)
+            # record the variants so /avatar/ can pick the right size and
+            # format, each referencing the blob holding the image
+            for key, (size, variant_format, cache_hash, digest, length) in zip(keys, stored):
+                await self.db.execute("INSERT INTO avatar_blobs (hash, format, bytes, object_key) "
+                                      "VALUES ($1, $2, $3, $4) ON CONFLICT (hash) DO NOTHING",
+                                      digest, variant_format, length, key)
+                await self.db.execute("INSERT INTO avatars (toshi_id, hash, format, size, source_hash, object_key, blob_hash) "
+                                      "VALUES ($1, $2, $3, $4, $5, $6, $7) "
+                                      "ON CONFLICT (toshi_id, hash) DO UPDATE "
+                                      "SET format = EXCLUDED.format, size = EXCLUDED.size, source_hash = EXCLUDED.source_hash, "
+                                      "object_key = EXCLUDED.object_key, blob_hash = EXCLUDED.blob_hash, "
+                                      "last_modified = (now() AT TIME ZONE 'utc')",
+                                      toshi_id, cache_hash, variant_format, size, source_hash, key, digest)
             user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
+            await notify_user_updated(self.db, toshi_id)
             await self.db.commit()
+        get_image_cache().invalidate_group(avatar_cache_group(toshi_id))
+        # only once the blobs are recorded
+        upload_cache.put(upload_key, stored, sum(len(cache_hash) + len(digest) for _, _, cache_hash, digest, _ in stored))
 
         self.write_user_data(user)
 
         self.track(toshi_id, "Updated avatar")
 
+    async def touch_avatar_blobs(self, digests):
+        """Marks the blobs with the given digests as used, which keeps
+        housekeeping from removing them until the avatars referencing
+        them have been recorded. Returns the digests of the blobs that
+        are stored"""
+
+        async with self.db:
+            rows = await self.db.fetch("UPDATE avatar_blobs SET last_used = (now() AT TIME ZONE 'utc') "
+                                       "WHERE hash = ANY($1) RETURNING hash", list(digests))
+            await self.db.commit()
+        return {row['hash'] for row in rows}
+
+    async def store_avatar_variants(self, variants):
+        """Uploads the variants from `process_image` that aren't already
+        stored as blobs. Returns `(size, format, hash, digest, bytes)` for
+        each of them, without the image data"""
+
+        stored = await self.touch_avatar_blobs([digest for _, _, _, _, digest in variants])
+        uploads = [(avatar_blob_key(digest, variant_format), data)
+                   for _, variant_format, data, _, digest in variants if digest not in stored]
+        AVATAR_BLOBS.labels('uploaded').inc(len(uploads))
+        AVATAR_BLOBS.labels('deduplicated').inc(len(variants) - len(uploads))
+
+        async with self.boto:
+            await asyncio.gather(*[self.boto.put_object(key=key, body=data) for key, data in uploads])
+
+        return [(size, variant_format, cache_hash, digest, len(data))
+                for size, variant_format, data, cache_hash, digest in variants]
+
+
+@stream_request_body
+class UserCreationHandler(StreamingUploadMixin, RateLimitMixin, UserMixin, DatabaseMixin, BaseHandler):
 
-class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
+    # only limit updates, which include avatar uploads
+    rate_limit_route = 'user_update'
+    rate_limit_methods = ('PUT',)
 
     def __init__(self, *args, api_version=1, **kwargs):
         super().__init__(*args, **kwargs)
         self.api_version = api_version
 
+    async def prepare_upload(self):
+        # uploads without a current signature, or for users that don't
+        # exist, are rejected before they're read
+        toshi_id, _, _ = self.check_signature_headers()
+        if self.is_superuser(toshi_id):
+            return
+        async with self.db:
+            exists = await self.db.fetchval("SELECT 1 FROM users WHERE toshi_id = $1", toshi_id)
+        if not exists:
+            raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
+
     async def post(self):
 
+        self.read_body()
         toshi_id = self.verify_request()
         payload = self.json
 
@@ -486,9 +689,10 @@ class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
         self.track(toshi_id, "Created account")
 
     def put(self):
+        self.read_body()
         toshi_id = self.verify_request()
 
-        if not self.request.headers['Content-Type'].startswith('application/json') and not self.request.files:
+        if not self.request.headers['Content-Type'].startswith('application/json') and not self.uploads:
             raise JSONHTTPError(400, body={'errors': [{'id': 'bad_data', 'message': 'Expected application/json or multipart/form-data'}]})
 
         # check for superuser update
@@ -501,12 +705,15 @@ class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
 
             toshi_id = specific_toshi_id
 
-        if self.request.files:
+        if self.uploads:
             return self.update_user_avatar(toshi_id)
         else:
             return self.update_user(toshi_id)
 
-class UserHandler(UserMixin, DatabaseMixin, BaseHandler):
+@stream_request_body
+class UserHandler(StreamingUploadMixin, UserMixin, DatabaseMixin, BaseHandler):
+
+    slow_query_log = True
 
     def __init__(self, *args, apps_only=None, api_version=1, **kwargs):
         super().__init__(*args, **kwargs)
@@ -552,7 +759,7 @@ class UserHandler(UserMixin, DatabaseMixin, BaseHandler):
 
         self.write_user_data(row)
 
-    async def put(self, username):
+    async def get_address_to_update(self, username):
 
         if regex.match('^0x[a-fA-F0-9]{40}$', username):
 
@@ -571,9 +778,23 @@ class UserHandler(UserMixin, DatabaseMixin, BaseHandler):
 
             raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_username', 'message': 'Invalid Username'}]})
 
+        return address_to_update
+
+    async def prepare_upload(self):
+        # check the signature is current, the user exists and the sender
+        # can update them before reading the upload
+        request_address, _, _ = self.check_signature_headers()
+        address_to_update = await self.get_address_to_update(self.path_kwargs['username'])
+        if request_address != address_to_update and not self.is_superuser(request_address):
+            raise JSONHTTPError(401, body={'errors': [{'id': 'permission_denied', 'message': 'Permission Denied'}]})
+
+    async def put(self, username):
+
+        self.read_body()
+        address_to_update = await self.get_address_to_update(username)
         request_address = self.verify_request()
 
-        if not self.request.headers['Content-Type'].startswith('application/json') and not self.request.files:
+        if not self.request.headers['Content-Type'].startswith('application/json') and not self.uploads:
             raise JSONHTTPError(400, body={'errors': [{'id': 'bad_data', 'message': 'Expected application/json or multipart/form-data'}]})
 
         if request_address != address_to_update:
@@ -582,13 +803,20 @@ class UserHandler(UserMixin, DatabaseMixin, BaseHandler):
             if not self.is_superuser(request_address):
                 raise JSONHTTPError(401, body={'errors': [{'id': 'permission_denied', 'message': 'Permission Denied'}]})
 
-        if self.request.files:
+        if self.uploads:
             return await self.update_user_avatar(address_to_update)
         else:
             return await self.update_user(address_to_update)
 
 
-class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
+class SearchUserHandler(RateLimitMixin, QueuedAnalyticsMixin, DatabaseMixin, BaseHandler):
+
+    rate_limit_route = 'search'
+    slow_query_log = True
+
+    def rate_limit_cost(self):
+        # listing lots of users costs more than a single search
+        return 1 + len(self.get_query_arguments('toshi_id')) // LIST_USERS_PER_TOKEN
 
     def __init__(self, *args, force_featured=None, force_apps=None, **kwargs):
         super().__init__(*args, **kwargs)
@@ -663,6 +891,17 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
         else:
             check_connected = False
 
+        # the postgres presence store is filtered by joining against the
+        # websocket_sessions table, other stores give us the connected ids
+        join_sessions = False
+        connected_toshi_ids = None
+        if check_connected:
+            presence = get_presence_store()
+            if presence.name == 'postgres':
+                join_sessions = True
+            else:
+                connected_toshi_ids = await presence.connected_toshi_ids()
+
         if query is None:
             sql = ("SELECT users.*, array_agg(bot_categories.category_id) AS category_ids, "
                    "array_agg(categories.tag) AS category_tags, "
@@ -673,11 +912,14 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
                    "AND category_names.language = $1 "
                    "LEFT JOIN categories ON bot_categories.category_id = categories.category_id ")
             sql_args = ['en']
-            if check_connected:
+            if join_sessions:
                 sql += "INNER JOIN websocket_sessions ON users.toshi_id = websocket_sessions.toshi_id "
             if payment_address:
                 sql += "WHERE active = true AND payment_address = ${} ".format(len(sql_args) + 1)
                 sql_args.append(payment_address)
+                if connected_toshi_ids is not None:
+                    sql += "AND users.toshi_id = ANY(${}) ".format(len(sql_args) + 1)
+                    sql_args.append(connected_toshi_ids)
                 if apps is not None:
                     sql += "AND is_bot = ${} AND blocked = false ".format(len(sql_args) + 1)
                     sql_args.append(apps)
@@ -708,6 +950,9 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
                     if apps is None or apps is False:
                         sql += "AND is_bot = FALSE "
                 sql += "AND active = true "
+                if connected_toshi_ids is not None:
+                    sql += "AND users.toshi_id = ANY(${}) ".format(len(sql_args) + 1)
+                    sql_args.append(connected_toshi_ids)
                 sql += "GROUP BY users.toshi_id "
                 if apps is not None and len(categories) > 0:
                     sql += "HAVING array_agg(bot_categories.category_id) @> ${} ".format(len(sql_args) + 1)
@@ -763,6 +1008,9 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
                 where_q.append("is_public = ${}".format(len(sql_args) + 1))
                 sql_args.append(public)
             where_q.append("active = true")
+            if connected_toshi_ids is not None:
+                where_q.append("users.toshi_id = ANY(${})".format(len(sql_args) + 1))
+                sql_args.append(connected_toshi_ids)
             where_q = " AND {}".format(" AND ".join(where_q)) if where_q else ""
             sql = ("SELECT * FROM "
                    "(SELECT users.*, array_agg(bot_categories.category_id) AS category_ids, "
@@ -777,7 +1025,7 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
                    "WHERE (tsv @@ q){} "
                    "GROUP BY users.toshi_id ").format(
                        "INNER JOIN websocket_sessions ON users.toshi_id = websocket_sessions.toshi_id "
-                       if check_connected else "",
+                       if join_sessions else "",
                        where_q)
             if apps is not None and len(categories) > 0:
                 sql += "HAVING array_agg(bot_categories.category_id) @> ${} ".format(len(sql_args) + 1)
@@ -860,7 +1108,7 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
             'results': [user_row_for_json(self.request, row) for row in rows]
         })
 
-class SearchDappHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
+class SearchDappHandler(QueuedAnalyticsMixin, DatabaseMixin, BaseHandler):
 
     async def get(self):
 
@@ -872,7 +1120,10 @@ class SearchDappHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
         })
 
 
-class IdenticonHandler(DatabaseMixin, SimpleFileHandler):
+class IdenticonHandler(SimpleFileHandler):
+    """Identicons only depend on the address and format, so they are
+    rendered on demand and kept in the image cache rather than stored,
+    and clients and CDNs can cache them forever"""
 
     FORMAT_MAP = {
         'PNG': 'image/png',
@@ -890,31 +1141,30 @@ class IdenticonHandler(DatabaseMixin, SimpleFileHandler):
         if format not in self.FORMAT_MAP.keys():
             raise HTTPError(404)
 
-        identicon_pkey = "{}_identicon_{}".format(address, format)
-        async with self.db:
-            # add suffix to id for cached identicons
-            row = await self.db.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1", identicon_pkey)
+        cache = get_image_cache()
+        cache_key = ('identicon', address, format)
+        image = cache.get(cache_key)
+        if image is None:
+            data = await self.run_in_executor(create_identitcon, address, format)
+            image = CachedImage(data, self.FORMAT_MAP[format], hashlib.md5(data).hexdigest(), IDENTICON_LAST_MODIFIED, None)
+            cache.put(cache_key, image, len(data))
 
-        if row is None:
-            data = blockies.create(address, size=8, scale=12, format=format.upper())
-            hasher = hashlib.md5()
-            hasher.update(data)
-            cache_hash = hasher.hexdigest()
-            async with self.db:
-                await self.db.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4) "
-                                      "ON CONFLICT (toshi_id, hash) DO UPDATE "
-                                      "SET img = EXCLUDED.img, format = EXCLUDED.format, last_modified = (now() AT TIME ZONE 'utc')",
-                                      identicon_pkey, data, cache_hash, format)
-                await self.db.commit()
-            last_modified = datetime.datetime.utcnow()
-        else:
-            data = row['img']
-            cache_hash = row['hash']
-            last_modified = row['last_modified']
+        self.set_header('Cache-Control', 'public, max-age={}, immutable'.format(IDENTICON_MAX_AGE))
+        await self.handle_file_response(image.data, image.content_type, image.hash, image.last_modified)
+
+class AvatarHandler(BotoMixin, DatabaseMixin, SimpleFileHandler):
+    """Serves avatars stored in the database. Avatars that have been copied
+    to the object store (see `toshiid.migrate_avatars`) are redirected
+    to instead, without reading the image from the database.
 
-        await self.handle_file_response(data, self.FORMAT_MAP[format], cache_hash, last_modified)
+    The `size` query argument picks the smallest stored version of the
+    avatar that's at least that many pixels wide, or the largest if none
+    are big enough. Clients that accept webp are sent the webp version
+    of the avatar when there is one, whatever the url's extension"""
 
-class AvatarHandler(DatabaseMixin, SimpleFileHandler):
+    # only read the image if it's going to be served from here
+    COLUMNS = ("toshi_id, hash, format, last_modified, size, source_hash, object_key, "
+               "CASE WHEN object_key IS NULL THEN img END AS img")
 
     def head(self, address, hash, format):
         return self.get(address, hash, format, include_body=False)
@@ -927,24 +1177,86 @@ class AvatarHandler(DatabaseMixin, SimpleFileHandler):
         if format == 'JPG':
             format = 'JPEG'
 
+        size = self.get_query_argument('size', None)
+        if size is not None:
+            size = parse_int(size)
+            if size is None or size <= 0:
+                raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid size'}]})
+            # picks the same avatar as the exact size, without a cache
+            # entry and query for every size that could be asked for
+            size = avatar_size_step(size)
+
+        webp = accepts_media_type(self.request.headers.get('Accept', ''), 'image/webp')
+        # the response depends on the accept header
+        self.set_header('Vary', 'Accept')
+
+        cache = get_image_cache()
+        cache_key = ('avatar', address, format, hash, size, webp)
+        image = cache.get(cache_key)
+        if image is None:
+            image = await self.fetch_avatar(address, hash, format, size, webp)
+            if image is None:
+                raise HTTPError(404)
+            cache.put(cache_key, image, len(image.data) if image.data is not None else len(image.redirect_url),
+                      group=avatar_cache_group(address),
+                      # the newest avatar can change, and other processes
+                      # can't invalidate our cache
+                      ttl=AVATAR_LATEST_CACHE_TTL if hash is None else None)
+
+        if image.redirect_url is not None:
+            if hash is None:
+                # the newest avatar can change at any time
+                self.set_header('Cache-Control', 'public, max-age={}'.format(AVATAR_LATEST_REDIRECT_MAX_AGE))
+                self.redirect(image.redirect_url, permanent=False)
+            else:
+                self.set_header('Cache-Control', 'public, max-age={}'.format(AVATAR_REDIRECT_MAX_AGE))
+                self.redirect(image.redirect_url, permanent=True)
+            return
+
+        await self.handle_file_response(image.data, image.content_type, image.hash, image.last_modified)
+
+    async def fetch_avatar(self, address, hash, format, size=None, webp=False):
+
         async with self.db:
             if hash is None:
-                row = await self.db.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1 AND format = $2 ORDER BY last_modified DESC",
+                # all the sizes of an avatar share the same last modified
+                # time, the full size one is the largest
+                row = await self.db.fetchrow("SELECT {} FROM avatars WHERE toshi_id = $1 AND format = $2 "
+                                             "ORDER BY last_modified DESC, size DESC NULLS FIRST"
+                                             .format(self.COLUMNS),
                                              address, format)
             else:
                 row = await self.db.fetchrow(
-                    "SELECT * FROM avatars WHERE toshi_id = $1 AND format = $2 AND substring(hash for {}) = $3"
-                    .format(AVATAR_URL_HASH_LENGTH),
+                    "SELECT {} FROM avatars WHERE toshi_id = $1 AND format = $2 AND substring(hash for {}) = $3"
+                    .format(self.COLUMNS, AVATAR_URL_HASH_LENGTH),
                     address, format, hash)
 
-        if row is None or row['format'] != format:
-            raise HTTPError(404)
+            if row is None or row['format'] != format:
+                return None
+
+            if (size is not None or webp) and row['source_hash'] is not None:
+                # prefer webp if it's accepted, then the closest size
+                variant = await self.db.fetchrow(
+                    "SELECT {} FROM avatars WHERE toshi_id = $1 AND source_hash = $2 AND format IN ($3, $4) "
+                    "ORDER BY format = $4 DESC, size >= $5 DESC, CASE WHEN size >= $5 THEN size ELSE -size END LIMIT 1"
+                    .format(self.COLUMNS),
+                    address, row['source_hash'], format, 'WEBP' if webp else format,
+                    size if size is not None else row['size'])
+                if variant is not None:
+                    row = variant
 
-        await self.handle_file_response(row['img'], "image/{}".format(format.lower()),
-                                        row['hash'], row['last_modified'])
+        content_type = "image/{}".format(row['format'].lower())
+        if row['object_key'] is not None:
+            async with self.boto:
+                url = self.boto.url_for_object(row['object_key'])
+            return CachedImage(None, content_type, row['hash'], row['last_modified'], url)
+        return CachedImage(row['img'], content_type, row['hash'], row['last_modified'], None)
 
 
-class ReportHandler(RequestVerificationMixin, AnalyticsMixin, DatabaseMixin, BaseHandler):
+class ReportHandler(RateLimitMixin, RequestVerificationMixin, QueuedAnalyticsMixin, DatabaseMixin, BaseHandler):
+
+    rate_limit_route = 'report'
+    rate_limit_methods = ('POST',)
 
     async def post(self):
 
@@ -976,24 +1288,27 @@ class ReportHandler(RequestVerificationMixin, AnalyticsMixin, DatabaseMixin, Bas
         self.track(reporter_toshi_id, "Made report")
         self.track(reportee_toshi_id, "Was reported")
 
+async def fetch_categories(db, language='en'):
+    return await db.fetch("SELECT * FROM categories "
+                          "JOIN category_names ON categories.category_id = category_names.category_id "
+                          "WHERE language = $1 ORDER BY categories.category_id",
+                          language)
+
+def category_row_for_json(row):
+    return {"id": row['category_id'], "tag": row['tag'], "name": row['name']}
+
 class CategoryHandler(DatabaseMixin, BaseHandler):
 
     async def get(self):
 
         async with self.db:
-            rows = await self.db.fetch("SELECT * FROM categories "
-                                       "JOIN category_names ON categories.category_id = category_names.category_id "
-                                       "WHERE language = $1 ORDER BY categories.category_id",
-                                       'en')
+            rows = await fetch_categories(self.db)
 
         self.write({
-            "categories": [
-                {"id": row['category_id'], "tag": row['tag'], "name": row['name']}
-                for row in rows
-            ]
+            "categories": [category_row_for_json(row) for row in rows]
         })
 
-class ReputationUpdateHandler(RequestVerificationMixin, AnalyticsMixin, DatabaseMixin, BaseHandler):
+class ReputationUpdateHandler(RequestVerificationMixin, QueuedAnalyticsMixin, DatabaseMixin, BaseHandler):
 
     async def post(self):
 
@@ -1035,6 +1350,7 @@ class ReputationUpdateHandler(RequestVerificationMixin, AnalyticsMixin, Database
         async with self.db:
             await self.db.execute("UPDATE users SET reputation_score = $1, review_count = $2, average_rating = $3 WHERE toshi_id = $4",
                                   score, count, rating, toshi_id)
+            await notify_user_updated(self.db, toshi_id)
             await self.db.commit()
 
         self.set_status(204)
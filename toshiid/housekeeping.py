@@ -1,54 +1,330 @@
 import asyncio
+import random
 
 import logging
+from toshi.boto import BotoMixin
 from toshi.log import configure_logger
 from toshi.database import prepare_database, get_database_pool
 from toshi.config import config
+from toshiid.presence import get_presence_store, PRESENCE_TTL
+from toshiid.avatars import AVATAR_URL_HASH_LENGTH
 
 DEFAULT_DELAY = 30
+# the shortest time between runs when there's a backlog to clean up
+MIN_DELAY = 1
+
+# how many sessions to delete per statement, and how many statements
+# to run before giving the table a rest until the next run
+DELETE_BATCH_SIZE = 1000
+MAX_BATCHES_PER_RUN = 50
+# pause between batches to let other queries get at the table
+BATCH_PAUSE = 0.05
+
+STATS_INTERVAL = 600
+
+# how many versions of each user's avatar (per format) to keep around
+AVATAR_VERSIONS_TO_KEEP = 2
+AVATAR_GC_INTERVAL = 3600
+AVATAR_GC_JITTER = 300
+# avatars are large, so delete fewer of them at a time and
+# give the database more of a rest between batches
+AVATAR_GC_BATCH_SIZE = 100
+AVATAR_GC_MAX_BATCHES = 20
+AVATAR_GC_BATCH_PAUSE = 0.5
+# blobs no avatar references are only removed once no upload has used
+# them for this long, which leaves uploads that found the blob already
+# stored enough time to record the avatars referencing it
+AVATAR_BLOB_GRACE_PERIOD = 86400
 
 log = logging.getLogger("toshiid.housekeeping")
 if 'database' in config:
     config['database']['max_size'] = '1'
     config['database']['min_size'] = '1'
 
-class HousekeepingApplication:
+class HousekeepingJob:
+
+    def __init__(self, name, func, interval, *, jitter=0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.handle = None
+        self.running = False
+
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_duration = None
+        self.max_duration = 0
+        self.total_duration = 0
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'last_duration': self.last_duration,
+            'max_duration': self.max_duration,
+            'average_duration': self.total_duration / self.runs if self.runs else None
+        }
+
+class HousekeepingApplication(BotoMixin):
+    """Runs registered jobs at their own intervals. A job is a coroutine
+    function, if it returns a number that is used as the delay until its
+    next run instead of the job's interval. Jobs never overlap with
+    themselves, and a failing job doesn't affect the others.
 
-    def __init__(self, *, delay=DEFAULT_DELAY):
-        self._schedule = None
+    The database pool is limited to a single connection, so jobs should
+    only hold on to a connection for short periods of time"""
+
+    def __init__(self, *, delay=DEFAULT_DELAY, batch_size=DELETE_BATCH_SIZE, max_batches=MAX_BATCHES_PER_RUN,
+                 avatar_versions=None):
+        self._jobs = {}
+        self._running = False
         self._delay = delay
+        self._batch_size = batch_size
+        self._max_batches = max_batches
+        if avatar_versions is None:
+            avatar_versions = int(config['general'].get('avatar_versions_to_keep', AVATAR_VERSIONS_TO_KEEP))
+        self._avatar_versions = avatar_versions
+        self.avatar_bytes_reclaimed = 0
+        self.avatar_blob_bytes_reclaimed = 0
 
         configure_logger(log)
 
+        self.register_job('websocket_sessions', self.clean_websocket_sessions, delay)
+        if avatar_versions > 0:
+            self.register_job('avatar_gc', self.collect_avatar_garbage, AVATAR_GC_INTERVAL,
+                              jitter=AVATAR_GC_JITTER)
+        self.register_job('stats', self.log_stats, STATS_INTERVAL)
+
+    def register_job(self, name, func, interval, *, jitter=0):
+        if name in self._jobs:
+            raise Exception("Housekeeping job '{}' already registered".format(name))
+        job = self._jobs[name] = HousekeepingJob(name, func, interval, jitter=jitter)
+        if self._running:
+            self._schedule_job(job, 0)
+        return job
+
     def start(self):
         asyncio.get_event_loop().create_task(self._start())
 
     async def _start(self):
         await prepare_database()
-        self._schedule = asyncio.get_event_loop().call_soon(self.run_housekeeping)
+        self._running = True
+        for job in self._jobs.values():
+            self._schedule_job(job, 0)
 
     def shutdown(self):
-        if self._schedule:
-            self._schedule.cancel()
+        self._running = False
+        for job in self._jobs.values():
+            if job.handle:
+                job.handle.cancel()
+                job.handle = None
 
     def run(self):
         self.start()
         asyncio.get_event_loop().run_forever()
 
-    def schedule_housekeeping(self):
-        self._schedule = asyncio.get_event_loop().call_later(self._delay, self.run_housekeeping)
+    def stats(self):
+        return {name: job.stats() for name, job in self._jobs.items()}
+
+    def _schedule_job(self, job, delay):
+        if job.jitter and delay > 0:
+            delay += random.uniform(0, job.jitter)
+        job.handle = asyncio.get_event_loop().call_later(delay, self._run_job, job)
+
+    def _run_job(self, job):
+        job.handle = None
+        if job.running:
+            job.skipped += 1
+            self._schedule_job(job, job.interval)
+            return
+        asyncio.get_event_loop().create_task(self._execute_job(job))
+
+    async def _execute_job(self, job):
+        job.running = True
+        start = asyncio.get_event_loop().time()
+        delay = None
+        try:
+            delay = await job.func()
+        except:
+            job.failures += 1
+            log.exception("error running housekeeping job '{}'".format(job.name))
+        finally:
+            job.running = False
+            duration = asyncio.get_event_loop().time() - start
+            job.runs += 1
+            job.last_duration = duration
+            job.total_duration += duration
+            job.max_duration = max(job.max_duration, duration)
 
-    def run_housekeeping(self):
-        asyncio.get_event_loop().create_task(self.do_housekeeping())
+        if self._running:
+            self._schedule_job(job, job.interval if delay is None else delay)
 
-    async def do_housekeeping(self):
+    async def log_stats(self):
+        for name, stats in sorted(self.stats().items()):
+            log.info("Housekeeping job '{}': {} runs, {} failures, {} skipped, average {}, max {:.3f}s".format(
+                name, stats['runs'], stats['failures'], stats['skipped'],
+                "{:.3f}s".format(stats['average_duration']) if stats['runs'] else "-", stats['max_duration']))
+
+    def next_delay(self, removed, backlog):
+        """Works out how long to wait until the next run based on how
+        much there was to clean up in the last run"""
+
+        if backlog:
+            return min(MIN_DELAY, self._delay)
+        # the closer we came to the limit of a single run
+        # the sooner we check again
+        load = removed / (self._batch_size * self._max_batches)
+        return max(min(MIN_DELAY, self._delay), self._delay * (1 - load))
+
+    async def expire_websocket_sessions(self):
+        """Deletes stale websocket sessions in batches, returning the number
+        of sessions removed and whether there are still more to remove"""
+
+        removed = 0
+        deleted = 0
+        for batch in range(self._max_batches):
+            if batch > 0:
+                await asyncio.sleep(BATCH_PAUSE)
+            # only hold on to the connection for a single batch
+            async with get_database_pool().acquire() as con:
+                rval = await con.execute(
+                    "DELETE FROM websocket_sessions WHERE websocket_session_id IN ("
+                    "SELECT websocket_session_id FROM websocket_sessions "
+                    "WHERE last_seen < (now() AT TIME ZONE 'utc' - interval '{} seconds') "
+                    "ORDER BY last_seen LIMIT $1 FOR UPDATE SKIP LOCKED)".format(PRESENCE_TTL),
+                    self._batch_size)
+            deleted = int(rval.split()[-1])
+            removed += deleted
+            if deleted < self._batch_size:
+                break
+        return removed, deleted == self._batch_size
+
+    async def clean_websocket_sessions(self):
+        start = asyncio.get_event_loop().time()
+        removed, backlog = await self.expire_websocket_sessions()
+
+        presence = get_presence_store()
+        if presence.name == 'redis':
+            redis_removed = await presence.expire_sessions(limit=self._batch_size * self._max_batches)
+            removed += redis_removed
+            backlog = backlog or redis_removed == self._batch_size * self._max_batches
+
+        duration = asyncio.get_event_loop().time() - start
+        delay = self.next_delay(removed, backlog)
+        if removed > 0:
+            log.info("Housekeeping cleaned up {} stale sessions in {:.3f}s{}, next run in {:.1f}s".format(
+                removed, duration, " (backlog remaining)" if backlog else "", delay))
+        return delay
+
+    async def expire_avatar_versions(self, *, batch_size=AVATAR_GC_BATCH_SIZE, max_batches=AVATAR_GC_MAX_BATCHES):
+        """Deletes all but the newest versions of each user's avatar, per
+        format. All the sizes of an upload count as a single version.
+        Avatars still referenced by the user's avatar url are never
+        removed. Only the rows are deleted, images in the object store
+        can be shared with other users and are removed separately by
+        `expire_avatar_blobs`. Returns the number of avatars removed, the
+        number of bytes reclaimed and whether there are still more to
+        remove"""
+
+        # ranking the versions covers the whole table, so the avatars
+        # to remove are only worked out once per run
         async with get_database_pool().acquire() as con:
-            rval = await con.execute("DELETE FROM websocket_sessions "
-                                     "WHERE last_seen < (now() AT TIME ZONE 'utc' - interval '60 seconds')")
-        if rval != "DELETE 0":
-            log.info("Housekeeping cleaned up {} stale sessions".format(rval[7:]))
+            superseded = await con.fetch(
+                "SELECT versions.toshi_id, versions.hash, versions.last_modified FROM ("
+                "SELECT toshi_id, hash, last_modified, COALESCE(source_hash, hash) AS source_hash, dense_rank() OVER ("
+                "PARTITION BY toshi_id, format ORDER BY last_modified DESC NULLS LAST, COALESCE(source_hash, hash)) AS version "
+                "FROM avatars) AS versions "
+                "WHERE versions.version > $1 "
+                "AND NOT EXISTS (SELECT 1 FROM users WHERE users.toshi_id = versions.toshi_id "
+                "AND (position(versions.toshi_id || '_' || substring(versions.source_hash for {}) IN users.avatar) > 0 "
+                # uploads stored as blobs are referenced by the full size image's blob
+                "OR EXISTS (SELECT 1 FROM avatars AS source WHERE source.toshi_id = versions.toshi_id "
+                "AND source.hash = versions.source_hash AND position(source.blob_hash IN users.avatar) > 0))) "
+                "LIMIT $2".format(AVATAR_URL_HASH_LENGTH),
+                self._avatar_versions, batch_size * max_batches)
+
+        removed = 0
+        reclaimed = 0
+        for start in range(0, len(superseded), batch_size):
+            if start > 0:
+                await asyncio.sleep(AVATAR_GC_BATCH_PAUSE)
+            batch = superseded[start:start + batch_size]
+            async with get_database_pool().acquire() as con:
+                # avatars uploaded again since they were picked
+                # are the newest version again, so are skipped
+                rows = await con.fetch(
+                    "DELETE FROM avatars USING unnest($1::VARCHAR[], $2::VARCHAR[], $3::TIMESTAMP[]) "
+                    "AS superseded (toshi_id, hash, last_modified) "
+                    "WHERE avatars.toshi_id = superseded.toshi_id AND avatars.hash = superseded.hash "
+                    "AND avatars.last_modified IS NOT DISTINCT FROM superseded.last_modified "
+                    "RETURNING COALESCE(octet_length(avatars.img), 0) AS size",
+                    [row['toshi_id'] for row in batch], [row['hash'] for row in batch],
+                    [row['last_modified'] for row in batch])
+            removed += len(rows)
+            reclaimed += sum(row['size'] for row in rows)
+        return removed, reclaimed, len(superseded) == batch_size * max_batches
+
+    async def expire_avatar_blobs(self, *, batch_size=AVATAR_GC_BATCH_SIZE, max_batches=AVATAR_GC_MAX_BATCHES):
+        """Deletes blobs that no avatar references and that haven't been
+        used by an upload within the grace period, from the object store
+        and from `avatar_blobs`. Returns the number of blobs removed, the
+        number of bytes reclaimed and whether there are still more to
+        remove"""
+
+        removed = 0
+        reclaimed = 0
+        deleted = 0
+        for batch in range(max_batches):
+            if batch > 0:
+                await asyncio.sleep(AVATAR_GC_BATCH_PAUSE)
+            async with get_database_pool().acquire() as con:
+                # the rows stay locked until their objects are deleted, so
+                # an upload using one of the blobs meanwhile waits for this
+                # and then finds it gone, and uploads the image again. if
+                # deleting the objects fails the rows are kept
+                async with con.transaction():
+                    rows = await con.fetch(
+                        "DELETE FROM avatar_blobs WHERE hash IN ("
+                        "SELECT hash FROM avatar_blobs "
+                        "WHERE last_used < (now() AT TIME ZONE 'utc' - interval '{} seconds') "
+                        "AND NOT EXISTS (SELECT 1 FROM avatars WHERE avatars.blob_hash = avatar_blobs.hash) "
+                        "LIMIT $1 FOR UPDATE SKIP LOCKED) "
+                        "RETURNING object_key, COALESCE(bytes, 0) AS size".format(AVATAR_BLOB_GRACE_PERIOD),
+                        batch_size)
+                    if rows:
+                        async with self.boto:
+                            await asyncio.gather(*[self.boto.delete_object(key=row['object_key']) for row in rows])
+            deleted = len(rows)
+            removed += deleted
+            reclaimed += sum(row['size'] for row in rows)
+            if deleted < batch_size:
+                break
+        return removed, reclaimed, deleted == batch_size
+
+    async def collect_avatar_garbage(self):
+        start = asyncio.get_event_loop().time()
+        removed, reclaimed, backlog = await self.expire_avatar_versions()
+        self.avatar_bytes_reclaimed += reclaimed
+        if removed > 0:
+            log.info("Housekeeping removed {} superseded avatars ({} bytes) in {:.3f}s{}".format(
+                removed, reclaimed, asyncio.get_event_loop().time() - start,
+                " (backlog remaining)" if backlog else ""))
 
-        self.schedule_housekeeping()
+        start = asyncio.get_event_loop().time()
+        removed, reclaimed, blob_backlog = await self.expire_avatar_blobs()
+        self.avatar_blob_bytes_reclaimed += reclaimed
+        if removed > 0:
+            log.info("Housekeeping removed {} unused avatar blobs ({} bytes) in {:.3f}s{}".format(
+                removed, reclaimed, asyncio.get_event_loop().time() - start,
+                " (backlog remaining)" if blob_backlog else ""))
+        if backlog or blob_backlog:
+            # carry on after a short rest rather than waiting a whole interval
+            return AVATAR_GC_INTERVAL / 60
 
 if __name__ == '__main__':
+    from toshiid.app import update_config
+    update_config()
     HousekeepingApplication().run()
@@ -0,0 +1,132 @@
+"""Renders blockies identicons as palette PNGs.
+
+Produces the same image as `blockies.create(seed, size=size, scale=scale)`
+but skips drawing into a full colour Pillow image: the pattern is turned
+into packed 2 bit rows of palette indexes, and as every cell is `scale`
+pixels high most rows are the same and only built once. The result is a
+3 colour palette PNG, which is a fraction of the size of the RGB one.
+"""
+import math
+import struct
+import zlib
+
+from PIL import ImageColor
+
+RANDSEED_LENGTH = 4
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def _int32(num):
+    num &= 0xffffffff
+    return num - 0x100000000 if num & 0x80000000 else num
+
+class _Random:
+    """The xorshift generator blockies uses, seeded from a string"""
+
+    def __init__(self, seed):
+        randseed = self.randseed = [0] * RANDSEED_LENGTH
+        for i, char in enumerate(seed):
+            # only the shifted value is truncated, as in blockies
+            value = randseed[i % RANDSEED_LENGTH]
+            randseed[i % RANDSEED_LENGTH] = _int32(value << 5) - value + ord(char)
+
+    def rand(self):
+        randseed = self.randseed
+        t = _int32(randseed[0] ^ (randseed[0] << 11))
+        last = _int32(randseed[3])
+        randseed[0], randseed[1], randseed[2] = randseed[1], randseed[2], randseed[3]
+        randseed[3] = last ^ (last >> 19) ^ t ^ (t >> 8)
+        # blockies divides by 2^31 rather than 2^32
+        return (randseed[3] & 0xffffffff) / 2147483648
+
+    def color(self):
+        h = math.floor(self.rand() * 360)
+        s = (self.rand() * 60) + 40
+        l = (self.rand() + self.rand() + self.rand() + self.rand()) * 25
+        r, g, b = ImageColor.getrgb("hsl({},{}%,{}%)".format(h, round(s), round(l)))
+        # lightness can go over 100%, pillow clips the colour when drawing
+        return min(max(r, 0), 255), min(max(g, 0), 255), min(max(b, 0), 255)
+
+def _pattern(random, size):
+    data_width = math.ceil(size / 2)
+    mirror_width = size - data_width
+    rows = []
+    for _ in range(size):
+        row = [math.floor(random.rand() * 2.3) for _ in range(data_width)]
+        row.extend(reversed(row[:mirror_width]))
+        rows.append(row)
+    return rows
+
+def _pixel_row(cells, previous, scale, top):
+    """Returns the palette indexes for a row of pixels. blockies draws each
+    cell one pixel too wide and too high, so the first pixel row and column
+    of a cell are covered by its neighbours above and to the left when the
+    cell itself is background. The last cell drawn wins"""
+
+    pixels = bytearray(len(cells) * scale)
+    for col, value in enumerate(cells):
+        x = col * scale
+        if value:
+            pixels[x:x + scale] = bytes((value,)) * scale
+            continue
+        if top and previous is not None and previous[col]:
+            pixels[x + 1:x + scale] = bytes((previous[col],)) * (scale - 1)
+        if col > 0:
+            # the first column, in order of which was drawn last
+            if cells[col - 1]:
+                pixels[x] = cells[col - 1]
+            elif top and previous is not None and previous[col]:
+                pixels[x] = previous[col]
+            elif top and previous is not None and previous[col - 1]:
+                pixels[x] = previous[col - 1]
+        elif top and previous is not None and previous[col]:
+            pixels[x] = previous[col]
+    return pixels
+
+# shifts each palette index into its position in a packed byte
+_SHIFT_TABLES = [bytes((value << shift) & 0xff for value in range(256)) for shift in (6, 4, 2, 0)]
+
+def _pack(pixels):
+    """Packs palette indexes into 2 bits per pixel, with the filter type
+    byte each png row starts with. Every 4th pixel is shifted into place
+    at once and the results are or'ed together as big ints"""
+
+    if len(pixels) % 4:
+        pixels = pixels + bytes(4 - len(pixels) % 4)
+    length = len(pixels) // 4
+    packed = 0
+    for offset, table in enumerate(_SHIFT_TABLES):
+        packed |= int.from_bytes(pixels[offset::4].translate(table), 'big')
+    return b'\x00' + packed.to_bytes(length, 'big')
+
+def _chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def render_png(seed, size=8, scale=12):
+    """Renders the identicon for `seed` as a palette PNG"""
+
+    random = _Random(seed)
+    # colours are taken from the generator in this order
+    color = random.color()
+    bgcolor = random.color()
+    spotcolor = random.color()
+    cells = _pattern(random, size)
+
+    rows = []
+    previous = None
+    for row in cells:
+        # the first pixel row of a cell can differ from the rest
+        rows.append(_pack(_pixel_row(row, previous, scale, True)))
+        rows.extend([_pack(_pixel_row(row, previous, scale, False))] * (scale - 1))
+        previous = row
+
+    dimension = size * scale
+    # palette indexes match the cell values
+    palette = bytes(bgcolor + color + spotcolor)
+    return b''.join([
+        PNG_SIGNATURE,
+        _chunk(b'IHDR', struct.pack(">IIBBBBB", dimension, dimension, 2, 3, 0, 0, 0)),
+        _chunk(b'PLTE', palette),
+        _chunk(b'IDAT', zlib.compress(b''.join(rows), 9)),
+        _chunk(b'IEND', b'')
+    ])
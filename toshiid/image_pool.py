@@ -0,0 +1,127 @@
+import asyncio
+import concurrent.futures
+import time
+
+from toshi.config import config
+from toshi.log import log
+from toshiid.metrics import Counter, Gauge, Histogram
+
+DEFAULT_WORKERS = 2
+# how many images can wait for a free worker before new ones are rejected
+DEFAULT_QUEUE_SIZE = 8
+
+IMAGE_POOL_PENDING = Gauge('toshiid_image_pool_pending', "Images being processed or waiting for a worker").labels()
+IMAGE_POOL_REJECTED = Counter('toshiid_image_pool_rejected_total', "Images rejected because the queue was full").labels()
+IMAGE_POOL_WAIT = Histogram('toshiid_image_pool_wait_seconds', "Time images spent waiting for a worker").labels()
+IMAGE_PROCESSING = Histogram('toshiid_image_processing_seconds', "Time spent processing images", ['function'])
+
+class ImagePoolBusy(Exception):
+    """The image can't be processed right now, but could be if
+    the upload was tried again later"""
+
+class ImagePoolFull(ImagePoolBusy):
+    pass
+
+class ImagePoolBroken(ImagePoolBusy):
+    pass
+
+def _timed_call(func, args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+class ImagePool:
+    """Runs image processing in a pool of worker processes, so decoding
+    and encoding doesn't hold the GIL in the web process. The number of
+    images waiting for a worker is limited, past that `run` raises
+    `ImagePoolFull` rather than letting uploads build up. If a worker
+    dies `run` raises `ImagePoolBroken` and the pool is restarted.
+
+    Arguments and results are pickled to and from the workers, so pass
+    the image data as `bytes` rather than objects holding on to it.
+
+    With 0 workers images are processed in the default thread pool,
+    with the same limit on how many can be waiting"""
+
+    _instance = None
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = None
+        self._config = None
+
+        self.pending = 0
+        self.processed = 0
+        self.rejected = 0
+
+    @staticmethod
+    def get_instance():
+        workers = int(config['general'].get('image_workers', DEFAULT_WORKERS))
+        queue_size = int(config['general'].get('image_queue_size', DEFAULT_QUEUE_SIZE))
+        instance = ImagePool._instance
+        if instance is None or instance._config != (workers, queue_size):
+            if instance is not None:
+                instance.shutdown()
+            instance = ImagePool._instance = ImagePool(workers, queue_size)
+            instance._config = (workers, queue_size)
+        return instance
+
+    @property
+    def capacity(self):
+        return max(self.workers, 1) + self.queue_size
+
+    def _get_executor(self):
+        # started on first use so the workers are forked
+        # after the application has been set up
+        if self._executor is None and self.workers > 0:
+            self._executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        return self._executor
+
+    async def run(self, func, *args):
+        """Runs `func(*args)` in a worker, `func` must be a module level
+        function so it can be pickled"""
+
+        if self.pending >= self.capacity:
+            self.rejected += 1
+            IMAGE_POOL_REJECTED.inc()
+            raise ImagePoolFull()
+
+        self.pending += 1
+        IMAGE_POOL_PENDING.inc()
+        start = time.perf_counter()
+        try:
+            executor = self._get_executor()
+            result, duration = await asyncio.get_event_loop().run_in_executor(
+                executor, _timed_call, func, args)
+        except concurrent.futures.process.BrokenProcessPool:
+            # a worker died (e.g. it was killed for using too much
+            # memory), start a new pool for the next image. every
+            # image pending in the old pool fails, only restart once
+            if self._executor is executor:
+                log.error("image processing pool is broken, restarting it")
+                executor.shutdown(wait=False)
+                self._executor = None
+            raise ImagePoolBroken()
+        finally:
+            self.pending -= 1
+            IMAGE_POOL_PENDING.dec()
+
+        self.processed += 1
+        IMAGE_PROCESSING.labels(func.__name__).observe(duration)
+        IMAGE_POOL_WAIT.observe(max(0.0, time.perf_counter() - start - duration))
+        return result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'pending': self.pending,
+            'processed': self.processed,
+            'rejected': self.rejected
+        }
@@ -0,0 +1,128 @@
+import math
+
+import tornado.ioloop
+import tornado.websocket
+
+from toshi.log import log
+
+# how many pings are sent before yielding back to the event loop
+PING_BATCH_SIZE = 500
+
+class KeepaliveScheduler:
+    """A timer wheel used to send keep alive pings to websocket
+    connections. The wheel has one slot per second of the keep alive
+    interval, connections are spread round robin over the slots and stay
+    in the same slot for their lifetime, so each connection is pinged once
+    per revolution of the wheel without needing a timer of its own.
+
+    The wheel is also used for callbacks that need to run some seconds
+    in the future (e.g. cleaning up closed sessions), again avoiding a
+    timer per connection.
+
+    There's one wheel per interval, so connections added before the
+    interval was changed are still pinged by the wheel they were added to"""
+
+    _instances = {}
+
+    def __init__(self, interval, *, io_loop=None, batch_size=PING_BATCH_SIZE):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.interval = interval
+        self.batch_size = batch_size
+        self._slots = [set() for _ in range(interval)]
+        self._deferred = [[] for _ in range(interval)]
+        self._position = 0
+        self._next_slot = 0
+        self._connections = 0
+        self._timer = None
+        self._next_tick = None
+
+    @staticmethod
+    def get_instance(interval):
+        instances = KeepaliveScheduler._instances
+        io_loop = tornado.ioloop.IOLoop.current()
+        if any(instance.io_loop is not io_loop for instance in instances.values()):
+            # the loop has changed (e.g. in tests), so the
+            # connections on the old wheels are gone
+            for instance in instances.values():
+                instance.stop()
+            instances.clear()
+        instance = instances.get(interval)
+        if instance is None:
+            instance = instances[interval] = KeepaliveScheduler(interval, io_loop=io_loop)
+        return instance
+
+    def __len__(self):
+        return self._connections
+
+    def add(self, connection):
+        """Adds the connection to the wheel. `send_ping` will be called
+        on the connection once every interval until it is removed"""
+
+        slot = (self._position + 1 + self._next_slot) % self.interval
+        self._next_slot = (self._next_slot + 1) % self.interval
+        self._slots[slot].add(connection)
+        connection._keepalive_slot = slot
+        self._connections += 1
+        self._start()
+
+    def remove(self, connection):
+        slot = getattr(connection, '_keepalive_slot', None)
+        if slot is None or connection not in self._slots[slot]:
+            return
+        self._slots[slot].discard(connection)
+        del connection._keepalive_slot
+        self._connections -= 1
+
+    def call_later(self, delay, callback):
+        """Runs the callback after roughly `delay` seconds. Delays are
+        rounded up to the next second and are limited to the interval"""
+
+        if delay <= 0:
+            self.io_loop.add_callback(callback)
+            return
+        offset = min(max(int(math.ceil(delay)), 1), self.interval)
+        self._deferred[(self._position + offset) % self.interval].append(callback)
+        self._start()
+
+    def stop(self):
+        if self._timer is not None:
+            self.io_loop.remove_timeout(self._timer)
+            self._timer = None
+
+    def _start(self):
+        if self._timer is not None:
+            return
+        self._next_tick = self.io_loop.time() + 1
+        self._timer = self.io_loop.call_at(self._next_tick, self._tick)
+
+    def _tick(self):
+        self._timer = None
+        self._position = (self._position + 1) % self.interval
+
+        deferred = self._deferred[self._position]
+        if deferred:
+            self._deferred[self._position] = []
+            for callback in deferred:
+                self.io_loop.add_callback(callback)
+
+        connections = self._slots[self._position]
+        if connections:
+            self._ping_batch(list(connections), 0)
+
+        if self._connections > 0 or any(self._deferred):
+            # schedule off the previous tick rather than now to avoid drift
+            self._next_tick = max(self._next_tick + 1, self.io_loop.time())
+            self._timer = self.io_loop.call_at(self._next_tick, self._tick)
+
+    def _ping_batch(self, connections, offset):
+        for connection in connections[offset:offset + self.batch_size]:
+            try:
+                connection.send_ping()
+            except tornado.websocket.WebSocketClosedError:
+                pass
+            except:
+                log.exception("unexpected error sending keep alive ping")
+        offset += self.batch_size
+        if offset < len(connections):
+            # yield to the event loop between batches
+            self.io_loop.add_callback(self._ping_batch, connections, offset)
@@ -1,18 +1,21 @@
 import asyncio
+import functools
+import heapq
 import os
 
-from toshi.database import DatabaseMixin
+from toshiid.database import DatabaseMixin
 from toshi.errors import JSONHTTPError
 from toshi.ethereum.utils import data_encoder
 from toshi.handlers import BaseHandler, RequestVerificationMixin
 from toshiid.handlers_v2 import user_row_for_json
-from toshi.redis import RedisMixin, get_redis_connection
+from toshiid.redis_pools import get_redis_pool, REQUEST_POOL, BLOCKING_POOL
 from toshi.log import log
 
 import string
 
 LOGIN_KEY_PREFIX = "toshi:id:login:"
 LOGIN_TOKEN_EXPIRY = 60
+LOGIN_NOTIFICATION_CHANNEL = "toshi:id:login"
 AUTH_TOKEN_REDIS_PREFIX = "toshi:auth_token:"
 AUTH_TOKEN_EXIPRY = 60
 
@@ -47,97 +50,186 @@ def b62decode(string):
     return num
 
 class LoginManager:
+    """Tracks pending login checks. Login results are pushed to a list in
+    redis (so a result posted before the check starts isn't lost) and
+    announced on a single pub/sub channel, which wakes up the waiting
+    check in whichever process has it.
+
+    Pending keys are kept in a dict of key -> deadline along with a heap
+    of deadlines, so adding, completing and expiring checks are all at
+    worst O(log n)"""
+
     _instance = None
 
     def __init__(self):
-        self._keys = []
+        self._loop = None
+        self._keys = {}
         self._futures = {}
-        self._running = False
+        self._expiry = []
+        self._expiry_handle = None
+        self._redis = None
+        self._subscription = None
         self._posted_warning = 0
 
     @staticmethod
     def create_login_check(key):
         if LoginManager._instance is None:
             LoginManager._instance = LoginManager()
+        return LoginManager._instance._create_login_check(key)
+
+    def _reset(self, loop):
+        # futures and timers are bound to the event loop, so
+        # start from scratch if it has changed (e.g. in tests)
+        if self._expiry_handle is not None:
+            self._expiry_handle.cancel()
+        self.__init__()
+        self._loop = loop
+
+    def _create_login_check(self, key):
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._reset(loop)
         key = "{}{}".format(LOGIN_KEY_PREFIX, key)
-        if key in LoginManager._instance._futures:
-            return LoginManager._instance._futures[key]
-        future = LoginManager._instance._futures[key] = asyncio.get_event_loop().create_future()
-        LoginManager._instance._keys.append(key)
-        future._time = asyncio.get_event_loop().time()
-        LoginManager._instance._start()
+        if key in self._futures:
+            return self._futures[key]
+        future = self._futures[key] = loop.create_future()
+        deadline = self._keys[key] = loop.time() + LOGIN_TOKEN_EXPIRY
+        heapq.heappush(self._expiry, (deadline, key))
+        future.add_done_callback(functools.partial(self._remove, key))
+        self._schedule_expiry()
+        self._check_size()
+        loop.create_task(self._check_new(key))
         return future
 
-    def _start(self):
-        if self._running or len(self._keys) == 0:
+    def _remove(self, key, future):
+        if self._futures.get(key) is future:
+            del self._futures[key]
+            del self._keys[key]
+            self._check_size()
+
+    def _check_size(self):
+        # I'm worried here about attacks on the login endpoint that
+        # would fill the keys list and use up all the memory on the
+        # server. This block is in place to warn and debug issues should
+        # this end up happening
+        grouping = len(self._keys) // 500
+        if grouping > self._posted_warning:
+            log.warning("Login keys list has reached {} keys".format(len(self._keys)))
+            self._posted_warning = grouping
+        elif grouping < self._posted_warning:
+            log.warning("Login keys list has returned to {} keys".format(len(self._keys)))
+            self._posted_warning = grouping
+
+    def _schedule_expiry(self):
+        if self._expiry_handle is not None or not self._expiry:
+            return
+        # every check has the same expiry time, so the head
+        # of the heap is always the next one to expire
+        self._expiry_handle = self._loop.call_at(self._expiry[0][0], self._expire)
+
+    def _expire(self):
+        self._expiry_handle = None
+        now = self._loop.time()
+        while self._expiry and self._expiry[0][0] <= now:
+            deadline, key = heapq.heappop(self._expiry)
+            # skip entries for checks that have already completed
+            if self._keys.get(key) != deadline:
+                continue
+            future = self._futures[key]
+            if not future.done():
+                future.set_exception(TimeoutError())
+        self._schedule_expiry()
+
+    async def _ensure_subscribed(self):
+        # the subscription holds on to a connection forever, so keep it
+        # (and the claims) away from the connections used by requests
+        redis = await get_redis_pool(BLOCKING_POOL).get_redis()
+        if self._redis is not redis or self._subscription is None:
+            self._redis = redis
+            self._subscription = self._loop.create_task(self._subscribe(redis))
+        subscription = self._subscription
+        try:
+            await subscription
+        except:
+            if self._subscription is subscription:
+                self._subscription = None
+            raise
+
+    async def _subscribe(self, redis):
+        channel, = await redis.subscribe(LOGIN_NOTIFICATION_CHANNEL)
+        self._loop.create_task(self._listen(redis, channel))
+
+    async def _listen(self, redis, channel):
+        try:
+            while await channel.wait_message():
+                key = await channel.get(encoding='utf-8')
+                if key in self._futures:
+                    self._loop.create_task(self._claim(key))
+        except Exception:
+            log.exception("error while listening for logins")
+        if self._redis is not redis:
             return
-        self._running = True
-        asyncio.get_event_loop().create_task(self._run())
+        self._subscription = None
+        if self._keys:
+            # we may have missed notifications while the subscription
+            # was down, so resubscribe and check everything pending
+            self._loop.call_later(1, lambda: self._loop.create_task(self._check_pending()))
+
+    async def _check_pending(self):
+        try:
+            await self._ensure_subscribed()
+            keys = list(self._keys)
+            if not keys:
+                return
+            async with get_redis_pool(BLOCKING_POOL).acquire() as redis:
+                pipe = redis.pipeline()
+                for key in keys:
+                    pipe.lpop(key, encoding='utf-8')
+                results = await pipe.execute()
+            for key, result in zip(keys, results):
+                self._set_result(key, result)
+        except:
+            log.exception("error while checking logins")
+
+    async def _check_new(self, key):
+        try:
+            # make sure we're listening for the result before checking if
+            # it's already been posted, otherwise it could be missed
+            await self._ensure_subscribed()
+            await self._claim(key)
+        except:
+            log.exception("error while checking login")
+            if key in self._keys:
+                self._loop.call_later(1, lambda: self._loop.create_task(self._check_new(key)))
+
+    async def _claim(self, key):
+        # lpop makes sure only one waiting check gets the result
+        async with get_redis_pool(BLOCKING_POOL).acquire() as redis:
+            result = await redis.lpop(key, encoding='utf-8')
+        self._set_result(key, result)
+
+    def _set_result(self, key, result):
+        if result is None:
+            return
+        future = self._futures.get(key)
+        if future is None:
+            log.warning("got result for missing login key")
+        elif not future.done():
+            future.set_result(result)
 
-    async def _run(self):
-        while len(self._keys) > 0:
-            try:
-                # I'm worried here about attacks on the login endpoint that
-                # would fill the keys list and block further login attempts
-                # and/or use up all the memory on the server. This block
-                # is in place to warn and debug issues should this end up
-                # happening
-                if len(self._keys) > 500:
-                    grouping = len(self._keys) // 500
-                    if grouping > self._posted_warning:
-                        log.warning("Login keys list has reached {} keys".format(len(self._keys)))
-                        self._posted_warning = grouping
-                    elif grouping < self._posted_warning:
-                        log.warning("Login keys list has returned to {} keys".format(len(self._keys)))
-                        self._posted_warning = grouping
-                elif self._posted_warning > 0:
-                    log.warning("Login keys list length has returned to {} keys".format(len(self._keys)))
-                    self._posted_warning = 0
-
-                allkeys = self._keys[:]
-                for offset in range(0, len(allkeys), 500):
-                    keys = allkeys[offset:offset + 500]
-                    if len(keys) == 0:
-                        continue
-                    # the timeout here will cause <1 second latency on new login
-                    # requests.
-                    result = await get_redis_connection().blpop(*keys, timeout=1, encoding='utf-8')
-                    if result:
-                        key, result = result
-                        self._keys.remove(key)
-                        keys.remove(key)
-                        if key not in self._futures:
-                            log.warning("got result for missing login key")
-                        else:
-                            future = self._futures.pop(key)
-                            future.set_result(result)
-                    # cleanup stale keys
-                    for key in keys:
-                        if key not in self._futures:
-                            self._keys.remove(key)
-                        future = self._futures[key]
-                        if asyncio.get_event_loop().time() - future._time > LOGIN_TOKEN_EXPIRY:
-                            future.set_excetion(TimeoutError())
-                        if future.done():
-                            del self._futures[key]
-                            self._keys.remove(key)
-            except:
-                log.exception("error while checking logins")
-                if len(self._keys) > 0:
-                    await asyncio.sleep(1)
-        self._running = False
-
-class LoginHandler(RequestVerificationMixin, RedisMixin, DatabaseMixin, BaseHandler):
+class LoginHandler(RequestVerificationMixin, DatabaseMixin, BaseHandler):
 
     def is_address_allowed(self, address):
         return True
 
-    def set_login_result(self, key, address):
-        pipe = self.redis.pipeline()
+    async def set_login_result(self, key, address):
         key = "{}{}".format(LOGIN_KEY_PREFIX, key)
-        pipe.lpush(key, address)
-        pipe.expire(key, LOGIN_TOKEN_EXPIRY)
-        return pipe.execute()
+        async with get_redis_pool(REQUEST_POOL).acquire() as redis:
+            pipe = redis.pipeline()
+            pipe.lpush(key, address)
+            pipe.expire(key, LOGIN_TOKEN_EXPIRY)
+            pipe.publish(LOGIN_NOTIFICATION_CHANNEL, key)
+            return await pipe.execute()
 
     def on_connection_close(self):
         super().on_connection_close()
@@ -149,8 +241,9 @@ class LoginHandler(RequestVerificationMixin, RedisMixin, DatabaseMixin, BaseHand
         num = int(data_encoder(os.urandom(16))[2:], 16)
         token = b62encode(num)
 
-        await self.redis.set('{}{}'.format(AUTH_TOKEN_REDIS_PREFIX, token), address,
-                             expire=AUTH_TOKEN_EXIPRY)
+        async with get_redis_pool(REQUEST_POOL).acquire() as redis:
+            await redis.set('{}{}'.format(AUTH_TOKEN_REDIS_PREFIX, token), address,
+                            expire=AUTH_TOKEN_EXIPRY)
 
         self.write({'auth_token': token})
 
@@ -199,13 +292,15 @@ class LoginHandler(RequestVerificationMixin, RedisMixin, DatabaseMixin, BaseHand
         self.set_status(204)
         self.finish()
 
-class WhoDisHandler(DatabaseMixin, RedisMixin, BaseHandler):
+class WhoDisHandler(DatabaseMixin, BaseHandler):
 
     async def get(self, token):
         key = "{}{}".format(AUTH_TOKEN_REDIS_PREFIX, token)
-        toshi_id = await self.redis.get(key, encoding='utf-8')
+        async with get_redis_pool(REQUEST_POOL).acquire() as redis:
+            toshi_id = await redis.get(key, encoding='utf-8')
+            if toshi_id is not None:
+                await redis.delete(key)
         if toshi_id is not None:
-            await self.redis.delete(key)
             async with self.db:
                 user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1",
                                               toshi_id)
@@ -0,0 +1,212 @@
+import bisect
+import math
+
+import tornado.websocket
+
+from toshi.config import config
+from toshi.errors import JSONHTTPError
+from toshi.handlers import BaseHandler
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+_collectors = []
+
+def register_collector(collector):
+    """Registers a function that's called before the metrics are
+    exposed, used to update gauges that are expensive to keep current"""
+
+    _collectors.append(collector)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(extra[0], _escape(extra[1])))
+    return "{{{}}}".format(",".join(pairs)) if pairs else ""
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class _Metric:
+    """Base for metrics. Children for each set of label values are created
+    with `labels()`, and should be created once up front and kept around
+    so recording a value doesn't need to look anything up"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), *, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        registry.append(self)
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError("Expected labels {} for metric {}".format(self.labelnames, self.name))
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._create_child()
+        return child
+
+    def _create_child(self):
+        raise NotImplementedError
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation.replace('\n', ' ')),
+                 "# TYPE {} {}".format(self.name, self.type)]
+        for values, child in list(self._children.items()):
+            lines.extend(self._expose_child(values, child))
+        return lines
+
+    def _expose_child(self, values, child):
+        return ["{}{} {}".format(self.name, _format_labels(self.labelnames, values), _format_value(child.value))]
+
+class _CounterChild:
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Counter(_Metric):
+
+    type = 'counter'
+
+    def _create_child(self):
+        return _CounterChild()
+
+class _GaugeChild:
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+class Gauge(_Metric):
+
+    type = 'gauge'
+
+    def _create_child(self):
+        return _GaugeChild()
+
+class _HistogramChild:
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # one more than the bounds for +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class Histogram(_Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), *, buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry=registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def _create_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _expose_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(
+                self.name, _format_labels(self.labelnames, values, ('le', _format_value(float(bound)))), cumulative))
+        labels = _format_labels(self.labelnames, values)
+        lines.append("{}_sum{} {}".format(self.name, labels, _format_value(child.sum)))
+        lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+def exposition(registry=REGISTRY):
+    for collector in _collectors:
+        collector()
+    lines = []
+    for metric in registry:
+        lines.extend(metric.expose())
+    lines.append("")
+    return "\n".join(lines)
+
+HTTP_REQUESTS = Counter(
+    'toshiid_http_requests_total', "HTTP requests by route and status class", ['route', 'status'])
+HTTP_REQUEST_DURATION = Histogram(
+    'toshiid_http_request_duration_seconds', "HTTP request latency by route", ['route'])
+
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+class RouteMetrics:
+
+    __slots__ = ('duration', 'statuses')
+
+    def __init__(self, route):
+        self.duration = HTTP_REQUEST_DURATION.labels(route)
+        self.statuses = [HTTP_REQUESTS.labels(route, status) for status in STATUS_CLASSES]
+
+class RequestMetricsMixin:
+
+    _request_metrics = None
+
+    def on_finish(self):
+        super().on_finish()
+        metrics = self._request_metrics
+        metrics.duration.observe(self.request.request_time())
+        status = self.get_status() // 100 - 1
+        if 0 <= status < len(STATUS_CLASSES):
+            metrics.statuses[status].inc()
+
+def route_label(pattern):
+    return pattern.lstrip('^').rstrip('$')
+
+def instrument_urls(urls):
+    """Returns the urls with each handler replaced by a subclass that
+    records request counts and latency for that url. Websocket handlers
+    are left as is, their connections are tracked by the handler"""
+
+    instrumented = []
+    for url in urls:
+        pattern, handler = url[0], url[1]
+        if not issubclass(handler, tornado.websocket.WebSocketHandler):
+            handler = type(handler.__name__, (RequestMetricsMixin, handler), {
+                '_request_metrics': RouteMetrics(route_label(pattern))
+            })
+        instrumented.append((pattern, handler) + tuple(url[2:]))
+    return instrumented
+
+class MetricsHandler(BaseHandler):
+
+    def get(self):
+        token = config['general'].get('metrics_token')
+        if not token and config['general'].getboolean('metrics_require_token', False):
+            raise JSONHTTPError(403, body={'errors': [{'id': 'permission_denied', 'message': 'Permission Denied'}]})
+        if token and self.request.headers.get('Authorization') != "Bearer {}".format(token):
+            raise JSONHTTPError(401, body={'errors': [{'id': 'permission_denied', 'message': 'Permission Denied'}]})
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(exposition())
@@ -0,0 +1,135 @@
+import asyncio
+import os
+import time
+
+import logging
+from toshi.boto import BotoMixin
+from toshi.log import configure_logger
+from toshi.database import prepare_database, get_database_pool
+from toshi.config import config
+from toshiid.avatars import avatar_object_key
+
+DEFAULT_CONCURRENCY = 10
+DEFAULT_BATCH_SIZE = 100
+PROGRESS_INTERVAL = 10
+
+log = logging.getLogger("toshiid.migrate_avatars")
+
+class AvatarMigration(BotoMixin):
+    """Copies avatars stored in the database to the object store, using
+    the same keys as newly uploaded avatars. Once an avatar has been
+    copied its `object_key` is set, and the avatar handler redirects to
+    the object store instead of reading the image from the database.
+
+    Progress is kept in the `object_key` column, so the migration can be
+    stopped and run again at any time to carry on where it left off.
+    Avatars that fail to upload are skipped and retried on the next run.
+
+    If `clear_images` is set the image is removed from the database once
+    it has been copied"""
+
+    def __init__(self, *, concurrency=DEFAULT_CONCURRENCY, batch_size=DEFAULT_BATCH_SIZE, clear_images=False):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.clear_images = clear_images
+
+        self.migrated = 0
+        self.failed = 0
+        self.bytes_uploaded = 0
+
+    async def next_batch(self, after):
+        """Returns the next batch of avatars that haven't been copied yet,
+        ordered by primary key starting after the given (toshi_id, hash)"""
+
+        async with get_database_pool().acquire() as con:
+            if after is None:
+                return await con.fetch(
+                    "SELECT toshi_id, hash, format FROM avatars "
+                    "WHERE object_key IS NULL AND img IS NOT NULL "
+                    "ORDER BY toshi_id, hash LIMIT $1",
+                    self.batch_size)
+            return await con.fetch(
+                "SELECT toshi_id, hash, format FROM avatars "
+                "WHERE object_key IS NULL AND img IS NOT NULL "
+                "AND (toshi_id, hash) > ($1, $2) "
+                "ORDER BY toshi_id, hash LIMIT $3",
+                after[0], after[1], self.batch_size)
+
+    async def migrate_avatar(self, row):
+        async with get_database_pool().acquire() as con:
+            img = await con.fetchval("SELECT img FROM avatars WHERE toshi_id = $1 AND hash = $2",
+                                     row['toshi_id'], row['hash'])
+        if img is None:
+            return
+
+        key = avatar_object_key(row['toshi_id'], row['hash'], row['format'])
+        await self.boto.put_object(key=key, body=img)
+
+        async with get_database_pool().acquire() as con:
+            if self.clear_images:
+                await con.execute("UPDATE avatars SET object_key = $1, img = NULL WHERE toshi_id = $2 AND hash = $3",
+                                  key, row['toshi_id'], row['hash'])
+            else:
+                await con.execute("UPDATE avatars SET object_key = $1 WHERE toshi_id = $2 AND hash = $3",
+                                  key, row['toshi_id'], row['hash'])
+        self.migrated += 1
+        self.bytes_uploaded += len(img)
+
+    async def _migrate_avatar(self, semaphore, row):
+        try:
+            await self.migrate_avatar(row)
+        except:
+            self.failed += 1
+            log.exception("error migrating avatar {}_{}".format(row['toshi_id'], row['hash']))
+        finally:
+            semaphore.release()
+
+    async def run(self):
+        """Copies all avatars that haven't been copied yet, returning the
+        number of avatars copied and the number that failed"""
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        start = last_progress = time.monotonic()
+        after = None
+
+        async with self.boto:
+            while True:
+                rows = await self.next_batch(after)
+                if not rows:
+                    break
+                after = (rows[-1]['toshi_id'], rows[-1]['hash'])
+                for row in rows:
+                    # wait for a free slot before starting the next upload
+                    await semaphore.acquire()
+                    pending = {task for task in pending if not task.done()}
+                    pending.add(asyncio.get_event_loop().create_task(self._migrate_avatar(semaphore, row)))
+
+                if time.monotonic() - last_progress > PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    log.info("Migrated {} avatars ({} bytes), {} failed".format(
+                        self.migrated, self.bytes_uploaded, self.failed))
+            if pending:
+                await asyncio.wait(pending)
+
+        log.info("Finished migrating {} avatars ({} bytes) in {:.1f}s, {} failed".format(
+            self.migrated, self.bytes_uploaded, time.monotonic() - start, self.failed))
+        return self.migrated, self.failed
+
+async def main(concurrency, batch_size, clear_images):
+    await prepare_database()
+    migration = AvatarMigration(concurrency=concurrency, batch_size=batch_size, clear_images=clear_images)
+    await migration.run()
+
+if __name__ == '__main__':
+    from toshiid.app import update_config
+    update_config()
+    configure_logger(log)
+    log.setLevel(logging.INFO)
+    concurrency = int(os.environ.get('AVATAR_MIGRATION_CONCURRENCY', DEFAULT_CONCURRENCY))
+    # each upload holds on to a database connection for a short time
+    config['database']['max_size'] = str(concurrency + 1)
+    asyncio.get_event_loop().run_until_complete(main(
+        concurrency,
+        int(os.environ.get('AVATAR_MIGRATION_BATCH_SIZE', DEFAULT_BATCH_SIZE)),
+        os.environ.get('AVATAR_MIGRATION_CLEAR_IMAGES', 'false').lower() == 'true'))
@@ -0,0 +1,117 @@
+import time
+
+from toshi.config import config
+from toshi.database import get_database_pool
+from toshiid.redis_pools import get_redis_pool, REQUEST_POOL
+
+# how long a session is considered connected without hearing from it
+PRESENCE_TTL = 60
+
+PRESENCE_SESSIONS_KEY = "toshi:id:presence:sessions"
+PRESENCE_CONNECTED_KEY = "toshi:id:presence:connected"
+PRESENCE_USER_SESSIONS_KEY_PREFIX = "toshi:id:presence:user_sessions:"
+
+# the sessions for each toshi_id are kept in a set rather than a count so
+# it can't drift from the sessions zset: refreshing a session adds it back
+# if the set has been lost. the set doesn't expire, stale sessions are
+# removed from it by `expire_sessions`
+
+# KEYS: sessions zset, connected zset, toshi_id's sessions set
+# ARGV: session member, timestamp, toshi_id
+SET_CONNECTED_SCRIPT = """
+local added = redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[3])
+return added
+"""
+
+# KEYS: sessions zset, connected zset, toshi_id's sessions set
+# ARGV: session member, toshi_id
+SET_NOT_CONNECTED_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    redis.call('SREM', KEYS[3], ARGV[1])
+    if redis.call('SCARD', KEYS[3]) == 0 then
+        redis.call('ZREM', KEYS[2], ARGV[2])
+    end
+    return 1
+end
+return 0
+"""
+
+class PostgresPresenceStore:
+    """Stores websocket sessions in the `websocket_sessions` table.
+    Connected filters are done by joining against that table"""
+
+    name = 'postgres'
+
+    async def set_connected(self, session_id, toshi_id):
+        async with get_database_pool().acquire() as con:
+            await con.execute("INSERT INTO websocket_sessions (websocket_session_id, toshi_id) VALUES ($1, $2) "
+                              "ON CONFLICT (websocket_session_id) DO UPDATE "
+                              "SET last_seen = (now() AT TIME ZONE 'utc')",
+                              session_id, toshi_id)
+
+    async def set_not_connected(self, session_id, toshi_id):
+        async with get_database_pool().acquire() as con:
+            await con.execute("DELETE FROM websocket_sessions WHERE websocket_session_id = $1",
+                              session_id)
+
+class RedisPresenceStore:
+    """Stores websocket sessions in redis, keeping a sorted set of
+    session -> last_seen, a sorted set of toshi_id -> last_seen and the
+    set of sessions for each toshi_id"""
+
+    name = 'redis'
+
+    def _keys(self, toshi_id):
+        return [PRESENCE_SESSIONS_KEY, PRESENCE_CONNECTED_KEY,
+                "{}{}".format(PRESENCE_USER_SESSIONS_KEY_PREFIX, toshi_id)]
+
+    async def set_connected(self, session_id, toshi_id):
+        async with get_redis_pool(REQUEST_POOL).acquire() as redis:
+            await redis.eval(
+                SET_CONNECTED_SCRIPT, keys=self._keys(toshi_id),
+                args=["{}:{}".format(toshi_id, session_id), time.time(), toshi_id])
+
+    async def set_not_connected(self, session_id, toshi_id):
+        async with get_redis_pool(REQUEST_POOL).acquire() as redis:
+            await redis.eval(
+                SET_NOT_CONNECTED_SCRIPT, keys=self._keys(toshi_id),
+                args=["{}:{}".format(toshi_id, session_id), toshi_id])
+
+    async def connected_toshi_ids(self):
+        async with get_redis_pool(REQUEST_POOL).acquire() as redis:
+            return await redis.zrangebyscore(
+                PRESENCE_CONNECTED_KEY, min=time.time() - PRESENCE_TTL, encoding='utf-8')
+
+    async def expire_sessions(self, limit=None):
+        """Removes sessions that haven't been refreshed within the ttl,
+        oldest first and at most `limit` of them, returning the number
+        of sessions removed"""
+
+        cutoff = time.time() - PRESENCE_TTL
+        async with get_redis_pool(REQUEST_POOL).acquire() as redis:
+            if limit is None:
+                stale = await redis.zrangebyscore(PRESENCE_SESSIONS_KEY, max=cutoff, encoding='utf-8')
+            else:
+                stale = await redis.zrangebyscore(PRESENCE_SESSIONS_KEY, max=cutoff, offset=0, count=limit,
+                                                  encoding='utf-8')
+            removed = 0
+            for member in stale:
+                toshi_id, session_id = member.split(':', 1)
+                removed += await redis.eval(
+                    SET_NOT_CONNECTED_SCRIPT, keys=self._keys(toshi_id),
+                    args=[member, toshi_id])
+            await redis.zremrangebyscore(PRESENCE_CONNECTED_KEY, max=cutoff)
+        return removed
+
+_stores = {
+    'postgres': PostgresPresenceStore(),
+    'redis': RedisPresenceStore()
+}
+
+def get_presence_store():
+    backend = config['general'].get('presence_backend', 'postgres')
+    if backend not in _stores:
+        raise Exception("Unknown presence backend: {}".format(backend))
+    return _stores[backend]
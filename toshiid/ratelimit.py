@@ -0,0 +1,198 @@
+import collections
+import inspect
+import math
+import time
+
+from toshi.config import config
+from toshi.log import log
+from toshiid.redis_pools import get_redis_pool, REQUEST_POOL
+
+RATE_LIMIT_KEY_PREFIX = "toshi:id:ratelimit:"
+
+# limit the number of buckets kept when falling back to memory
+MAX_MEMORY_BUCKETS = 100000
+
+# token buckets stored as hashes of tokens and last update time.
+# all buckets must have enough tokens for any of them to be taken
+# KEYS: bucket keys
+# ARGV: now, cost, then rate and burst for each key
+# returns 0 if allowed, otherwise how many milliseconds until it would be
+TAKE_TOKENS_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + i * 2])
+    local burst = tonumber(ARGV[2 + i * 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(bucket[1])
+    if available == nil then
+        available = burst
+    else
+        available = math.min(burst, available + math.max(0, now - tonumber(bucket[2])) * rate)
+    end
+    tokens[i] = available
+    if available < cost then
+        wait = math.max(wait, (cost - available) / rate)
+    end
+end
+if wait > 0 then
+    return math.ceil(wait * 1000)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + i * 2])
+    local burst = tonumber(ARGV[2 + i * 2])
+    redis.call('HMSET', key, 'tokens', tokens[i] - cost, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+return 0
+"""
+
+def parse_rate_limits(value):
+    """Parses `"client.search=5:20,route.search=200:400"` into a dict of
+    (scope, route) -> (tokens per second, burst size), where scope is
+    either `client` (a bucket per client) or `route` (a bucket shared by
+    all clients)"""
+
+    limits = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        name, limit = item.split('=', 1)
+        scope, route = name.strip().split('.', 1)
+        if scope not in ('client', 'route'):
+            raise Exception("Unknown rate limit scope: {}".format(scope))
+        rate, burst = limit.split(':', 1)
+        limits[(scope, route)] = (float(rate), float(burst))
+    return limits
+
+class MemoryTokenBuckets:
+    """Token buckets kept in this process only, used when redis isn't
+    available. Limits are then per process rather than shared"""
+
+    def __init__(self, maxsize=MAX_MEMORY_BUCKETS):
+        self.maxsize = maxsize
+        self._buckets = collections.OrderedDict()
+
+    def take(self, buckets, cost, now=None):
+        if now is None:
+            now = time.time()
+        tokens = []
+        wait = 0
+        for key, rate, burst in buckets:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                available = burst
+            else:
+                available = min(burst, bucket[0] + max(0, now - bucket[1]) * rate)
+            tokens.append(available)
+            if available < cost:
+                wait = max(wait, (cost - available) / rate)
+        if wait > 0:
+            return wait
+        for (key, rate, burst), available in zip(buckets, tokens):
+            self._buckets[key] = (available - cost, now)
+            self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return 0
+
+class RateLimiter:
+
+    _instance = None
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.memory = MemoryTokenBuckets()
+        self._redis_failed = False
+        self._config = None
+
+    @staticmethod
+    def get_instance():
+        value = config['general'].get('rate_limits', '')
+        instance = RateLimiter._instance
+        if instance is None or instance._config != value:
+            instance = RateLimiter._instance = RateLimiter(parse_rate_limits(value))
+            instance._config = value
+        return instance
+
+    def buckets(self, route, client):
+        buckets = []
+        if ('client', route) in self.limits:
+            rate, burst = self.limits[('client', route)]
+            buckets.append(("{}{}:{}".format(RATE_LIMIT_KEY_PREFIX, route, client), rate, burst))
+        if ('route', route) in self.limits:
+            rate, burst = self.limits[('route', route)]
+            buckets.append(("{}{}".format(RATE_LIMIT_KEY_PREFIX, route), rate, burst))
+        return buckets
+
+    async def check(self, route, client, cost=1):
+        """Takes `cost` tokens from the route's buckets for the given
+        client. Returns 0 if the request is allowed, otherwise the number
+        of seconds until it would be"""
+
+        buckets = self.buckets(route, client)
+        if not buckets:
+            return 0
+        # don't let a single request cost more than a full bucket
+        cost = min(cost, min(burst for _, _, burst in buckets))
+
+        if 'redis' in config:
+            try:
+                args = [time.time(), cost]
+                for _, rate, burst in buckets:
+                    args.extend([rate, burst])
+                async with get_redis_pool(REQUEST_POOL).acquire() as redis:
+                    wait = await redis.eval(TAKE_TOKENS_SCRIPT, keys=[key for key, _, _ in buckets], args=args)
+                if self._redis_failed:
+                    log.info("rate limiting using redis again")
+                    self._redis_failed = False
+                return wait / 1000
+            except:
+                if not self._redis_failed:
+                    log.exception("error checking rate limit in redis, falling back to memory")
+                    self._redis_failed = True
+
+        return self.memory.take(buckets, cost)
+
+def client_ip(request):
+    """The ip address of the client making the request. Behind proxies
+    (e.g. the heroku router) the connection comes from the proxy, so
+    with `trusted_proxies` set the address each proxy appends to
+    X-Forwarded-For is used instead. Entries before those come from
+    the client, so can't be trusted"""
+
+    trusted_proxies = int(config['general'].get('trusted_proxies', 0))
+    if trusted_proxies > 0:
+        forwarded = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+        if len(forwarded) >= trusted_proxies:
+            return forwarded[-trusted_proxies]
+    return request.remote_ip
+
+class RateLimitMixin:
+    """Applies the configured rate limits for `rate_limit_route` to the
+    handler's `rate_limit_methods`, responding with a 429 when a limit is
+    exceeded. Clients are identified by their ip address, see `client_ip`"""
+
+    rate_limit_route = None
+    rate_limit_methods = ('GET',)
+
+    def rate_limit_cost(self):
+        return 1
+
+    async def prepare(self):
+        rval = super().prepare()
+        if inspect.isawaitable(rval):
+            await rval
+        if self._finished or self.request.method not in self.rate_limit_methods:
+            return
+
+        wait = await RateLimiter.get_instance().check(
+            self.rate_limit_route, client_ip(self.request), self.rate_limit_cost())
+        if wait > 0:
+            self.set_status(429)
+            self.set_header('Retry-After', str(int(math.ceil(wait))))
+            self.set_header('Content-Type', 'application/json')
+            self.write({'errors': [{'id': 'rate_limited', 'message': 'Too Many Requests'}]})
+            self.finish()
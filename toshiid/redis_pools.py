@@ -0,0 +1,213 @@
+import asyncio
+import functools
+import time
+
+import aioredis
+
+from toshi.config import config
+from toshi.log import log
+from toshiid.metrics import Gauge, Histogram, register_collector
+
+# commands run while handling requests
+REQUEST_POOL = 'request'
+# long lived and blocking commands (e.g. pub/sub subscriptions)
+BLOCKING_POOL = 'blocking'
+
+DEFAULT_POOL_SIZES = {
+    REQUEST_POOL: 10,
+    BLOCKING_POOL: 4
+}
+
+# log a warning when waiting longer than this for a free connection
+SLOW_ACQUIRE_WARNING = 0.1
+
+REDIS_POOL_ACQUIRE = Histogram('toshiid_redis_pool_acquire_seconds',
+                               "Time spent waiting for a redis connection", ['pool'])
+REDIS_POOL_WAITING = Gauge('toshiid_redis_pool_waiting', "Callers waiting for a redis connection", ['pool'])
+REDIS_POOL_SIZE = Gauge('toshiid_redis_pool_size', "Open connections in the redis pool", ['pool'])
+REDIS_POOL_FREE = Gauge('toshiid_redis_pool_free', "Free connections in the redis pool", ['pool'])
+REDIS_COMMAND = Histogram('toshiid_redis_command_seconds', "Redis command latency", ['pool', 'command'])
+
+def _observe_since(child, start, future):
+    child.observe(time.monotonic() - start)
+
+class RedisCommandMetrics:
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._children = {}
+
+    def get(self, command):
+        child = self._children.get(command)
+        if child is None:
+            name = command.decode() if isinstance(command, bytes) else command
+            child = self._children[command] = REDIS_COMMAND.labels(self.pool, name.upper())
+        return child
+
+class InstrumentedRedis(aioredis.Redis):
+    """Records the latency of each command. Commands sent as part
+    of a pipeline aren't recorded individually"""
+
+    def __init__(self, pool_or_conn, command_metrics):
+        super().__init__(pool_or_conn)
+        self._command_metrics = command_metrics
+
+    def execute(self, command, *args, **kwargs):
+        child = self._command_metrics.get(command)
+        future = super().execute(command, *args, **kwargs)
+        future.add_done_callback(functools.partial(_observe_since, child, time.monotonic()))
+        return future
+
+def _redis_address():
+    redis_config = config['redis']
+    if 'url' in redis_config:
+        return redis_config['url']
+    if 'unix_socket_path' in redis_config:
+        return redis_config['unix_socket_path']
+    return (redis_config.get('host', 'localhost'), int(redis_config.get('port', 6379)))
+
+class _PoolConnectionContext:
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._client = None
+        self._connection = None
+
+    async def __aenter__(self):
+        self._client, self._connection = await self._pool._acquire()
+        return InstrumentedRedis(self._connection, self._pool._command_metrics)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._client.connection.release(self._connection)
+
+class RedisPool:
+    """A sized pool of redis connections that keeps track of how long
+    callers have to wait for a free connection.
+
+    The pool connects lazily, and reconnects if the redis config or the
+    event loop changes, closing the previous pool first"""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self._connecting = None
+        self._address = None
+        self._loop = None
+
+        self.acquires = 0
+        self.waiting = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        self._command_metrics = RedisCommandMetrics(name)
+        self._acquire_metrics = REDIS_POOL_ACQUIRE.labels(name)
+
+    async def _connect(self, address):
+        pool = await aioredis.create_pool(
+            address, db=int(config['redis'].get('db', 0)), password=config['redis'].get('password'),
+            minsize=1, maxsize=self.size)
+        return InstrumentedRedis(pool, self._command_metrics)
+
+    async def _reconnect(self, address, previous, previous_loop):
+        if previous is not None:
+            await self._close(previous, previous_loop)
+        return await self._connect(address)
+
+    async def _close(self, connecting, loop):
+        """Closes the pool from before the config or event loop changed"""
+
+        if loop is not asyncio.get_event_loop():
+            # the pool can't be waited on from this loop, and if the
+            # old loop has been closed its connections are gone already
+            try:
+                if not connecting.done():
+                    connecting.cancel()
+                elif not connecting.cancelled() and connecting.exception() is None:
+                    connecting.result().connection.close()
+            except RuntimeError:
+                pass
+            return
+        try:
+            redis = await connecting
+        except Exception:
+            return
+        redis.connection.close()
+        await redis.connection.wait_closed()
+
+    async def get_redis(self):
+        """Returns a client that runs commands directly on the pool. Pub/sub
+        commands run on a dedicated connection taken from the pool"""
+
+        address = _redis_address()
+        loop = asyncio.get_event_loop()
+        if self._address != address or self._loop is not loop:
+            previous, previous_loop = self._connecting, self._loop
+            self._address = address
+            self._loop = loop
+            self._connecting = loop.create_task(self._reconnect(address, previous, previous_loop))
+        connecting = self._connecting
+        try:
+            return await connecting
+        except:
+            # make sure we try to connect again next time
+            if self._connecting is connecting:
+                self._address = None
+            raise
+
+    def acquire(self):
+        """Returns a context manager holding a connection from the pool.
+        Use as `async with pool.acquire() as redis:`"""
+
+        return _PoolConnectionContext(self)
+
+    async def _acquire(self):
+        client = await self.get_redis()
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            connection = await client.connection.acquire()
+        finally:
+            self.waiting -= 1
+        wait = time.monotonic() - start
+        self.acquires += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self._acquire_metrics.observe(wait)
+        if wait > SLOW_ACQUIRE_WARNING:
+            log.warning("waited {:.3f}s for a connection from the '{}' redis pool".format(wait, self.name))
+        return client, connection
+
+    def stats(self):
+        stats = {
+            'maxsize': self.size,
+            'acquires': self.acquires,
+            'waiting': self.waiting,
+            'average_wait': self.total_wait / self.acquires if self.acquires else 0.0,
+            'max_wait': self.max_wait
+        }
+        if self._connecting is not None and self._connecting.done() and not self._connecting.exception():
+            pool = self._connecting.result().connection
+            stats['size'] = pool.size
+            stats['freesize'] = pool.freesize
+        return stats
+
+_pools = {}
+
+def get_redis_pool(name):
+    if name not in _pools:
+        if name not in DEFAULT_POOL_SIZES:
+            raise Exception("Unknown redis pool: {}".format(name))
+        size = int(config['general'].get('redis_{}_pool_size'.format(name), DEFAULT_POOL_SIZES[name]))
+        _pools[name] = RedisPool(name, size)
+    return _pools[name]
+
+def redis_pool_stats():
+    return {name: pool.stats() for name, pool in _pools.items()}
+
+def _collect_redis_pool_metrics():
+    for name, stats in redis_pool_stats().items():
+        REDIS_POOL_WAITING.labels(name).set(stats['waiting'])
+        REDIS_POOL_SIZE.labels(name).set(stats.get('size', 0))
+        REDIS_POOL_FREE.labels(name).set(stats.get('freesize', 0))
+
+register_collector(_collect_redis_pool_metrics)
@@ -1,7 +1,8 @@
 import asyncio
-from toshi.database import DatabaseMixin
+from toshiid.database import DatabaseMixin
 from toshi.handlers import BaseHandler
-from toshiid.handlers_v1 import parse_boolean, PUNCTUATION
+from toshiid.handlers_v1 import parse_boolean, PUNCTUATION, LIST_USERS_PER_TOKEN
+from toshiid.ratelimit import RateLimitMixin
 from toshiid.handlers_v2 import user_row_for_json
 from toshi.utils import parse_int, validate_address
 from toshi.errors import JSONHTTPError
@@ -16,7 +17,14 @@ GROUPINGS = [
 ]
 RESULTS_PER_SECTION = 5
 
-class SearchHandler(DatabaseMixin, BaseHandler):
+class SearchHandler(RateLimitMixin, DatabaseMixin, BaseHandler):
+
+    rate_limit_route = 'search'
+    slow_query_log = True
+
+    def rate_limit_cost(self):
+        addresses = len(self.get_query_arguments('toshi_id')) + len(self.get_query_arguments('payment_address'))
+        return 1 + addresses // LIST_USERS_PER_TOKEN
 
     async def get(self):
 
@@ -96,58 +104,10 @@ class SearchHandler(DatabaseMixin, BaseHandler):
         limit = parse_int(self.get_query_argument('limit', 20))
         offset = parse_int(self.get_query_argument('offset', 0))
 
-        if search_query:
-
-            search_query = ''.join([" " if c in PUNCTUATION else c for c in search_query])
-            # split words and add in partial matching flags
-            search_query = '|'.join(['{}:*'.format(word) for word in search_query.split(' ') if word])
-            sql = ("SELECT {} FROM users, TO_TSQUERY($1) AS q WHERE (tsv @@ q){} "
-                   "{}{}")
-            values = [search_query]
-            order_by = "ORDER BY TS_RANK_CD(tsv, TO_TSQUERY($1)), reputation_score DESC NULLS LAST, review_count DESC, username"
-
-        else:
-
-            sql = ("SELECT {} FROM users{} "
-                   "{}{}")
-            values = []
-            order_by = "ORDER BY reputation_score DESC NULLS LAST, review_count DESC, username"
-
-        where_params = []
-
-        if search_type is not None:
-            is_bot = search_type == 'bot' or search_type == 'groupbot'
-            is_groupchatbot = search_type == 'groupbot'
-
-            where_params.append("is_bot = ${}".format(len(values) + 1))
-            values.append(is_bot)
-            where_params.append("is_groupchatbot = ${}".format(len(values) + 1))
-            values.append(is_groupchatbot)
-
-        if is_public is not None:
-            where_params.append("is_public = ${}".format(len(values) + 1))
-            values.append(is_public)
-        if featured is not None:
-            where_params.append("featured = ${}".format(len(values) + 1))
-            values.append(featured)
-
-        if where_params:
-            where_params = " AND ".join(where_params)
-            if search_query:
-                where_params = " AND " + where_params
-            else:
-                where_params = " WHERE " + where_params
-        else:
-            where_params = ""
-
-        paging = " OFFSET ${} LIMIT ${}".format(len(values) + 1, len(values) + 2)
-
         async with self.db:
-            total = await self.db.fetchval(
-                sql.format("COUNT(*)", where_params, "", ""), *values)
-            values.extend([offset, limit])
-            results = await self.db.fetch(
-                sql.format("*", where_params, order_by, paging), *values)
+            total, results = await search_users(
+                self.db, search_type=search_type, search_query=search_query,
+                is_public=is_public, featured=featured, offset=offset, limit=limit)
 
         query = []
         for key, values in self.request.query_arguments.items():
@@ -161,3 +121,69 @@ class SearchHandler(DatabaseMixin, BaseHandler):
             'results': [user_row_for_json(r) for r in results],
             'query': "&".join(query)
         })
+
+async def search_users(db, *, search_type=None, search_query=None, is_public=None, featured=None, offset=0, limit=20):
+    """Runs a search against the users table, returning the total number of
+    matches and the rows for the requested page"""
+
+    if search_query:
+
+        search_query = ''.join([" " if c in PUNCTUATION else c for c in search_query])
+        # split words and add in partial matching flags
+        search_query = '|'.join(['{}:*'.format(word) for word in search_query.split(' ') if word])
+        sql = ("SELECT {} FROM users, TO_TSQUERY($1) AS q WHERE (tsv @@ q){} "
+               "{}{}")
+        values = [search_query]
+        order_by = "ORDER BY TS_RANK_CD(tsv, TO_TSQUERY($1)), reputation_score DESC NULLS LAST, review_count DESC, username"
+
+    else:
+
+        sql = ("SELECT {} FROM users{} "
+               "{}{}")
+        values = []
+        order_by = "ORDER BY reputation_score DESC NULLS LAST, review_count DESC, username"
+
+    where_params = []
+
+    if search_type is not None:
+        is_bot = search_type == 'bot' or search_type == 'groupbot'
+        is_groupchatbot = search_type == 'groupbot'
+
+        where_params.append("is_bot = ${}".format(len(values) + 1))
+        values.append(is_bot)
+        where_params.append("is_groupchatbot = ${}".format(len(values) + 1))
+        values.append(is_groupchatbot)
+
+    if is_public is not None:
+        where_params.append("is_public = ${}".format(len(values) + 1))
+        values.append(is_public)
+    if featured is not None:
+        where_params.append("featured = ${}".format(len(values) + 1))
+        values.append(featured)
+
+    if where_params:
+        where_params = " AND ".join(where_params)
+        if search_query:
+            where_params = " AND " + where_params
+        else:
+            where_params = " WHERE " + where_params
+    else:
+        where_params = ""
+
+    paging = " OFFSET ${} LIMIT ${}".format(len(values) + 1, len(values) + 2)
+
+    total = await db.fetchval(
+        sql.format("COUNT(*)", where_params, "", ""), *values)
+    values.extend([offset, limit])
+    results = await db.fetch(
+        sql.format("*", where_params, order_by, paging), *values)
+
+    return total, results
+
+async def fetch_users(db, toshi_ids):
+    """Returns the users matching the given toshi ids, in the order
+    the toshi ids were given"""
+
+    rows = await db.fetch("SELECT * FROM users WHERE toshi_id = ANY($1)", toshi_ids)
+    ordering = {toshi_id: i for i, toshi_id in enumerate(toshi_ids)}
+    return sorted(rows, key=lambda row: ordering[row['toshi_id']])
@@ -0,0 +1,205 @@
+import asyncio
+import asyncpg
+
+import tornado.websocket
+from tornado.escape import json_encode
+
+from toshi.config import config
+from toshi.database import get_database_pool
+from toshi.log import log
+from toshiid.handlers_v2 import user_row_for_json
+
+USER_UPDATED_CHANNEL = "toshi_id_user_updated"
+
+# stop a single connection from subscribing to the whole user base
+MAX_SUBSCRIPTIONS_PER_CONNECTION = 1000
+
+async def notify_user_updated(db, toshi_id):
+    """Queues a notification that the given user has changed. This should be
+    called inside the transaction making the change, postgres only delivers
+    the notification once the transaction is committed"""
+
+    await db.execute("SELECT pg_notify($1, $2)", USER_UPDATED_CHANNEL, toshi_id)
+
+class SubscriptionManager:
+    """Listens for user update notifications from postgres and forwards
+    them to any websockets subscribed to the updated user.
+
+    The listening connection is checked every `LISTENER_CHECK_INTERVAL`
+    seconds and reconnected with backoff if it's been lost, after which
+    subscribers are sent the current state of their users in case any
+    updates were missed while it was down"""
+
+    _instance = None
+
+    LISTENER_CHECK_INTERVAL = 10
+    LISTENER_CHECK_TIMEOUT = 5
+    LISTENER_MAX_BACKOFF = 60
+
+    def __init__(self):
+        self._subscribers = {}
+        self._pending = set()
+        self._dirty = set()
+        self._listener = None
+        self._listener_dsn = None
+        self._listener_connected = None
+        self._listener_con = None
+
+    @staticmethod
+    def get_instance():
+        if SubscriptionManager._instance is None:
+            SubscriptionManager._instance = SubscriptionManager()
+        return SubscriptionManager._instance
+
+    async def _add_listener(self, dsn):
+        # use a dedicated connection so we don't hold on to
+        # one of the pool's connections forever
+        con = await asyncpg.connect(dsn)
+        try:
+            await con.add_listener(USER_UPDATED_CHANNEL, self._on_notification)
+        except:
+            con.terminate()
+            raise
+        return con
+
+    async def _listen(self, dsn, connected):
+        con = None
+        backoff = 1
+        try:
+            while True:
+                if con is None:
+                    try:
+                        con = self._listener_con = await self._add_listener(dsn)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        if not connected.done():
+                            # let the first subscription know it failed
+                            connected.set_exception(e)
+                            return
+                        log.warning("error reconnecting user update listener, retrying in {}s".format(backoff))
+                        await asyncio.sleep(backoff)
+                        backoff = min(backoff * 2, self.LISTENER_MAX_BACKOFF)
+                        continue
+                    backoff = 1
+                    if not connected.done():
+                        connected.set_result(None)
+                    else:
+                        log.info("user update listener reconnected")
+                        await self._send_updates(list(self._subscribers))
+
+                await asyncio.sleep(self.LISTENER_CHECK_INTERVAL)
+                try:
+                    if con.is_closed():
+                        raise ConnectionError("connection closed")
+                    await con.fetchval("SELECT 1", timeout=self.LISTENER_CHECK_TIMEOUT)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.warning("lost user update listener connection, reconnecting")
+                    self._close_listener_connection(con)
+                    con = None
+        finally:
+            if con is not None:
+                self._close_listener_connection(con)
+
+    def _close_listener_connection(self, con):
+        if not con.is_closed():
+            con.terminate()
+        if self._listener_con is con:
+            self._listener_con = None
+
+    def _stop_listener(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self._listener_con is not None:
+            self._close_listener_connection(self._listener_con)
+        self._listener_dsn = None
+
+    async def subscribe(self, websocket, toshi_ids):
+        dsn = config['database']['dsn']
+        if self._listener_dsn != dsn:
+            # first subscription, or the database has changed
+            self._stop_listener()
+            self._listener_dsn = dsn
+            self._listener_connected = asyncio.get_event_loop().create_future()
+            self._listener = asyncio.get_event_loop().create_task(self._listen(dsn, self._listener_connected))
+        try:
+            # shielded so a cancelled subscription doesn't affect the others
+            await asyncio.shield(self._listener_connected)
+        except asyncio.CancelledError:
+            raise
+        except:
+            # make sure we try again on the next subscription
+            if self._listener_dsn == dsn:
+                self._stop_listener()
+            raise
+        for toshi_id in toshi_ids:
+            self._subscribers.setdefault(toshi_id, set()).add(websocket)
+
+    def unsubscribe(self, websocket, toshi_ids):
+        for toshi_id in toshi_ids:
+            websockets = self._subscribers.get(toshi_id)
+            if websockets is None:
+                continue
+            websockets.discard(websocket)
+            if not websockets:
+                del self._subscribers[toshi_id]
+
+    def _on_notification(self, connection, pid, channel, toshi_id):
+        if toshi_id not in self._subscribers:
+            return
+        self._dirty.add(toshi_id)
+        # multiple updates to the same user while a fetch is running
+        # are picked up by a single fetch once it's done
+        if toshi_id in self._pending:
+            return
+        self._pending.add(toshi_id)
+        asyncio.get_event_loop().create_task(self._send_update(toshi_id))
+
+    async def _fetch_user(self, toshi_id):
+        async with get_database_pool().acquire() as con:
+            return await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
+
+    async def _send_update(self, toshi_id):
+        try:
+            # the flag is cleared before fetching, so an update committed
+            # after the fetch's snapshot marks the user dirty again and
+            # the latest row is fetched on the next pass
+            while toshi_id in self._dirty:
+                self._dirty.discard(toshi_id)
+                try:
+                    row = await self._fetch_user(toshi_id)
+                except:
+                    log.exception("error fetching updated user {}".format(toshi_id))
+                    continue
+                if row is not None:
+                    self._write_update(row)
+        finally:
+            self._pending.discard(toshi_id)
+
+    async def _send_updates(self, toshi_ids):
+        if not toshi_ids:
+            return
+        try:
+            async with get_database_pool().acquire() as con:
+                rows = await con.fetch("SELECT * FROM users WHERE toshi_id = ANY($1)", toshi_ids)
+        except:
+            log.exception("error fetching subscribed users")
+            return
+        for row in rows:
+            self._write_update(row)
+
+    def _write_update(self, row):
+        toshi_id = row['toshi_id']
+        message = json_encode({
+            "jsonrpc": "2.0",
+            "method": "user_updated",
+            "params": [user_row_for_json(row)]
+        })
+        for websocket in list(self._subscribers.get(toshi_id, ())):
+            try:
+                websocket.write_message(message)
+            except tornado.websocket.WebSocketClosedError:
+                self.unsubscribe(websocket, [toshi_id])
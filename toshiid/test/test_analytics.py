@@ -0,0 +1,106 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.analytics import AnalyticsQueue, MixpanelBackend, parse_sample_rates
+from toshi.config import config
+from toshi.test.base import AsyncHandlerTest
+from toshi.test.database import requires_database
+
+try:
+    import mixpanel
+except ImportError:
+    mixpanel = None
+
+class SlowBackend:
+
+    def __init__(self):
+        self.batches = []
+
+    async def send(self, events):
+        await asyncio.sleep(0.1)
+        self.batches.append(events)
+
+class AnalyticsQueueTest(AsyncHandlerTest):
+
+    def setUp(self):
+        fd, self.analytics_file = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        super().setUp(extraconf={'general': {'apps_dont_require_websocket': True,
+                                             'analytics_backend': 'file',
+                                             'analytics_target': self.analytics_file,
+                                             'analytics_flush_interval': '0.1'}})
+
+    def tearDown(self):
+        super().tearDown()
+        os.remove(self.analytics_file)
+
+    def get_urls(self):
+        return urls
+
+    def get_url(self, path):
+        path = "/v1{}".format(path)
+        return super().get_url(path)
+
+    @gen_test
+    @requires_database
+    async def test_search_events_are_queued(self):
+
+        for _ in range(3):
+            resp = await self.fetch("/search/apps?query=bot", method="GET")
+            self.assertResponseCodeEqual(resp, 200)
+            self.assertEqual(len(json_decode(resp.body)['results']), 0)
+
+        await asyncio.sleep(0.5)
+
+        with open(self.analytics_file) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(len(events), 3)
+        for event in events:
+            self.assertEqual(event['type'], 'track')
+            self.assertEqual(event['event'], 'Searched')
+        self.assertEqual(AnalyticsQueue.get_instance().stats()['sent'], 3)
+
+    @gen_test
+    async def test_queue_drops_and_samples(self):
+
+        backend = SlowBackend()
+        queue = AnalyticsQueue(backend, maxsize=10, batch_size=5, flush_interval=0.1,
+                               sample_rates=parse_sample_rates("Searched=0"))
+
+        for i in range(20):
+            queue.put('track', None, 'Edited profile', {'i': i})
+        for i in range(5):
+            queue.put('track', None, 'Searched', {})
+
+        # putting events never waits on the backend
+        self.assertEqual(len(queue), 10)
+        self.assertEqual(queue.dropped, 10)
+        self.assertEqual(queue.sampled_out, 5)
+
+        await asyncio.sleep(0.5)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual([len(batch) for batch in backend.batches], [5, 5])
+        self.assertEqual([data['i'] for batch in backend.batches for _, _, _, data in batch], list(range(10)))
+
+    @unittest.skipIf(mixpanel is None, "mixpanel isn't installed")
+    def test_mixpanel_queued_by_default(self):
+
+        backend = config['general'].pop('analytics_backend')
+        config['mixpanel'] = {'token': 'abc'}
+        try:
+            queue = AnalyticsQueue.get_instance()
+            self.assertIsInstance(queue.backend, MixpanelBackend)
+
+            # sending events directly has to be asked for
+            config['general']['analytics_backend'] = 'direct'
+            self.assertIsNone(AnalyticsQueue.get_instance())
+        finally:
+            config['general']['analytics_backend'] = backend
+            del config['mixpanel']
@@ -8,6 +8,7 @@ from datetime import datetime
 from toshiid.app import urls
 from toshi.test.base import AsyncHandlerTest, ToshiWebSocketJsonRPCClient
 from toshi.test.database import requires_database
+from toshi.test.redis import requires_redis
 from toshi.ethereum.utils import private_key_to_address
 
 TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
@@ -619,3 +620,125 @@ class SearchAppsHandlerWithWebsocketTest(AsyncHandlerTest):
         self.assertEqual(resp.code, 200)
         body = json_decode(resp.body)
         self.assertEqual(len(body['results']), 1)
+
+class SearchAppsHandlerWithRedisPresenceTest(AsyncHandlerTest):
+
+    def setUp(self):
+        super().setUp(extraconf={'general': {'apps_dont_require_websocket': False,
+                                             'presence_backend': 'redis'}})
+        from toshiid.websocket import WebsocketHandler
+        WebsocketHandler.SESSION_CLOSE_TIMEOUT = 0
+
+    def get_urls(self):
+        return urls
+
+    async def websocket_connect(self, signing_key):
+        con = ToshiWebSocketJsonRPCClient(self.get_url("/v1/ws"), signing_key=signing_key)
+        await con.connect()
+        return con
+
+    def fetch(self, url, **kwargs):
+        return super().fetch("/v1{}".format(url), **kwargs)
+
+    @gen_test
+    @requires_database
+    @requires_redis
+    async def test_username_query(self):
+        username = "ToshiBot"
+        positive_query = 'Tos'
+
+        private_key = os.urandom(32)
+        toshi_id = private_key_to_address(private_key)
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, name, toshi_id, is_bot, is_public) VALUES ($1, $2, $3, $4, $5)",
+                              username, username, toshi_id, True, True)
+
+        resp = await self.fetch("/search/apps?query={}".format(positive_query), method="GET")
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), 0)
+
+        con = await self.websocket_connect(private_key)
+
+        resp = await self.fetch("/search/apps?query={}".format(positive_query), method="GET")
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), 1)
+
+        # make sure nothing was written to postgres
+        async with self.pool.acquire() as dbcon:
+            count = await dbcon.fetchval("SELECT COUNT(*) FROM websocket_sessions")
+        self.assertEqual(count, 0)
+
+        con.close()
+        await asyncio.sleep(0.2)
+
+        resp = await self.fetch("/search/apps?query={}".format(positive_query), method="GET")
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), 0)
+
+    @gen_test
+    @requires_database
+    @requires_redis
+    async def test_multiple_websockets(self):
+        username = "ToshiBot"
+        private_key = os.urandom(32)
+        toshi_id = private_key_to_address(private_key)
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, name, toshi_id, is_bot, is_public) VALUES ($1, $2, $3, $4, $5)",
+                              username, username, toshi_id, True, True)
+
+        cons = []
+        for _ in range(3):
+            con = await self.websocket_connect(private_key)
+            cons.append(con)
+
+        resp = await self.fetch("/search/apps", method="GET")
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), 1)
+
+        # the bot should stay connected until all its sessions are closed
+        for con in cons[:2]:
+            con.close()
+        await asyncio.sleep(0.2)
+
+        resp = await self.fetch("/search/apps", method="GET")
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), 1)
+
+        cons[2].close()
+        await asyncio.sleep(0.2)
+
+        resp = await self.fetch("/search/apps", method="GET")
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), 0)
+
+    @gen_test
+    @requires_redis
+    async def test_lost_session_set(self):
+
+        from toshiid.presence import get_presence_store, PRESENCE_USER_SESSIONS_KEY_PREFIX
+        from toshiid.redis_pools import get_redis_pool, REQUEST_POOL
+        presence = get_presence_store()
+        toshi_id = private_key_to_address(os.urandom(32))
+
+        await presence.set_connected('session1', toshi_id)
+        await presence.set_connected('session2', toshi_id)
+        # e.g. a count key from an older version that expired while
+        # both sessions were still connected
+        async with get_redis_pool(REQUEST_POOL).acquire() as redis:
+            await redis.delete("{}{}".format(PRESENCE_USER_SESSIONS_KEY_PREFIX, toshi_id))
+
+        # the next ping restores the session
+        await presence.set_connected('session1', toshi_id)
+        await presence.set_not_connected('session2', toshi_id)
+        self.assertIn(toshi_id, await presence.connected_toshi_ids())
+
+        await presence.set_not_connected('session1', toshi_id)
+        self.assertNotIn(toshi_id, await presence.connected_toshi_ids())
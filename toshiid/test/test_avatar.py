@@ -15,9 +15,12 @@ from tornado.platform.asyncio import to_asyncio_future
 from tornado.ioloop import IOLoop
 
 from toshiid.app import urls
-from toshiid.handlers_v1 import AVATAR_URL_HASH_LENGTH
+from toshiid.avatars import AVATAR_URL_HASH_LENGTH
+from toshiid.handlers_v1 import WEBP_SUPPORTED, process_image, accepts_media_type, ImageProcessingError
+from toshiid.cache import get_image_cache, get_upload_cache
 from toshi.test.moto_server import requires_moto, BotoTestMixin
 from toshi.analytics import encode_id
+from toshi.config import config
 from toshi.test.database import requires_database
 from toshi.test.base import AsyncHandlerTest
 from toshi.ethereum.utils import data_decoder
@@ -50,6 +53,11 @@ def body_producer(boundary, files):
 
 class UserAvatarHandlerTest(BotoTestMixin, AsyncHandlerTest):
 
+    def setUp(self):
+        super().setUp()
+        # each test starts with an empty object store
+        get_upload_cache().clear()
+
     def get_urls(self):
         return urls
 
@@ -86,7 +94,7 @@ class UserAvatarHandlerTest(BotoTestMixin, AsyncHandlerTest):
         self.assertIsNotNone(urow)
         self.assertIsNotNone(urow['avatar'])
         self.assertIsNotNone(
-            regex.match("\/[^\/]+\/public\/avatar\/{}_[a-f0-9]{{{}}}\.png".format(TEST_ADDRESS, AVATAR_URL_HASH_LENGTH),
+            regex.match("\/[^\/]+\/public\/avatar\/blob\/[a-f0-9]{64}\.png",
                         urllib.parse.urlparse(urow['avatar']).path), urow['avatar'])
 
         first_avatar_url = urow['avatar']
@@ -128,7 +136,7 @@ class UserAvatarHandlerTest(BotoTestMixin, AsyncHandlerTest):
         self.assertIsNotNone(urow)
         self.assertIsNotNone(urow['avatar'])
         self.assertIsNotNone(
-            regex.match("\/[^\/]+\/public\/avatar\/{}_[a-f0-9]{{{}}}\.jpg".format(TEST_ADDRESS, AVATAR_URL_HASH_LENGTH),
+            regex.match("\/[^\/]+\/public\/avatar\/blob\/[a-f0-9]{64}\.jpg",
                         urllib.parse.urlparse(urow['avatar']).path))
         jpg_avatar_url = urow['avatar']
 
@@ -167,7 +175,9 @@ class UserAvatarHandlerTest(BotoTestMixin, AsyncHandlerTest):
         async with self.boto:
             objs = await self.boto.list_objects()
         self.assertIn('Contents', objs)
-        self.assertEqual(len(objs['Contents']), 2)
+        # each upload is stored at full size (96px) and 64px, and
+        # in webp as well if it's supported
+        self.assertEqual(len(objs['Contents']), 4 * (2 if WEBP_SUPPORTED else 1))
 
     @gen_test
     @requires_database
@@ -197,7 +207,7 @@ class UserAvatarHandlerTest(BotoTestMixin, AsyncHandlerTest):
         self.assertIsNotNone(urow)
         self.assertIsNotNone(urow['avatar'])
         self.assertIsNotNone(
-            regex.match("\/[^\/]+\/public\/avatar\/{}_[a-f0-9]{{{}}}\.png".format(TEST_ADDRESS, AVATAR_URL_HASH_LENGTH),
+            regex.match("\/[^\/]+\/public\/avatar\/blob\/[a-f0-9]{64}\.png",
                         urllib.parse.urlparse(urow['avatar']).path), urow['avatar'])
         resp = await self.fetch(urow['avatar'], method="GET")
         self.assertEqual(resp.code, 200, "Got unexpected {} for url: {}".format(resp.code, urow['avatar']))
@@ -294,3 +304,236 @@ class UserAvatarHandlerTest(BotoTestMixin, AsyncHandlerTest):
         loop.add_future(f2, f2done)
 
         await asyncio.wait([to_asyncio_future(f) for f in [f1, f2]], timeout=5)
+
+class AvatarSizeTest(BotoTestMixin, AsyncHandlerTest):
+
+    def setUp(self):
+        super().setUp()
+        get_image_cache().clear()
+        get_upload_cache().clear()
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_avatar_sizes(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        boundary = uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+        # 800px, larger than the largest size stored
+        png = blockies.create(TEST_PAYMENT_ADDRESS, size=8, scale=100, format='PNG')
+        body = body_producer(boundary, [('image.png', png)])
+
+        resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 200)
+        avatar_url = json_decode(resp.body)['avatar']
+
+        async with self.boto:
+            objs = await self.boto.list_objects()
+        self.assertEqual(len(objs['Contents']), 4 * (2 if WEBP_SUPPORTED else 1))
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT * FROM avatars WHERE toshi_id = $1 AND format = 'PNG' ORDER BY size",
+                                   TEST_ADDRESS)
+        self.assertEqual([row['size'] for row in rows], [64, 128, 256, 512])
+        full = rows[-1]
+        self.assertTrue(avatar_url.endswith(full['object_key']))
+        self.assertEqual(set(row['source_hash'] for row in rows), {full['hash']})
+
+        for size, expected in [(None, 512), (40, 64), (64, 64), (100, 128), (300, 512), (1000, 512)]:
+            url = "/avatar/{}.png".format(TEST_ADDRESS)
+            if size is not None:
+                url = "{}?size={}".format(url, size)
+            resp = await self.fetch(url, method="GET", follow_redirects=False)
+            self.assertResponseCodeEqual(resp, 302)
+            self.assertEqual(resp.headers['Vary'], 'Accept')
+            self.assertTrue(resp.headers['Location'].endswith('.png'))
+            resp = await self.fetch(url, method="GET")
+            self.assertResponseCodeEqual(resp, 200)
+            self.assertEqual(Image.open(BytesIO(resp.body)).size, (expected, expected), url)
+
+        # sizes are cached by the stored size they pick
+        self.assertIn(('avatar', TEST_ADDRESS, 'PNG', None, 128, False), get_image_cache())
+        self.assertNotIn(('avatar', TEST_ADDRESS, 'PNG', None, 100, False), get_image_cache())
+
+        # sizes of a specific avatar
+        resp = await self.fetch("/avatar/{}_{}.png?size=200".format(TEST_ADDRESS, full['hash'][:AVATAR_URL_HASH_LENGTH]),
+                                method="GET", follow_redirects=False)
+        self.assertResponseCodeEqual(resp, 301)
+        self.assertTrue(resp.headers['Location'].endswith(rows[2]['object_key']))
+
+        resp = await self.fetch("/avatar/{}.png?size=abc".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 400)
+
+    def test_large_jpeg_decoded_at_reduced_size(self):
+
+        jpeg = Image.new('RGB', (2048, 1024), (255, 0, 0))
+        # the left half is blue, so after rotating the top half should be
+        jpeg.paste((0, 0, 255), (0, 0, 1024, 1024))
+        stream = BytesIO()
+        # rotated 90° clockwise
+        exif_dict = {"0th": {piexif.ImageIFD.Orientation: 6}}
+        jpeg.save(stream, format="JPEG", exif=piexif.dump(exif_dict))
+        data = stream.getbuffer().tobytes()
+
+        variants, format = process_image(data, 'image/jpeg')
+        self.assertEqual(format, 'JPEG')
+        size, _, full, _, _ = variants[0]
+        self.assertEqual(size, 512)
+        image = Image.open(BytesIO(full)).convert('RGB')
+        self.assertEqual(image.size, (256, 512))
+        r, g, b = image.getpixel((128, 128))
+        self.assertGreater(b, r)
+        r, g, b = image.getpixel((128, 384))
+        self.assertGreater(r, b)
+
+        # too many pixels is rejected without decoding
+        with self.assertRaises(ImageProcessingError):
+            process_image(data, 'image/jpeg', max_pixels=2048 * 1024 - 1)
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_identical_avatars_stored_once(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'JaneSmith', TEST_ADDRESS_2)
+
+        boundary = uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+        png = blockies.create(TEST_PAYMENT_ADDRESS, size=8, scale=12, format='PNG')
+        body = body_producer(boundary, [('image.png', png)])
+
+        resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 200)
+        avatar_url = json_decode(resp.body)['avatar']
+        # a superuser uploading the same image for another user, from
+        # another process so the upload is processed again
+        get_upload_cache().clear()
+        config['superusers'] = {TEST_ADDRESS: 1}
+        try:
+            resp = await self.fetch_signed("/v1/user/JaneSmith", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                           body=body, headers=headers)
+        finally:
+            del config['superusers']
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['avatar'], avatar_url)
+
+        async with self.boto:
+            objs = await self.boto.list_objects()
+        self.assertEqual(len(objs['Contents']), 2 * (2 if WEBP_SUPPORTED else 1))
+
+        async with self.pool.acquire() as con:
+            blobs = await con.fetchval("SELECT COUNT(*) FROM avatar_blobs")
+            rows = await con.fetch("SELECT * FROM avatars ORDER BY toshi_id, size, format")
+        self.assertEqual(blobs, len(objs['Contents']))
+        # each user has their own references to the same blobs
+        self.assertEqual(len(rows), 2 * blobs)
+        self.assertEqual([row['blob_hash'] for row in rows if row['toshi_id'] == TEST_ADDRESS],
+                         [row['blob_hash'] for row in rows if row['toshi_id'] == TEST_ADDRESS_2])
+
+        # both users' avatar urls resolve to the shared image
+        for address in [TEST_ADDRESS, TEST_ADDRESS_2]:
+            resp = await self.fetch("/avatar/{}.png".format(address), method="GET", follow_redirects=False)
+            self.assertResponseCodeEqual(resp, 302)
+            self.assertEqual(resp.headers['Location'], avatar_url)
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_retried_upload_skips_processing(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        boundary = uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+        png = blockies.create(TEST_PAYMENT_ADDRESS, size=8, scale=12, format='PNG')
+        body = body_producer(boundary, [('image.png', png)])
+
+        hits = get_upload_cache().hits
+        responses = []
+        for _ in range(3):
+            resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                           body=body, headers=headers)
+            self.assertResponseCodeEqual(resp, 200)
+            responses.append(json_decode(resp.body)['avatar'])
+        self.assertEqual(get_upload_cache().hits, hits + 2)
+        self.assertEqual(len(set(responses)), 1)
+
+        # the same image with a different boundary is still the same upload
+        boundary = uuid4().hex
+        resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body_producer(boundary, [('image.png', png)]),
+                                       headers={'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(get_upload_cache().hits, hits + 3)
+
+        resp = await self.fetch("/avatar/{}.png".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.body, png)
+
+    @unittest.skipUnless(WEBP_SUPPORTED, "pillow was built without webp support")
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_webp_avatars(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        boundary = uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+        png = blockies.create(TEST_PAYMENT_ADDRESS, size=8, scale=40, format='PNG')
+        body = body_producer(boundary, [('image.png', png)])
+        resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 200)
+        # the user's avatar is unchanged
+        self.assertTrue(json_decode(resp.body)['avatar'].endswith('.png'))
+
+        async with self.pool.acquire() as con:
+            full = await con.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1 AND format = 'PNG' ORDER BY size DESC",
+                                      TEST_ADDRESS)
+
+        accept = {'Accept': 'image/webp,image/*,*/*;q=0.8'}
+        for url, expected in [("/avatar/{}.png".format(TEST_ADDRESS), 320),
+                              ("/avatar/{}_{}.png".format(TEST_ADDRESS, full['hash'][:AVATAR_URL_HASH_LENGTH]), 320),
+                              ("/avatar/{}.png?size=100".format(TEST_ADDRESS), 128)]:
+            resp = await self.fetch(url, method="GET", headers=accept, follow_redirects=False)
+            self.assertIn(resp.code, (301, 302))
+            self.assertEqual(resp.headers['Vary'], 'Accept')
+            self.assertTrue(resp.headers['Location'].endswith('.webp'), resp.headers['Location'])
+            resp = await self.fetch(url, method="GET", headers=accept)
+            self.assertResponseCodeEqual(resp, 200)
+            image = Image.open(BytesIO(resp.body))
+            self.assertEqual(image.format, 'WEBP')
+            self.assertEqual(image.size, (expected, expected))
+
+            # the same url without webp in the accept header
+            resp = await self.fetch(url, method="GET")
+            self.assertResponseCodeEqual(resp, 200)
+            self.assertEqual(Image.open(BytesIO(resp.body)).format, 'PNG')
+
+            # or refusing it explicitly
+            resp = await self.fetch(url, method="GET", headers={'Accept': 'image/webp;q=0,image/*'})
+            self.assertResponseCodeEqual(resp, 200)
+            self.assertEqual(Image.open(BytesIO(resp.body)).format, 'PNG')
+
+    def test_accepts_media_type(self):
+
+        self.assertTrue(accepts_media_type('image/webp,image/*,*/*;q=0.8', 'image/webp'))
+        self.assertTrue(accepts_media_type('image/png, Image/WebP; q=0.5', 'image/webp'))
+        self.assertFalse(accepts_media_type('image/webp;q=0', 'image/webp'))
+        self.assertFalse(accepts_media_type('image/webp; q=0.0, image/*', 'image/webp'))
+        self.assertFalse(accepts_media_type('image/*,*/*;q=0.8', 'image/webp'))
+        self.assertFalse(accepts_media_type('image/webpx', 'image/webp'))
+        self.assertFalse(accepts_media_type('', 'image/webp'))
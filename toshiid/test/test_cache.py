@@ -0,0 +1,92 @@
+import time
+
+from unittest import mock
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.cache import SegmentedLRUCache, get_image_cache, ENTRY_OVERHEAD
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+
+class SegmentedLRUCacheTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    def test_bounded_by_bytes(self):
+
+        cache = SegmentedLRUCache('test', 10 * (100 + ENTRY_OVERHEAD))
+        for i in range(20):
+            cache.put(i, b'\x00' * 100, 100)
+        self.assertEqual(len(cache), 10)
+        self.assertLessEqual(cache.bytes, cache.maxbytes)
+        self.assertEqual(cache.evictions, 10)
+        self.assertIsNone(cache.get(0))
+        self.assertIsNotNone(cache.get(19))
+
+        # too large for the cache
+        self.assertFalse(cache.put('large', b'\x00' * cache.maxbytes, cache.maxbytes))
+        self.assertNotIn('large', cache)
+
+    def test_frequently_used_entries_are_kept(self):
+
+        cache = SegmentedLRUCache('test', 10 * (100 + ENTRY_OVERHEAD))
+        for i in range(5):
+            cache.put(i, i, 100)
+            cache.get(i)
+        # a scan of entries that are only used once
+        for i in range(100, 200):
+            cache.put(i, i, 100)
+            cache.get(i + 1000)
+        for i in range(5):
+            self.assertEqual(cache.get(i), i)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 10)
+        self.assertEqual(stats['misses'], 100)
+        self.assertAlmostEqual(stats['hit_ratio'], 10 / 110)
+
+    def test_invalidation(self):
+
+        cache = SegmentedLRUCache('test', 1024 * 1024)
+        cache.put(('avatar', 'a', 1), 1, 10, group='a')
+        cache.put(('avatar', 'a', 2), 2, 10, group='a')
+        cache.put(('avatar', 'b', 1), 3, 10, group='b')
+        cache.get(('avatar', 'a', 1))
+        cache.invalidate_group('a')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.bytes, 10 + ENTRY_OVERHEAD)
+        self.assertEqual(cache.get(('avatar', 'b', 1)), 3)
+
+        cache.put('ttl', 1, 10, ttl=60)
+        self.assertEqual(cache.get('ttl'), 1)
+        with mock.patch('toshiid.cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('ttl'))
+        self.assertNotIn('ttl', cache)
+
+    @gen_test
+    @requires_database
+    async def test_avatars_are_cached(self):
+
+        get_image_cache().clear()
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4)",
+                              TEST_ADDRESS, b'\x89PNG', 'abcdef0123456789', 'PNG')
+
+        resp = await self.fetch("/avatar/{}_abcdef.png".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        stats = get_image_cache().stats()
+        self.assertEqual(stats['entries'], 1)
+
+        # served from memory even though it's gone from the database
+        async with self.pool.acquire() as con:
+            await con.execute("DELETE FROM avatars")
+        resp = await self.fetch("/avatar/{}_abcdef.png".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.body, b'\x89PNG')
+        self.assertEqual(get_image_cache().stats()['hits'], stats['hits'] + 1)
+
+        resp = await self.fetch("/metrics", method="GET")
+        self.assertIn('toshiid_cache_bytes{cache="image"}', resp.body.decode('utf-8'))
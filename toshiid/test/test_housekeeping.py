@@ -11,6 +11,7 @@ from toshiid.app import urls
 from toshiid.housekeeping import HousekeepingApplication
 from toshi.test.base import AsyncHandlerTest
 from toshi.test.database import requires_database
+from toshi.test.moto_server import requires_moto, BotoTestMixin
 from toshi.ethereum.utils import private_key_to_address
 
 class HousekeepingTest(AsyncHandlerTest):
@@ -81,3 +82,168 @@ class HousekeepingTest(AsyncHandlerTest):
         self.assertEqual(len(body['results']), 0)
 
         housekeeping.shutdown()
+
+    @gen_test
+    @requires_database
+    async def test_batched_session_cleanup(self):
+
+        stale_time = datetime.utcnow() - timedelta(minutes=2)
+        async with self.pool.acquire() as con:
+            for _ in range(7):
+                await con.execute("INSERT INTO websocket_sessions VALUES ($1, $2, $3)",
+                                  uuid.uuid4().hex, private_key_to_address(os.urandom(32)), stale_time)
+            await con.execute("INSERT INTO websocket_sessions VALUES ($1, $2, $3)",
+                              uuid.uuid4().hex, private_key_to_address(os.urandom(32)), datetime.utcnow())
+
+        housekeeping = HousekeepingApplication(delay=30, batch_size=2, max_batches=2)
+
+        # only 2 batches of 2 can be removed in a single run
+        removed, backlog = await housekeeping.expire_websocket_sessions()
+        self.assertEqual(removed, 4)
+        self.assertTrue(backlog)
+        # with a backlog the next run should happen quickly
+        self.assertLess(housekeeping.next_delay(removed, backlog), 30)
+
+        removed, backlog = await housekeeping.expire_websocket_sessions()
+        self.assertEqual(removed, 3)
+        self.assertFalse(backlog)
+
+        async with self.pool.acquire() as con:
+            count = await con.fetchval("SELECT COUNT(*) FROM websocket_sessions")
+        self.assertEqual(count, 1)
+
+        # with nothing to clean up we go back to the normal delay
+        self.assertEqual(housekeeping.next_delay(0, False), 30)
+
+    @gen_test
+    @requires_database
+    async def test_job_scheduling(self):
+
+        housekeeping = HousekeepingApplication(delay=30)
+
+        calls = []
+
+        async def failing_job():
+            calls.append('failing')
+            raise Exception("failure")
+
+        async def slow_job():
+            calls.append('slow')
+            await asyncio.sleep(0.5)
+
+        async def adaptive_job():
+            calls.append('adaptive')
+            return 0.05
+
+        housekeeping.register_job('failing', failing_job, 0.1)
+        housekeeping.register_job('slow', slow_job, 0.1)
+        housekeeping.register_job('adaptive', adaptive_job, 30)
+        with self.assertRaises(Exception):
+            housekeeping.register_job('failing', failing_job, 0.1)
+
+        housekeeping.start()
+        await asyncio.sleep(0.45)
+
+        # manually trigger the slow job while it's still running
+        slow = housekeeping._jobs['slow']
+        self.assertTrue(slow.running)
+        housekeeping._run_job(slow)
+
+        housekeeping.shutdown()
+
+        stats = housekeeping.stats()
+        # a failing job keeps getting rescheduled
+        self.assertGreater(stats['failing']['runs'], 1)
+        self.assertEqual(stats['failing']['runs'], stats['failing']['failures'])
+        # the slow job never overlaps with itself
+        self.assertEqual(calls.count('slow'), 1)
+        self.assertEqual(stats['slow']['skipped'], 1)
+        # jobs can override their own interval
+        self.assertGreater(stats['adaptive']['runs'], 1)
+        self.assertEqual(stats['websocket_sessions']['failures'], 0)
+
+    @gen_test
+    @requires_database
+    async def test_avatar_garbage_collection(self):
+
+        toshi_id = private_key_to_address(os.urandom(32))
+        referenced_hash = "deadbeef" * 4
+        now = datetime.utcnow()
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, avatar) VALUES ($1, $2, $3)",
+                              "avataruser", toshi_id, "/avatar/{}_{}.png".format(toshi_id, referenced_hash[:6]))
+            # the user's current avatar is old, but still referenced
+            await con.execute("INSERT INTO avatars (toshi_id, img, hash, format, last_modified) VALUES ($1, $2, $3, $4, $5)",
+                              toshi_id, b'\x00' * 100, referenced_hash, 'PNG', now - timedelta(days=10))
+            for i in range(4):
+                await con.execute("INSERT INTO avatars (toshi_id, img, hash, format, last_modified) VALUES ($1, $2, $3, $4, $5)",
+                                  toshi_id, b'\x00' * 10, "{:032x}".format(i), 'PNG', now - timedelta(days=i))
+            # only one jpeg version, which should be kept
+            await con.execute("INSERT INTO avatars (toshi_id, img, hash, format, last_modified) VALUES ($1, $2, $3, $4, $5)",
+                              toshi_id, b'\x00' * 10, "{:032x}".format(10), 'JPEG', now - timedelta(days=20))
+
+        housekeeping = HousekeepingApplication(avatar_versions=2)
+        removed, reclaimed, backlog = await housekeeping.expire_avatar_versions(batch_size=1, max_batches=10)
+        self.assertEqual(removed, 2)
+        self.assertEqual(reclaimed, 20)
+        self.assertFalse(backlog)
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT hash FROM avatars WHERE toshi_id = $1 ORDER BY hash", toshi_id)
+        self.assertEqual([row['hash'] for row in rows],
+                         ["{:032x}".format(0), "{:032x}".format(1), "{:032x}".format(10), referenced_hash])
+
+        # nothing left to do
+        removed, reclaimed, backlog = await housekeeping.expire_avatar_versions()
+        self.assertEqual(removed, 0)
+        self.assertEqual(reclaimed, 0)
+
+class AvatarBlobGarbageCollectionTest(BotoTestMixin, AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_avatar_blob_garbage_collection(self):
+
+        toshi_id = private_key_to_address(os.urandom(32))
+        now = datetime.utcnow()
+        blobs = [
+            # still referenced by an avatar
+            ("{:064x}".format(1), now - timedelta(days=10)),
+            # unreferenced, but used by an upload recently
+            ("{:064x}".format(2), now),
+            # unreferenced and unused
+            ("{:064x}".format(3), now - timedelta(days=10)),
+            ("{:064x}".format(4), now - timedelta(days=10))
+        ]
+        async with self.boto:
+            for blob_hash, _ in blobs:
+                await self.boto.put_object(key="blob/{}".format(blob_hash), body=b'\x00' * 10)
+        async with self.pool.acquire() as con:
+            for blob_hash, last_used in blobs:
+                await con.execute("INSERT INTO avatar_blobs (hash, format, bytes, object_key, last_used) "
+                                  "VALUES ($1, $2, $3, $4, $5)",
+                                  blob_hash, 'PNG', 10, "blob/{}".format(blob_hash), last_used)
+            await con.execute("INSERT INTO avatars (toshi_id, hash, format, blob_hash) VALUES ($1, $2, $3, $4)",
+                              toshi_id, "{:032x}".format(1), 'PNG', blobs[0][0])
+
+        housekeeping = HousekeepingApplication(avatar_versions=2)
+        removed, reclaimed, backlog = await housekeeping.expire_avatar_blobs(batch_size=1, max_batches=10)
+        self.assertEqual(removed, 2)
+        self.assertEqual(reclaimed, 20)
+        self.assertFalse(backlog)
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT hash FROM avatar_blobs ORDER BY hash")
+        self.assertEqual([row['hash'] for row in rows], [blobs[0][0], blobs[1][0]])
+        async with self.boto:
+            objs = await self.boto.list_objects()
+        self.assertEqual(sorted(obj['Key'] for obj in objs['Contents']),
+                         ["blob/{}".format(blobs[0][0]), "blob/{}".format(blobs[1][0])])
+
+        # nothing left to do
+        removed, reclaimed, backlog = await housekeeping.expire_avatar_blobs()
+        self.assertEqual(removed, 0)
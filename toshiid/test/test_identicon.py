@@ -1,6 +1,14 @@
+import blockies
+import random
+
+from io import BytesIO
+from PIL import Image
 from tornado.testing import gen_test
 
 from toshiid.app import urls
+from toshiid.cache import get_image_cache
+from toshiid.identicon import render_png
+from toshi.ethereum.utils import private_key_to_address
 from toshi.test.database import requires_database
 from toshi.test.base import AsyncHandlerTest
 
@@ -29,13 +37,16 @@ class UserAvatarHandlerTest(AsyncHandlerTest):
         resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS), method="GET")
         self.assertResponseCodeEqual(resp, 200)
 
-        async with self.pool.acquire() as con:
-            row = await con.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1",
-                                     "{}_identicon_{}".format(TEST_ADDRESS, "PNG"))
+        self.assertEqual(Image.open(BytesIO(resp.body)).convert('RGB').tobytes(),
+                         Image.open(BytesIO(blockies.create(TEST_ADDRESS, size=8, scale=12, format='PNG'))).tobytes())
 
-        self.assertIsNotNone(row)
+        # identicons aren't stored
+        async with self.pool.acquire() as con:
+            count = await con.fetchval("SELECT COUNT(*) FROM avatars")
+        self.assertEqual(count, 0)
 
         # check caching
+        self.assertIn('immutable', resp.headers['Cache-Control'])
         self.assertIn('Etag', resp.headers)
         last_etag = resp.headers['Etag']
         self.assertIn('Last-Modified', resp.headers)
@@ -46,3 +57,30 @@ class UserAvatarHandlerTest(AsyncHandlerTest):
             'If-Modified-Since': last_modified
         })
         self.assertResponseCodeEqual(resp, 304)
+
+        # the same etag is given when rendered again
+        get_image_cache().clear()
+        resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.headers['Etag'], last_etag)
+        self.assertEqual(resp.headers['Last-Modified'], last_modified)
+
+    def test_render_matches_blockies(self):
+
+        # fixed so failures can be reproduced
+        rng = random.Random(1)
+        seeds = [private_key_to_address(rng.getrandbits(256).to_bytes(32, 'big')) for _ in range(500)]
+        # a few seeds that aren't addresses
+        seeds.extend(["a", "toshi", "\u00e9\u00e8", "0x" + "f" * 64])
+        for seed in seeds:
+            expected = Image.open(BytesIO(blockies.create(seed, size=8, scale=12, format='PNG')))
+            image = Image.open(BytesIO(render_png(seed, size=8, scale=12)))
+            self.assertEqual(image.mode, 'P')
+            self.assertEqual(image.size, expected.size)
+            self.assertEqual(image.convert('RGB').tobytes(), expected.convert('RGB').tobytes(), seed)
+
+        # other sizes and scales
+        for size, scale in [(5, 3), (7, 1), (16, 4)]:
+            expected = Image.open(BytesIO(blockies.create(seeds[0], size=size, scale=scale, format='PNG')))
+            image = Image.open(BytesIO(render_png(seeds[0], size=size, scale=scale)))
+            self.assertEqual(image.convert('RGB').tobytes(), expected.convert('RGB').tobytes())
@@ -0,0 +1,129 @@
+import asyncio
+import blockies
+import os
+import time
+
+from uuid import uuid4
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.cache import get_upload_cache
+from toshiid.image_pool import ImagePool, ImagePoolFull, ImagePoolBroken
+from toshi.config import config
+from toshi.test.moto_server import requires_moto, BotoTestMixin
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+from toshi.ethereum.utils import data_decoder
+
+from toshiid.test.test_avatar import body_producer
+
+TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+
+def get_pid():
+    return os.getpid()
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+def crash():
+    os._exit(1)
+
+class ImagePoolTest(BotoTestMixin, AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    def get_url(self, path):
+        return super().get_url("/v1{}".format(path))
+
+    def setUp(self):
+        super().setUp()
+        get_upload_cache().clear()
+
+    def set_pool_config(self, workers, queue_size):
+        config['general']['image_workers'] = str(workers)
+        config['general']['image_queue_size'] = str(queue_size)
+
+    def tearDown(self):
+        config['general'].pop('image_workers', None)
+        config['general'].pop('image_queue_size', None)
+        if ImagePool._instance is not None:
+            ImagePool._instance.shutdown()
+            ImagePool._instance = None
+        super().tearDown()
+
+    @gen_test
+    async def test_runs_in_worker_process(self):
+
+        self.set_pool_config(1, 1)
+        pool = ImagePool.get_instance()
+        self.assertNotEqual(await pool.run(get_pid), os.getpid())
+        self.assertEqual(pool.stats()['processed'], 1)
+
+        # without workers images are processed in this process
+        self.set_pool_config(0, 1)
+        pool = ImagePool.get_instance()
+        self.assertEqual(await pool.run(get_pid), os.getpid())
+
+    @gen_test
+    async def test_rejects_when_full(self):
+
+        self.set_pool_config(1, 1)
+        pool = ImagePool.get_instance()
+        running = [asyncio.ensure_future(pool.run(sleep, 0.5)) for _ in range(2)]
+        # let them start
+        await asyncio.sleep(0)
+        with self.assertRaises(ImagePoolFull):
+            await pool.run(sleep, 0)
+        self.assertEqual(pool.stats()['rejected'], 1)
+        self.assertEqual(await asyncio.gather(*running), [0.5, 0.5])
+
+        # there's room again once the queue has drained
+        self.assertEqual(pool.stats()['pending'], 0)
+        self.assertEqual(await pool.run(sleep, 0), 0)
+
+    @gen_test
+    async def test_restarts_when_broken(self):
+
+        self.set_pool_config(1, 1)
+        pool = ImagePool.get_instance()
+        with self.assertRaises(ImagePoolBroken):
+            await pool.run(crash)
+        self.assertEqual(pool.stats()['pending'], 0)
+        self.assertNotEqual(await pool.run(get_pid), os.getpid())
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_avatar_upload_when_busy(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)",
+                              'BobSmith', TEST_ADDRESS)
+
+        self.set_pool_config(1, 0)
+        busy = asyncio.ensure_future(ImagePool.get_instance().run(sleep, 1))
+
+        boundary = uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+        png = blockies.create(TEST_ADDRESS, size=8, scale=12, format='PNG')
+        body = body_producer(boundary, [('image.png', png)])
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 503)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'busy')
+
+        await busy
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 200)
+
+        # bad images are still reported from the workers
+        body = body_producer(boundary, [('image.png', b'\x00' * 100)])
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 400)
@@ -7,7 +7,8 @@ from toshiid.app import urls
 from toshi.test.database import requires_database
 from toshi.test.redis import requires_redis
 from toshi.test.base import AsyncHandlerTest
-from toshiid.login import LoginManager
+from toshiid.login import LoginManager, LOGIN_KEY_PREFIX
+from toshiid.redis_pools import redis_pool_stats, REQUEST_POOL, BLOCKING_POOL
 
 from toshiid.test.test_user_v1 import TEST_PRIVATE_KEY, TEST_ADDRESS, TEST_PAYMENT_ADDRESS, TEST_ADDRESS_2
 
@@ -83,6 +84,12 @@ class LoginHandlerTest(AsyncHandlerTest):
         body = json_decode(resp.body)
         self.assertEqual(body['toshi_id'], TEST_ADDRESS)
 
+        # login checks and requests use separate redis pools
+        stats = redis_pool_stats()
+        self.assertGreater(stats[REQUEST_POOL]['acquires'], 0)
+        self.assertGreater(stats[BLOCKING_POOL]['acquires'], 0)
+        self.assertEqual(stats[REQUEST_POOL]['waiting'], 0)
+
     @gen_test(timeout=500)
     @requires_database
     @requires_redis
@@ -154,3 +161,33 @@ class LoginHandlerTest(AsyncHandlerTest):
             keys = keys_
 
         self.assertEqual(len(LoginManager._instance._keys), 0)
+
+    @gen_test
+    @requires_database
+    @requires_redis
+    async def test_login_completes_immediately(self):
+        """Makes sure waiting logins are woken up as soon as the login
+        is posted, rather than on the next poll"""
+
+        await self.create_test_users()
+        request_tokens = ['abcdefgh{}'.format(i) for i in range(10)]
+
+        fs = [asyncio.ensure_future(self.fetch("/login/{}".format(request_token)))
+              for request_token in request_tokens]
+        await asyncio.sleep(0.5)
+        self.assertEqual(len(LoginManager._instance._keys), len(request_tokens))
+
+        request_token = request_tokens[5]
+        start = asyncio.get_event_loop().time()
+        resp = await self.fetch_signed("/login/{}".format(request_token), signing_key=TEST_PRIVATE_KEY, method="POST", body={})
+        self.assertResponseCodeEqual(resp, 204)
+
+        resp = await fs[5]
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertLess(asyncio.get_event_loop().time() - start, 0.5)
+        self.assertEqual(len(LoginManager._instance._keys), len(request_tokens) - 1)
+        self.assertNotIn("{}{}".format(LOGIN_KEY_PREFIX, request_token), LoginManager._instance._futures)
+
+        for f in fs:
+            if not f.done():
+                f.cancel()
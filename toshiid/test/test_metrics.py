@@ -0,0 +1,85 @@
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.metrics import Counter, Histogram, exposition
+from toshi.config import config
+from toshi.test.base import AsyncHandlerTest
+from toshi.test.database import requires_database
+
+class MetricsTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    async def test_metrics_endpoint(self):
+
+        for _ in range(2):
+            resp = await self.fetch("/v1/search/user?query=bob", method="GET")
+            self.assertResponseCodeEqual(resp, 200)
+        resp = await self.fetch("/v1/user/0x0000000000000000000000000000000000000000", method="GET")
+        self.assertResponseCodeEqual(resp, 404)
+
+        resp = await self.fetch("/metrics", method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain'))
+        body = resp.body.decode('utf-8')
+        lines = body.split('\n')
+
+        # the counters are global, so only check they've been counted
+        search_counts = [line for line in lines if line.startswith(
+            'toshiid_http_requests_total{route="/v1/search/user/?",status="2xx"}')]
+        self.assertEqual(len(search_counts), 1)
+        self.assertGreaterEqual(int(search_counts[0].split()[-1]), 2)
+        self.assertIn('toshiid_http_requests_total{route="/v1/user/(?P<username>[^/]+)/?",status="4xx"}', body)
+        self.assertIn('toshiid_http_request_duration_seconds_bucket{route="/v1/search/user/?",le="+Inf"}', body)
+        self.assertIn('toshiid_db_pool_acquire_seconds_count', body)
+        self.assertIn('toshiid_db_pool_in_use', body)
+        self.assertIn('toshiid_db_query_seconds_count{query="SELECT * FROM users WHERE', body)
+        self.assertIn('toshiid_websocket_connections', body)
+
+    @gen_test
+    async def test_metrics_token(self):
+
+        config['general']['metrics_token'] = 'secret'
+        try:
+            resp = await self.fetch("/metrics", method="GET")
+            self.assertResponseCodeEqual(resp, 401)
+            resp = await self.fetch("/metrics", method="GET", headers={'Authorization': 'Bearer secret'})
+            self.assertResponseCodeEqual(resp, 200)
+        finally:
+            del config['general']['metrics_token']
+
+        # on heroku metrics aren't served at all without a token
+        config['general']['metrics_require_token'] = 'true'
+        try:
+            resp = await self.fetch("/metrics", method="GET")
+            self.assertResponseCodeEqual(resp, 403)
+        finally:
+            del config['general']['metrics_require_token']
+
+    def test_exposition_format(self):
+
+        registry = []
+        counter = Counter('test_total', "A test counter", ['name'], registry=registry)
+        histogram = Histogram('test_seconds', "A test histogram", buckets=[0.1, 1], registry=registry)
+        counter.labels('a"b').inc(2)
+        child = histogram.labels()
+        child.observe(0.1)
+        child.observe(0.5)
+        child.observe(5)
+
+        self.assertEqual(exposition(registry).split('\n'), [
+            '# HELP test_total A test counter',
+            '# TYPE test_total counter',
+            'test_total{name="a\\"b"} 2',
+            '# HELP test_seconds A test histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.6',
+            'test_seconds_count 3',
+            ''
+        ])
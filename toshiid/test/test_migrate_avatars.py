@@ -0,0 +1,92 @@
+import blockies
+import hashlib
+
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.cache import get_image_cache
+from toshiid.avatars import AVATAR_URL_HASH_LENGTH
+from toshiid.migrate_avatars import AvatarMigration
+from toshi.test.moto_server import requires_moto, BotoTestMixin
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+TEST_ADDRESS_2 = "0x056db290f8ba3250ca64a45d16284d04bc000000"
+
+class AvatarMigrationTest(BotoTestMixin, AsyncHandlerTest):
+
+    def setUp(self):
+        super().setUp()
+        get_image_cache().clear()
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_migrate_avatars(self):
+
+        avatars = []
+        async with self.pool.acquire() as con:
+            for i, address in enumerate([TEST_ADDRESS, TEST_ADDRESS_2] * 3):
+                png = blockies.create("{}{}".format(address, i), size=8, scale=12, format='PNG')
+                cache_hash = hashlib.md5(png).hexdigest()
+                await con.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4)",
+                                  address, png, cache_hash, 'PNG')
+                avatars.append((address, cache_hash, png))
+
+        # before migrating avatars are served from the database
+        address, cache_hash, png = avatars[0]
+        url = "/avatar/{}_{}.png".format(address, cache_hash[:AVATAR_URL_HASH_LENGTH])
+        resp = await self.fetch(url, method="GET", follow_redirects=False)
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.body, png)
+
+        migration = AvatarMigration(concurrency=2, batch_size=4)
+        migrated, failed = await migration.run()
+        self.assertEqual(migrated, 6)
+        self.assertEqual(failed, 0)
+
+        async with self.boto:
+            objs = await self.boto.list_objects()
+        self.assertEqual(sorted(obj['Key'] for obj in objs['Contents']),
+                         sorted("public/avatar/{}_{}.png".format(address, cache_hash[:AVATAR_URL_HASH_LENGTH])
+                                for address, cache_hash, _ in avatars))
+
+        async with self.pool.acquire() as con:
+            unmigrated = await con.fetchval("SELECT COUNT(*) FROM avatars WHERE object_key IS NULL")
+        self.assertEqual(unmigrated, 0)
+
+        # the same url now redirects to the object store, once
+        # the copy served from the database is out of the cache
+        get_image_cache().clear()
+        resp = await self.fetch(url, method="GET", follow_redirects=False)
+        self.assertResponseCodeEqual(resp, 301)
+        self.assertIn('max-age', resp.headers['Cache-Control'])
+        self.assertTrue(resp.headers['Location'].endswith(
+            "/public/avatar/{}_{}.png".format(address, cache_hash[:AVATAR_URL_HASH_LENGTH])))
+        resp = await self.fetch(url, method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.body, png)
+
+        # the latest avatar redirect is only cached for a short time
+        resp = await self.fetch("/avatar/{}.png".format(address), method="GET", follow_redirects=False)
+        self.assertResponseCodeEqual(resp, 302)
+
+        # running again only picks up avatars added since
+        async with self.pool.acquire() as con:
+            png = blockies.create(TEST_ADDRESS, size=8, scale=10, format='PNG')
+            await con.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4)",
+                              TEST_ADDRESS, png, hashlib.md5(png).hexdigest(), 'PNG')
+        migration = AvatarMigration(clear_images=True)
+        migrated, failed = await migration.run()
+        self.assertEqual(migrated, 1)
+        self.assertEqual(failed, 0)
+
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1 AND hash = $2",
+                                     TEST_ADDRESS, hashlib.md5(png).hexdigest())
+        self.assertIsNotNone(row['object_key'])
+        self.assertIsNone(row['img'])
@@ -0,0 +1,103 @@
+import os
+
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.ratelimit import MemoryTokenBuckets, RateLimiter
+from toshi.config import config
+from toshi.test.base import AsyncHandlerTest
+from toshi.test.database import requires_database
+from toshi.test.redis import requires_redis
+from toshi.ethereum.utils import private_key_to_address
+
+class RateLimitTest(AsyncHandlerTest):
+
+    def setUp(self):
+        super().setUp(extraconf={'general': {'apps_dont_require_websocket': True,
+                                             'rate_limits': 'client.search=1:3'}})
+
+        # make sure buckets from previous tests aren't used
+        RateLimiter._instance = None
+
+    def get_urls(self):
+        return urls
+
+    async def check_search_limit(self):
+
+        for _ in range(3):
+            resp = await self.fetch("/v1/search/user?query=bob", method="GET")
+            self.assertResponseCodeEqual(resp, 200)
+
+        resp = await self.fetch("/v1/search/user?query=bob", method="GET")
+        self.assertResponseCodeEqual(resp, 429)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'rate_limited')
+
+        # v2 search shares the same bucket
+        resp = await self.fetch("/v2/search?query=bob", method="GET")
+        self.assertResponseCodeEqual(resp, 429)
+
+        # routes without limits aren't affected
+        resp = await self.fetch("/v1/categories", method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+
+    @gen_test
+    @requires_database
+    async def test_search_rate_limit_in_memory(self):
+        await self.check_search_limit()
+
+    @gen_test
+    @requires_database
+    @requires_redis
+    async def test_search_rate_limit_in_redis(self):
+        await self.check_search_limit()
+
+    @gen_test
+    @requires_database
+    async def test_list_users_cost(self):
+
+        toshi_ids = [private_key_to_address(os.urandom(32)) for _ in range(200)]
+        # 200 users costs 3 tokens, using up the whole bucket
+        resp = await self.fetch("/v1/search/user?{}".format("&".join("toshi_id={}".format(toshi_id) for toshi_id in toshi_ids)),
+                                method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+
+        resp = await self.fetch("/v1/search/user?toshi_id={}".format(toshi_ids[0]), method="GET")
+        self.assertResponseCodeEqual(resp, 429)
+
+    @gen_test
+    @requires_database
+    async def test_client_ip_behind_proxy(self):
+
+        config['general']['trusted_proxies'] = '1'
+        try:
+            for _ in range(3):
+                resp = await self.fetch("/v1/search/user?query=bob", method="GET",
+                                        headers={'X-Forwarded-For': '10.0.0.1'})
+                self.assertResponseCodeEqual(resp, 200)
+            # addresses before the one added by the proxy come from the client
+            resp = await self.fetch("/v1/search/user?query=bob", method="GET",
+                                    headers={'X-Forwarded-For': '10.0.0.2, 10.0.0.1'})
+            self.assertResponseCodeEqual(resp, 429)
+
+            # other clients behind the same proxy have their own buckets
+            resp = await self.fetch("/v1/search/user?query=bob", method="GET",
+                                    headers={'X-Forwarded-For': '10.0.0.3'})
+            self.assertResponseCodeEqual(resp, 200)
+        finally:
+            config['general'].pop('trusted_proxies', None)
+
+    def test_memory_token_buckets(self):
+
+        buckets = MemoryTokenBuckets(maxsize=2)
+        limits = [("client", 1, 2), ("route", 10, 10)]
+        self.assertEqual(buckets.take(limits, 1, now=100), 0)
+        self.assertEqual(buckets.take(limits, 1, now=100), 0)
+        # the client bucket is empty, so no tokens should be taken from the route
+        self.assertEqual(buckets.take(limits, 1, now=100), 1)
+        self.assertEqual(buckets._buckets["route"], (8, 100))
+        # refills over time
+        self.assertEqual(buckets.take(limits, 1, now=101), 0)
+        self.assertEqual(buckets.take([("other", 1, 1)], 1, now=101), 0)
+        self.assertEqual(len(buckets._buckets), 2)
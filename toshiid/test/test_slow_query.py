@@ -0,0 +1,61 @@
+import asyncio
+
+from unittest import mock
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.database import query_shape
+from toshi.test.base import AsyncHandlerTest
+from toshi.test.database import requires_database
+
+class SlowQueryLogTest(AsyncHandlerTest):
+
+    def setUp(self):
+        super().setUp(extraconf={'general': {'slow_query_threshold': '0',
+                                             'slow_query_explain_rate': '1'}})
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    async def test_slow_queries_are_logged_and_explained(self):
+
+        with mock.patch('toshiid.database.log') as log:
+            resp = await self.fetch("/v2/search?query=bob&type=user", method="GET")
+            self.assertResponseCodeEqual(resp, 200)
+
+            # wait for the explain to finish
+            for _ in range(50):
+                messages = [call[0][0] for call in log.warning.call_args_list]
+                if any(message.startswith("plan for slow query") for message in messages):
+                    break
+                await asyncio.sleep(0.1)
+
+        slow = [message for message in messages if message.startswith("slow query")]
+        self.assertGreater(len(slow), 0)
+        self.assertIn("params: (str", slow[0])
+        plans = [message for message in messages if message.startswith("plan for slow query")]
+        self.assertEqual(len(plans), 1)
+        self.assertIn("Buffers", plans[0])
+        log.exception.assert_not_called()
+
+    @gen_test
+    @requires_database
+    async def test_handlers_without_slow_query_log(self):
+
+        with mock.patch('toshiid.database.log') as log:
+            resp = await self.fetch("/v1/categories", method="GET")
+            self.assertResponseCodeEqual(resp, 200)
+        log.warning.assert_not_called()
+
+    def test_query_shape(self):
+
+        self.assertEqual(
+            query_shape("SELECT u.* FROM users u JOIN (VALUES ('0x1', 0) , ('0x2', 1) ) AS v (toshi_id, ordering) "
+                        "ON u.toshi_id = v.toshi_id ORDER BY v.ordering"),
+            "SELECT u.* FROM users u JOIN (VALUES (...) ) AS v (toshi_id, ordering) "
+            "ON u.toshi_id = v.toshi_id ORDER BY v.ordering")
+        self.assertEqual(
+            query_shape("SELECT * FROM users\n  WHERE toshi_id = $1 LIMIT 10 OFFSET 20"),
+            "SELECT * FROM users WHERE toshi_id = $1 LIMIT ? OFFSET ?")
@@ -0,0 +1,111 @@
+import blockies
+import time
+
+from uuid import uuid4
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.cache import get_upload_cache
+from toshiid.uploads import multipart_boundary, parse_multipart, signature_data_string, keccak_256
+from toshi.config import config
+from toshi.handlers import TIMESTAMP_EXPIRY
+from toshi.request import sign_request
+from toshi.test.moto_server import requires_moto, BotoTestMixin
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+from toshi.ethereum.utils import data_decoder, ecrecover
+
+from toshiid.test.test_avatar import body_producer
+
+TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+
+class StreamingUploadTest(BotoTestMixin, AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    def setUp(self):
+        super().setUp()
+        get_upload_cache().clear()
+
+    def tearDown(self):
+        config['general'].pop('max_upload_size', None)
+        super().tearDown()
+
+    def test_parse_multipart(self):
+
+        boundary = uuid4().hex
+        body = body_producer(boundary, [('image.png', b'png data'), ('image.jpg', b'jpeg\r\ndata')])
+        boundary = multipart_boundary('multipart/form-data; boundary="{}"'.format(boundary))
+        parts = list(parse_multipart(body, boundary))
+        self.assertEqual([(name, filename, content_type) for name, filename, content_type, _, _ in parts],
+                         [('image.png', 'image.png', 'image/png'), ('image.jpg', 'image.jpg', 'image/jpeg')])
+        self.assertEqual([body[start:end] for _, _, _, start, end in parts], [b'png data', b'jpeg\r\ndata'])
+
+        with self.assertRaises(ValueError):
+            list(parse_multipart(body[:-10], boundary))
+
+    def test_signature_from_body_digest(self):
+
+        body = b'avatar data'
+        timestamp = int(time.time())
+        signature = sign_request(TEST_PRIVATE_KEY, "PUT", "/v1/user", timestamp, body)
+        digest = keccak_256()
+        digest.update(body)
+        self.assertTrue(ecrecover(signature_data_string("PUT", "/v1/user", timestamp, digest.digest()),
+                                  signature, TEST_ADDRESS))
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_upload_limits(self):
+
+        boundary = uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+        png = blockies.create(TEST_ADDRESS, size=8, scale=12, format='PNG')
+        body = body_producer(boundary, [('image.png', png)])
+
+        # the user doesn't exist yet
+        resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 404)
+
+        # stale signatures are rejected before the upload is read
+        timestamp = int(time.time()) - (TIMESTAMP_EXPIRY + 60)
+        signature = sign_request(TEST_PRIVATE_KEY, "PUT", "/v1/user", timestamp, body)
+        resp = await self.fetch_signed("/v1/user", method="PUT", timestamp=timestamp, address=TEST_ADDRESS,
+                                       signature=signature, body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 400)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'invalid_timestamp')
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        config['general']['max_upload_size'] = str(len(body) - 1)
+        resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 413)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'too_large')
+
+        config['general']['max_upload_size'] = str(len(body))
+        resp = await self.fetch_signed("/v1/user/BobSmith", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertIsNotNone(json_decode(resp.body)['avatar'])
+
+        # only one file can be uploaded
+        body = body_producer(boundary, [('image.png', png), ('image2.png', png)])
+        config['general']['max_upload_size'] = str(len(body))
+        resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 404)
+
+        # the signature still covers the whole body
+        timestamp = int(time.time())
+        signature = sign_request(TEST_PRIVATE_KEY, "PUT", "/v1/user", timestamp, body)
+        resp = await self.fetch_signed("/v1/user", method="PUT", timestamp=timestamp, address=TEST_ADDRESS,
+                                       signature=signature, body=body_producer(boundary, [('image.png', png)]),
+                                       headers=headers)
+        self.assertResponseCodeEqual(resp, 400)
@@ -0,0 +1,237 @@
+import asyncio
+import os
+
+from tornado.escape import json_decode, json_encode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.subscriptions import SubscriptionManager
+from toshi.test.base import AsyncHandlerTest, ToshiWebSocketJsonRPCClient
+from toshi.test.database import requires_database
+from toshi.config import config
+from toshi.ethereum.utils import data_decoder
+
+TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+TEST_ADDRESS_2 = "0x7f0294b53af29ded2b5fa04b6225a1bc334a41e6"
+
+class WebsocketJsonRPCTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    async def websocket_connect(self, signing_key):
+        con = ToshiWebSocketJsonRPCClient(self.get_url("/v1/ws"), signing_key=signing_key)
+        await con.connect()
+        return con
+
+    async def create_test_users(self):
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, name, toshi_id, is_bot, is_public) VALUES ($1, $2, $3, $4, $5)",
+                              "BobSmith", "Bob Smith", TEST_ADDRESS, False, True)
+            await con.execute("INSERT INTO users (username, name, toshi_id, is_bot, is_public) VALUES ($1, $2, $3, $4, $5)",
+                              "ToshiBot", "Toshi Bot", TEST_ADDRESS_2, True, True)
+
+    @gen_test
+    @requires_database
+    async def test_get_users(self):
+
+        await self.create_test_users()
+        con = await self.websocket_connect(os.urandom(32))
+
+        result = await con.call("get_users", [[TEST_ADDRESS_2, TEST_ADDRESS, "0x0000000000000000000000000000000000000000"]])
+        self.assertEqual(len(result), 2)
+        # results should be in the requested order
+        self.assertEqual(result[0]['toshi_id'], TEST_ADDRESS_2)
+        self.assertEqual(result[0]['type'], 'bot')
+        self.assertEqual(result[1]['toshi_id'], TEST_ADDRESS)
+        self.assertEqual(result[1]['username'], 'BobSmith')
+
+        con.close()
+
+    @gen_test
+    @requires_database
+    async def test_search(self):
+
+        await self.create_test_users()
+        con = await self.websocket_connect(os.urandom(32))
+
+        result = await con.call("search", {"query": "toshi", "type": "bot"})
+        self.assertEqual(result['total'], 1)
+        self.assertEqual(result['results'][0]['toshi_id'], TEST_ADDRESS_2)
+
+        result = await con.call("search", {"type": "user", "public": True})
+        self.assertEqual(result['total'], 1)
+        self.assertEqual(result['results'][0]['toshi_id'], TEST_ADDRESS)
+
+        con.close()
+
+    @gen_test
+    @requires_database
+    async def test_get_categories(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO categories (category_id, tag) VALUES ($1, $2)", 1, "cat1")
+            await con.execute("INSERT INTO category_names (category_id, name) VALUES ($1, $2)", 1, "Category1")
+
+        con = await self.websocket_connect(os.urandom(32))
+
+        result = await con.call("get_categories")
+        self.assertEqual(result, [{"id": 1, "tag": "cat1", "name": "Category1"}])
+
+        con.close()
+
+    @gen_test
+    @requires_database
+    async def test_batch_requests(self):
+
+        await self.create_test_users()
+        con = await self.websocket_connect(os.urandom(32))
+
+        con.con.write_message(json_encode([
+            {"jsonrpc": "2.0", "id": 1, "method": "get_users", "params": [[TEST_ADDRESS]]},
+            {"jsonrpc": "2.0", "id": 2, "method": "get_users", "params": [[TEST_ADDRESS_2]]},
+            {"jsonrpc": "2.0", "id": 3, "method": "get_users", "params": [["not an address"]]}
+        ]))
+        responses = json_decode(await con.con.read_message())
+        self.assertEqual(len(responses), 3)
+        responses = {response['id']: response for response in responses}
+        self.assertEqual(responses[1]['result'][0]['toshi_id'], TEST_ADDRESS)
+        self.assertEqual(responses[2]['result'][0]['toshi_id'], TEST_ADDRESS_2)
+        self.assertIn('error', responses[3])
+
+        # empty batches are invalid
+        con.con.write_message(json_encode([]))
+        response = json_decode(await con.con.read_message())
+        self.assertIn('error', response)
+
+        con.close()
+
+    @gen_test
+    @requires_database
+    async def test_user_update_subscription(self):
+
+        await self.create_test_users()
+        con = await self.websocket_connect(os.urandom(32))
+
+        result = await con.call("subscribe", [[TEST_ADDRESS]])
+        self.assertTrue(result)
+
+        resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body={"name": "Jamie"})
+        self.assertResponseCodeEqual(resp, 200)
+
+        notification = json_decode(await con.con.read_message())
+        self.assertEqual(notification['method'], 'user_updated')
+        self.assertEqual(notification['params'][0]['toshi_id'], TEST_ADDRESS)
+        self.assertEqual(notification['params'][0]['name'], 'Jamie')
+
+        # reputation updates should also be sent
+        config['reputation'] = {'id': TEST_ADDRESS}
+        resp = await self.fetch_signed("/v1/reputation", signing_key=TEST_PRIVATE_KEY, method="POST",
+                                       body={'toshi_id': TEST_ADDRESS, "reputation_score": 4.4,
+                                             "review_count": 10, "average_rating": 4.9})
+        self.assertResponseCodeEqual(resp, 204)
+
+        notification = json_decode(await con.con.read_message())
+        self.assertEqual(notification['method'], 'user_updated')
+        self.assertEqual(notification['params'][0]['review_count'], 10)
+
+        result = await con.call("unsubscribe", [[TEST_ADDRESS]])
+        self.assertTrue(result)
+
+        con.close()
+
+    @gen_test
+    @requires_database
+    async def test_update_during_fetch(self):
+
+        await self.create_test_users()
+        con = await self.websocket_connect(os.urandom(32))
+
+        result = await con.call("subscribe", [[TEST_ADDRESS]])
+        self.assertTrue(result)
+
+        # hold on to the first fetch's result until another
+        # update has been committed after it was read
+        manager = SubscriptionManager.get_instance()
+        fetch_user = manager._fetch_user
+        fetched = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow_fetch_user(toshi_id):
+            row = await fetch_user(toshi_id)
+            if not fetched.is_set():
+                fetched.set()
+                await release.wait()
+            return row
+
+        manager._fetch_user = slow_fetch_user
+        try:
+            resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                           body={"name": "Jamie"})
+            self.assertResponseCodeEqual(resp, 200)
+            await asyncio.wait_for(fetched.wait(), 5)
+
+            resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                           body={"name": "Alice"})
+            self.assertResponseCodeEqual(resp, 200)
+            for _ in range(50):
+                if TEST_ADDRESS in manager._dirty:
+                    break
+                await asyncio.sleep(0.1)
+            else:
+                self.fail("second update wasn't received")
+            release.set()
+
+            notification = json_decode(await con.con.read_message())
+            self.assertEqual(notification['params'][0]['name'], 'Jamie')
+            # the update made during the fetch is sent as well
+            notification = json_decode(await con.con.read_message())
+            self.assertEqual(notification['params'][0]['name'], 'Alice')
+        finally:
+            del manager._fetch_user
+
+        con.close()
+
+    @gen_test
+    @requires_database
+    async def test_subscription_listener_reconnects(self):
+
+        await self.create_test_users()
+        con = await self.websocket_connect(os.urandom(32))
+
+        SubscriptionManager.LISTENER_CHECK_INTERVAL = 0.1
+        try:
+            result = await con.call("subscribe", [[TEST_ADDRESS]])
+            self.assertTrue(result)
+
+            # drop the listening connection, as if postgres had been restarted
+            manager = SubscriptionManager.get_instance()
+            pid = manager._listener_con.get_server_pid()
+            async with self.pool.acquire() as dbcon:
+                await dbcon.execute("SELECT pg_terminate_backend($1)", pid)
+
+            for _ in range(50):
+                await asyncio.sleep(0.1)
+                if manager._listener_con is not None and manager._listener_con.get_server_pid() != pid:
+                    break
+            else:
+                self.fail("listener didn't reconnect")
+
+            # subscribers are sent the current state after reconnecting
+            notification = json_decode(await con.con.read_message())
+            self.assertEqual(notification['method'], 'user_updated')
+            self.assertEqual(notification['params'][0]['name'], 'Bob Smith')
+
+            resp = await self.fetch_signed("/v1/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                           body={"name": "Jamie"})
+            self.assertResponseCodeEqual(resp, 200)
+
+            notification = json_decode(await con.con.read_message())
+            self.assertEqual(notification['method'], 'user_updated')
+            self.assertEqual(notification['params'][0]['name'], 'Jamie')
+        finally:
+            SubscriptionManager.LISTENER_CHECK_INTERVAL = 10
+
+        con.close()
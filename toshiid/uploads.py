@@ -0,0 +1,209 @@
+import base64
+import collections
+import inspect
+import mmap
+import regex
+import tempfile
+import time
+
+from tornado.httputil import HTTPHeaders
+from toshi.config import config
+from toshi.errors import JSONHTTPError
+from toshi.ethereum.utils import data_decoder, ecrecover
+from toshi.handlers import TOSHI_ID_ADDRESS_HEADER, TOSHI_SIGNATURE_HEADER, TOSHI_TIMESTAMP_HEADER, TIMESTAMP_EXPIRY
+from toshi.utils import parse_int, validate_address
+
+try:
+    from Crypto.Hash import keccak
+
+    def keccak_256():
+        return keccak.new(digest_bits=256)
+except ImportError:
+    from sha3 import keccak_256
+
+DEFAULT_MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+
+# a file from a multipart upload, as `length` bytes at `offset` in the
+# spooled body at `path`
+UploadedFile = collections.namedtuple('UploadedFile', ['path', 'offset', 'length', 'filename', 'content_type'])
+
+DISPOSITION_PARAMS = regex.compile(r';\s*([\w*]+)=(?:"([^"]*)"|([^;\s]*))')
+
+def multipart_boundary(content_type):
+    for field in content_type.split(';')[1:]:
+        key, _, value = field.strip().partition('=')
+        if key == 'boundary' and value:
+            if len(value) > 1 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+            return value.encode('latin1')
+    return None
+
+def signature_data_string(method, path, timestamp, body_digest):
+    """The string signed by clients for a request, the same as
+    `toshi.request.generate_request_signature_data_string` builds,
+    but from the keccak256 digest of the body rather than the body"""
+
+    return "{}\n{}\n{}\n{}".format(method, path, timestamp, base64.b64encode(body_digest).decode('ascii'))
+
+def parse_multipart(body, boundary):
+    """Yields `(name, filename, content_type, start, end)` for each part of
+    the multipart body, where `start` and `end` are the offsets of the
+    part's data. `body` can be an mmap so the data isn't copied"""
+
+    delimiter = b'--' + boundary
+    last = body.rfind(delimiter + b'--')
+    if last == -1:
+        raise ValueError("Missing final boundary")
+    position = body.find(delimiter)
+    while position < last:
+        start = position + len(delimiter) + 2
+        position = body.find(delimiter, start)
+        headers_end = body.find(b'\r\n\r\n', start, position)
+        if headers_end == -1:
+            raise ValueError("Missing part headers")
+        headers = HTTPHeaders.parse(body[start:headers_end].decode('utf-8'))
+        disposition = headers.get('Content-Disposition', '')
+        params = {key: quoted or unquoted for key, quoted, unquoted in DISPOSITION_PARAMS.findall(disposition)}
+        if not disposition.startswith('form-data') or 'name' not in params:
+            raise ValueError("Invalid Content-Disposition")
+        # the data is followed by \r\n before the next delimiter
+        yield (params['name'], params.get('filename'), headers.get('Content-Type', 'application/unknown'),
+               headers_end + 4, position - 2)
+
+class StreamingUploadMixin:
+    """Writes multipart/form-data bodies to a temporary file as they're
+    received, rather than buffering them in memory. Other bodies are
+    buffered as usual.
+
+    Handlers must be decorated with `tornado.web.stream_request_body`, and
+    call `read_body` before using the request body. Files in the upload
+    are then in `self.uploads`, and other fields in the body arguments.
+
+    `prepare_upload` is called before an upload is received, so requests
+    that would be rejected anyway can be rejected before reading it.
+    Uploads larger than `max_upload_size` are refused.
+
+    The body of an upload is hashed as it's received, so `verify_request`
+    checks the signature without reading it back in"""
+
+    upload_methods = ('PUT',)
+
+    uploads = ()
+    _upload_file = None
+    _upload_digest = None
+    _body_chunks = None
+
+    @property
+    def max_upload_size(self):
+        return int(config['general'].get('max_upload_size', DEFAULT_MAX_UPLOAD_SIZE))
+
+    async def prepare(self):
+        rval = super().prepare()
+        if inspect.isawaitable(rval):
+            await rval
+        if self._finished:
+            return
+
+        content_type = self.request.headers.get('Content-Type', '')
+        if self.request.method not in self.upload_methods or not content_type.startswith('multipart/form-data'):
+            self._body_chunks = []
+            return
+
+        max_size = self.max_upload_size
+        content_length = parse_int(self.request.headers.get('Content-Length'))
+        if content_length is not None and content_length > max_size:
+            raise JSONHTTPError(413, body={'errors': [{'id': 'too_large', 'message': 'Upload too large'}]})
+
+        await self.prepare_upload()
+
+        # chunked uploads are cut off by the connection once they're too large
+        self.request.connection.set_max_body_size(max_size)
+        self._upload_file = tempfile.NamedTemporaryFile(prefix='upload-')
+        self._upload_digest = keccak_256()
+
+    async def prepare_upload(self):
+        pass
+
+    def check_signature_headers(self):
+        """Checks the signature headers are all there and the timestamp
+        is current, returning `(address, signature, timestamp)`. Uploads
+        can be rejected with this before they're read, the signature can
+        only be checked once they have been"""
+
+        address = self.request.headers.get(TOSHI_ID_ADDRESS_HEADER)
+        signature = self.request.headers.get(TOSHI_SIGNATURE_HEADER)
+        timestamp = self.request.headers.get(TOSHI_TIMESTAMP_HEADER)
+        for header, value in [(TOSHI_ID_ADDRESS_HEADER, address), (TOSHI_SIGNATURE_HEADER, signature),
+                              (TOSHI_TIMESTAMP_HEADER, timestamp)]:
+            if value is None:
+                raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Missing {}'.format(header)}]})
+
+        timestamp = parse_int(timestamp)
+        if timestamp is None or abs(int(time.time()) - timestamp) > TIMESTAMP_EXPIRY:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_timestamp', 'message': 'Invalid Toshi-Timestamp'}]})
+        if not validate_address(address):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_id_address', 'message': 'Invalid Toshi-ID-Address'}]})
+        try:
+            if len(data_decoder(signature)) != 65:
+                raise ValueError()
+        except Exception:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_signature', 'message': 'Invalid Toshi-Signature'}]})
+        return address, signature, timestamp
+
+    def data_received(self, chunk):
+        if self._upload_file is not None:
+            self._upload_file.write(chunk)
+            self._upload_digest.update(chunk)
+        elif self._body_chunks is not None:
+            self._body_chunks.append(chunk)
+
+    def read_body(self):
+
+        if self._upload_file is None:
+            self.request.body = b''.join(self._body_chunks or ())
+            self._body_chunks = None
+            return
+
+        self.request.body = b''
+        self._upload_file.flush()
+        boundary = multipart_boundary(self.request.headers['Content-Type'])
+        uploads = []
+        try:
+            if boundary is None:
+                raise ValueError("Missing boundary")
+            with mmap.mmap(self._upload_file.fileno(), 0, access=mmap.ACCESS_READ) as body:
+                for name, filename, content_type, start, end in parse_multipart(body, boundary):
+                    if filename is None:
+                        value = body[start:end]
+                        self.request.body_arguments.setdefault(name, []).append(value)
+                        self.request.arguments.setdefault(name, []).append(value)
+                    else:
+                        uploads.append(UploadedFile(self._upload_file.name, start, end - start,
+                                                    filename, content_type))
+        except ValueError:
+            # includes mmapping an empty file
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_data', 'message': 'Invalid multipart/form-data'}]})
+        self.uploads = uploads
+
+    def verify_request(self):
+        if self._upload_file is None:
+            return super().verify_request()
+        address, signature, timestamp = self.check_signature_headers()
+        data_string = signature_data_string(self.request.method, self.request.path, timestamp,
+                                            self._upload_digest.digest())
+        if not ecrecover(data_string, signature, address):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_signature', 'message': 'Invalid Toshi-Signature'}]})
+        return address
+
+    def _close_upload(self):
+        if self._upload_file is not None:
+            self._upload_file.close()
+            self._upload_file = None
+
+    def on_finish(self):
+        self._close_upload()
+        super().on_finish()
+
+    def on_connection_close(self):
+        self._close_upload()
+        super().on_connection_close()
@@ -1,14 +1,33 @@
+import asyncio
 import os
 import uuid
 
 import tornado.websocket
 import tornado.ioloop
+from tornado.escape import json_decode, json_encode
 
-from toshi.database import DatabaseMixin, get_database_pool
+from toshiid.database import DatabaseMixin
 from toshi.handlers import RequestVerificationMixin
 from toshi.jsonrpc.handlers import JsonRPCBase
+from toshi.jsonrpc.errors import JsonRPCInvalidParamsError
+from toshi.utils import parse_int, validate_address
 
 from toshi.log import log
+from toshiid.handlers_v1 import parse_boolean, fetch_categories, category_row_for_json
+from toshiid.handlers_v2 import user_row_for_json
+from toshiid.keepalive import KeepaliveScheduler
+from toshiid.presence import get_presence_store
+from toshiid.search_v2 import search_users, fetch_users
+from toshiid.subscriptions import SubscriptionManager, MAX_SUBSCRIPTIONS_PER_CONNECTION
+from toshiid.metrics import Counter, Gauge, register_collector
+
+# limits to stop a single message from tying up the database
+MAX_BATCH_SIZE = 50
+MAX_USERS_PER_REQUEST = 100
+MAX_SEARCH_LIMIT = 100
+# how many requests from a single connection can use the database at
+# once, however many messages or batched requests it sends
+MAX_CONCURRENT_REQUESTS = 4
 
 class ToshiIdJsonRPCHandler(JsonRPCBase, DatabaseMixin):
 
@@ -17,6 +36,92 @@ class ToshiIdJsonRPCHandler(JsonRPCBase, DatabaseMixin):
         self.application = application
         self.request = request
 
+    async def get_users(self, toshi_ids):
+
+        if not isinstance(toshi_ids, list) or len(toshi_ids) > MAX_USERS_PER_REQUEST or \
+           not all(isinstance(toshi_id, str) and validate_address(toshi_id) for toshi_id in toshi_ids):
+            raise JsonRPCInvalidParamsError(data={'id': 'bad_arguments', 'message': 'Bad Arguments'})
+
+        async with self.db:
+            rows = await fetch_users(self.db, [toshi_id.lower() for toshi_id in toshi_ids])
+
+        return [user_row_for_json(row) for row in rows]
+
+    async def search(self, query=None, type=None, public=None, featured=None, offset=0, limit=20):
+
+        offset = parse_int(offset)
+        limit = parse_int(limit)
+        if offset is None or limit is None or offset < 0 or limit < 0 or limit > MAX_SEARCH_LIMIT:
+            raise JsonRPCInvalidParamsError(data={'id': 'bad_arguments', 'message': 'Bad Arguments'})
+        if (query is not None and not isinstance(query, str)) or type not in (None, 'user', 'bot', 'groupbot'):
+            raise JsonRPCInvalidParamsError(data={'id': 'bad_arguments', 'message': 'Bad Arguments'})
+
+        async with self.db:
+            total, rows = await search_users(
+                self.db, search_type=type, search_query=query,
+                is_public=parse_boolean(public), featured=parse_boolean(featured),
+                offset=offset, limit=limit)
+
+        return {
+            'limit': limit,
+            'offset': offset,
+            'total': total,
+            'results': [user_row_for_json(row) for row in rows]
+        }
+
+    async def get_categories(self):
+
+        async with self.db:
+            rows = await fetch_categories(self.db)
+
+        return [category_row_for_json(row) for row in rows]
+
+    def _validate_toshi_ids(self, toshi_ids):
+        if not isinstance(toshi_ids, list) or \
+           not all(isinstance(toshi_id, str) and validate_address(toshi_id) for toshi_id in toshi_ids):
+            raise JsonRPCInvalidParamsError(data={'id': 'bad_arguments', 'message': 'Bad Arguments'})
+        return set(toshi_id.lower() for toshi_id in toshi_ids)
+
+    async def subscribe(self, toshi_ids):
+        """Subscribes the websocket to `user_updated` notifications
+        for the given users"""
+
+        toshi_ids = self._validate_toshi_ids(toshi_ids)
+        websocket = self.request
+        if len(websocket.subscriptions | toshi_ids) > MAX_SUBSCRIPTIONS_PER_CONNECTION:
+            raise JsonRPCInvalidParamsError(data={'id': 'too_many_subscriptions', 'message': 'Too Many Subscriptions'})
+
+        manager = SubscriptionManager.get_instance()
+        await manager.subscribe(websocket, toshi_ids)
+        if websocket.ws_connection is None:
+            # the websocket was closed while we were subscribing
+            manager.unsubscribe(websocket, toshi_ids)
+        else:
+            websocket.subscriptions.update(toshi_ids)
+        return True
+
+    def unsubscribe(self, toshi_ids):
+
+        toshi_ids = self._validate_toshi_ids(toshi_ids)
+        websocket = self.request
+        SubscriptionManager.get_instance().unsubscribe(websocket, toshi_ids)
+        websocket.subscriptions.difference_update(toshi_ids)
+        return True
+
+WEBSOCKET_CONNECTIONS = Gauge('toshiid_websocket_connections', "Open websocket connections").labels()
+WEBSOCKET_MESSAGES = Counter('toshiid_websocket_messages_total', "Websocket messages received").labels()
+WEBSOCKET_KEEPALIVE = Gauge('toshiid_websocket_keepalive_connections',
+                            "Websocket connections in the keep alive wheel").labels()
+WEBSOCKET_SUBSCRIBED_USERS = Gauge('toshiid_websocket_subscribed_users',
+                                   "Users with at least one websocket subscribed to their updates").labels()
+
+def _collect_websocket_metrics():
+    WEBSOCKET_KEEPALIVE.set(sum(len(keepalive) for keepalive in KeepaliveScheduler._instances.values()))
+    subscriptions = SubscriptionManager._instance
+    WEBSOCKET_SUBSCRIBED_USERS.set(len(subscriptions._subscribers) if subscriptions is not None else 0)
+
+register_collector(_collect_websocket_metrics)
+
 class WebsocketHandler(tornado.websocket.WebSocketHandler, RequestVerificationMixin):
 
     KEEP_ALIVE_TIMEOUT = 30
@@ -31,12 +136,13 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, RequestVerificationMi
     def open(self):
 
         self.io_loop = tornado.ioloop.IOLoop.current()
-        self.schedule_ping()
+        self.keepalive = KeepaliveScheduler.get_instance(self.KEEP_ALIVE_TIMEOUT)
+        self.keepalive.add(self)
         self.session_id = uuid.uuid4().hex
+        self.subscriptions = set()
+        self.request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
         self.io_loop.add_callback(self.set_connected)
-
-    def schedule_ping(self):
-        self._pingcb = self.io_loop.call_later(self.KEEP_ALIVE_TIMEOUT, self.send_ping)
+        WEBSOCKET_CONNECTIONS.inc()
 
     def send_ping(self):
         try:
@@ -45,19 +151,48 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, RequestVerificationMi
             pass
 
     def on_pong(self, data):
-        self.schedule_ping()
         self.io_loop.add_callback(self.set_connected)
 
     def on_close(self):
-        if hasattr(self, '_pingcb'):
-            self.io_loop.remove_timeout(self._pingcb)
-        # only remove after some time to give some leway in brefiely disconnected client
-        self.io_loop.call_later(self.SESSION_CLOSE_TIMEOUT, self.set_not_connected)
+        if hasattr(self, 'subscriptions'):
+            SubscriptionManager.get_instance().unsubscribe(self, self.subscriptions)
+        if hasattr(self, 'keepalive'):
+            WEBSOCKET_CONNECTIONS.dec()
+            self.keepalive.remove(self)
+            # only remove after some time to give some leway in brefiely disconnected client
+            self.keepalive.call_later(self.SESSION_CLOSE_TIMEOUT, self.set_not_connected)
+
+    async def _handle_request(self, message):
+        async with self.request_semaphore:
+            return await ToshiIdJsonRPCHandler(
+                self.toshi_id, self.application, self)(message)
+
+    async def _handle_batch(self, message):
+        """Runs the requests in a JSON-RPC batch concurrently, up to the
+        connection's request limit, returning the encoded list of responses"""
+
+        try:
+            requests = json_decode(message)
+        except ValueError:
+            requests = None
+        if not isinstance(requests, list) or len(requests) == 0 or len(requests) > MAX_BATCH_SIZE:
+            return {"jsonrpc": "2.0", "id": None,
+                    "error": {"code": -32600, "message": "Invalid Request"}}
+
+        responses = await asyncio.gather(*[
+            self._handle_request(json_encode(request)) for request in requests])
+        # notifications don't get a response
+        responses = [response for response in responses if response]
+        if responses:
+            return json_encode(responses)
+        return None
 
     async def _on_message(self, message):
         try:
-            response = await ToshiIdJsonRPCHandler(
-                self.toshi_id, self.application, self)(message)
+            if message.lstrip()[:1] in ('[', b'['):
+                response = await self._handle_batch(message)
+            else:
+                response = await self._handle_request(message)
             if response:
                 self.write_message(response)
         except:
@@ -67,18 +202,13 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, RequestVerificationMi
     def on_message(self, message):
         if message is None:
             return
+        WEBSOCKET_MESSAGES.inc()
         tornado.ioloop.IOLoop.current().add_callback(self._on_message, message)
 
     async def set_connected(self):
 
-        async with get_database_pool().acquire() as con:
-            await con.execute("INSERT INTO websocket_sessions (websocket_session_id, toshi_id) VALUES ($1, $2) "
-                              "ON CONFLICT (websocket_session_id) DO UPDATE "
-                              "SET last_seen = (now() AT TIME ZONE 'utc')",
-                              self.session_id, self.toshi_id)
+        await get_presence_store().set_connected(self.session_id, self.toshi_id)
 
     async def set_not_connected(self):
 
-        async with get_database_pool().acquire() as con:
-            await con.execute("DELETE FROM websocket_sessions WHERE websocket_session_id = $1",
-                              self.session_id)
+        await get_presence_store().set_not_connected(self.session_id, self.toshi_id)